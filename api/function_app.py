@@ -1,15 +1,42 @@
 import os
+import asyncio
 import base64
+import binascii
 import re
-from datetime import datetime, timedelta, date
+import time
+import threading
+from urllib.parse import parse_qs
+from datetime import datetime, timedelta, date, timezone
 import json
+import contextvars
+from contextlib import contextmanager, nullcontext
 import uuid
+import hashlib
+import itertools
+import random
+import gzip
+import io
+import math
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import importlib
 import azure.functions as func
 import logging
-import requests
-from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
-from azure.storage.blob import BlobServiceClient
-from azure.cosmos import CosmosClient, exceptions
+
+class LazyModule:
+    # Imports the module on first attribute access. The Azure SDKs and requests are only needed by
+    # some events, keeping them out of module load shortens cold starts on the Consumption plan.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+requests = LazyModule("requests")
+exceptions = LazyModule("azure.cosmos.exceptions")
 
 tables = {
     'events': os.environ.get('EVENTS_TABLE_NAME'),
@@ -29,271 +56,566 @@ buckets = {
     
 COSMOS_DB_ENDPOINT = os.getenv("COSMOS_DB_ENDPOINT")
 COSMOS_DB_DATABASE = os.getenv("COSMOS_DB_DATABASE")
+COSMOS_BATCH_LIMIT = 100
+TRANSACT_WRITE_MAX_WORKERS = int(os.getenv("TRANSACT_WRITE_MAX_WORKERS", "8"))
+READ_DB_PAGE_SIZE = int(os.getenv("READ_DB_PAGE_SIZE", "100"))
+READ_DB_MAX_PAGE_SIZE = 1000
 
 # Function is fronted by Easy Auth authentication and can safely use Anonymous authentication here
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
-from azure.mgmt.containerinstance import ContainerInstanceManagementClient
-from azure.mgmt.containerinstance.models import (
-    ContainerGroup,
-    Container,
-    ContainerGroupNetworkProtocol,
-    ContainerPort,
-    ResourceRequests,
-    ResourceRequirements,
-    OperatingSystemTypes,
-    ContainerGroupIdentity,
-    ResourceIdentityType,
-    ContainerGroupSubnetId,
-    ContainerGroupDiagnostics,
-    LogAnalytics
-)
+### REQUEST PIPELINE ###
+
+# The body is parsed once into an ApiRequest, validated against the schema its event registered
+# and then dispatched. Handlers read request.body and request.data instead of parsing again.
+LOG_MAX_STRING = int(os.getenv("LOG_MAX_STRING", "256"))
+LOG_MAX_ITEMS = 20
+LOG_REDACTED_FIELDS = {"base64_content", "password", "secret", "client_secret", "sas", "sas_token", "access_token"}
+JSON_TYPE_NAMES = {dict: "an object", list: "a list", str: "a string", (dict, list): "an object or a list"}
+
+event_handlers = {}
+
+class ApiRequest:
+    def __init__(self, http: func.HttpRequest, event, body, data):
+        self.http = http
+        self.event = event
+        self.body = body
+        self.data = data
+        self.headers = http.headers
+        self.params = http.params
+
+def api_event(name, body=None, data=dict, required=()):
+    def register(fn):
+        event_handlers[name] = {"handler": fn, "body": body or {}, "data": data, "required": required}
+        return fn
+    return register
+
+def validate_request(spec, body, data):
+    for field, kind in spec["body"].items():
+        if not isinstance((body or {}).get(field), kind):
+            return f"'{field}' must be {JSON_TYPE_NAMES[kind]}."
+    if "table" in spec["body"] and body["table"] not in tables:
+        return f"Unknown table '{body['table']}'."
+    if spec["data"] is not None and not isinstance(data, spec["data"]):
+        return f"'data' must be {JSON_TYPE_NAMES[spec['data']]}."
+    missing = [field for field in spec["required"] if isinstance(data, dict) and data.get(field) in (None, "")]
+    if missing:
+        return f"Missing {', '.join(missing)} in data."
+    return None
+
+def redact_for_log(value, depth=0):
+    if depth > 8:
+        return "<...>"
+    if isinstance(value, dict):
+        return {
+            key: f"<redacted {len(str(item))} chars>" if key in LOG_REDACTED_FIELDS else redact_for_log(item, depth + 1)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        items = [redact_for_log(item, depth + 1) for item in value[:LOG_MAX_ITEMS]]
+        if len(value) > LOG_MAX_ITEMS:
+            items.append(f"<{len(value) - LOG_MAX_ITEMS} more items>")
+        return items
+    if isinstance(value, str) and len(value) > LOG_MAX_STRING:
+        return f"{value[:LOG_MAX_STRING]}...<{len(value)} chars>"
+    return value
+
+def parse_api_request(req: func.HttpRequest):
+    # Returns an ApiRequest, or the error response when the request is rejected
+    # Raw chunks carry their parameters in the query string, the body is not JSON
+    if req.params.get('event') == 'upload_chunk':
+        event, body, data = 'upload_chunk', None, dict(req.params)
+    else:
+        try:
+            body = req.get_json()
+        except ValueError:
+            return func.HttpResponse("Invalid JSON body.", status_code=400)
+        if not isinstance(body, dict):
+            return func.HttpResponse("Invalid JSON body.", status_code=400)
+        event, data = body.get('event'), body.get('data')
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("event=%s body=%s", event, json.dumps(redact_for_log(body if body is not None else data), default=str))
+
+    spec = event_handlers.get(event)
+    if spec is None:
+        return func.HttpResponse(json.dumps({"result":f"Invalid event type ({event})"}), status_code=400)
+    if data is None and spec["data"] in (dict, (dict, list)):
+        data = {}
+    error = validate_request(spec, body, data)
+    if error:
+        return func.HttpResponse(json.dumps({"result": error}), status_code=400, mimetype="application/json")
+    return ApiRequest(req, event, body, data)
 
 @app.function_name(name="generic_api")
 @app.route(route="api")
 def handler(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
-    logging.info("req_body:")
-    logging.info(req_body)
+    request = parse_api_request(req)
+    if isinstance(request, func.HttpResponse):
+        return request
 
-    event = req_body.get('event')
     import traceback
+    metrics_token = begin_request_metrics(request.event)
     try:
-        if event == 'insert_db':
-            return insert_db(req)
-        elif event == 'read_db':
-            return read_db(req)
-        elif event == 'start_runner':
-            return start_runner(req)
-        elif event == 'upload_file_base64':
-            return upload_file_base64(req)
-        elif event == 'upload_file_url':
-            return upload_file_url(req)
-        elif event == 'read_logs':
-            return read_logs(req)
-        elif event == 'generate_presigned_url':
-            return generate_presigned_url(req)
-        elif event == 'transact_write':
-            return transact_write(req)
-        else:
-            return func.HttpResponse(json.dumps({"result":f"Invalid event type ({event})"}), status_code=400)
+        response = event_handlers[request.event]["handler"](request)
     except Exception as e:
         tb = traceback.format_exc()
-        return func.HttpResponse(json.dumps({"result":f"Api error: {e}", "tb": tb}), status_code=500)
-    
-def transact_write(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
+        response = func.HttpResponse(json.dumps({"result":f"Api error: {e}", "tb": tb}), status_code=500)
+    return finish_request_metrics(metrics_token, response)
 
+@api_event("transact_write", body={"items": list}, data=None)
+def transact_write(request: ApiRequest) -> func.HttpResponse:
     principal = os.getenv("AZURE_SUBSCRIPTION_ID")
     if not principal:
         return func.HttpResponse("Missing AZURE_SUBSCRIPTION_ID", status_code=500)
 
-    resp = get_work_token(principal)
     try:
-        tokens = resp.json()
-    except Exception as e:
-        return func.HttpResponse(resp.text, status_code=resp.status_code)
-
-    db_link   = f"dbs/{COSMOS_DB_DATABASE}"
-
-    responses = []
+        tokens = get_work_token(principal)
+    except BrokerTokenError as e:
+        return func.HttpResponse(str(e), status_code=e.status_code)
 
-    for item in req_body['items']:
-        try:
-            if 'Put' in item:
-                container_name = item['Put']['TableName']
-                container_name = tables[container_name]
-
-                coll_link   = f"{db_link}/colls/{container_name}"
-                credential  = { coll_link: tokens[container_name] }
-                client      = CosmosClient(COSMOS_DB_ENDPOINT, credential=credential)
-                container   = client.get_database_client(COSMOS_DB_DATABASE).get_container_client(container_name)
-
-                put_item = item['Put']['Item']
-                put_item.update({'id': get_id(put_item)}) # Reserved field that should not be used in InfraWeave rows, but is required by Cosmos DB
-                
-                response = container.upsert_item(put_item)
-                responses.append({"operation": "Put", "status": "Success", "item_id": put_item["id"]})
-                
-            elif 'Delete' in item:
-                container_name = item['Delete']['TableName']
-                container_name = tables[container_name]
-                
-                coll_link   = f"{db_link}/colls/{container_name}"
-                credential  = { coll_link: tokens[container_name] }
-                client      = CosmosClient(COSMOS_DB_ENDPOINT, credential=credential)
-                container   = client.get_database_client(COSMOS_DB_DATABASE).get_container_client(container_name)
-                
-                delete_key = item['Delete']['Key']
-                
-                container.delete_item(item=delete_key['id'], partition_key=principal)
-                responses.append({"operation": "Delete", "status": "Success", "item_id": delete_key["id"]})
+    containers = {
+        container_name: get_cosmos_container(container_name, tokens[container_name])
+        for container_name in write_item_containers(request.body['items'])
+    }
+    paths = {container_name: container_partition_key_path(container_name, container) for container_name, container in containers.items()}
+    groups = group_write_items(request.body['items'], principal, paths)
+    jobs = [
+        (containers[container_name], partition_key, entries)
+        for (container_name, partition_key), entries in groups.items()
+    ]
+    if len(jobs) <= 1:
+        results = [execute_write_group(*job) for job in jobs]
+    else:
+        with ThreadPoolExecutor(max_workers=min(TRANSACT_WRITE_MAX_WORKERS, len(jobs))) as pool:
+            results = list(pool.map(in_request_context(lambda job: execute_write_group(*job)), jobs))
+    return write_results_response(request.body['items'], results)
+
+def write_item_containers(items) -> set:
+    return {
+        tables[item[operation]['TableName']]
+        for item in items for operation in ('Put', 'Delete') if operation in item
+    }
 
-        except exceptions.CosmosHttpResponseError as e:
-            responses.append({
-                "error": str(e)
-            })
+def group_write_items(items, principal, paths) -> dict:
+    # Items for the same container and partition key are written as one transactional batch,
+    # independent groups run concurrently. Puts are grouped by the value at the container's
+    # partition key path, Puts where that value is unknown are upserted one by one (group key None).
+    groups = {}
+    for index, item in enumerate(items):
+        if 'Put' in item:
+            container_name = tables[item['Put']['TableName']]
+            put_item = item['Put']['Item']
+            put_item.update({'id': get_id(put_item)}) # Reserved field that should not be used in InfraWeave rows, but is required by Cosmos DB
+            operation = ("Put", put_item["id"], ("upsert", (put_item,)))
+            partition_key = partition_key_value(paths.get(container_name), put_item)
+        elif 'Delete' in item:
+            container_name = tables[item['Delete']['TableName']]
+            delete_key = item['Delete']['Key']
+            operation = ("Delete", delete_key["id"], ("delete", (delete_key["id"],)))
+            partition_key = principal
+        else:
+            continue
+        groups.setdefault((container_name, partition_key), []).append((index, operation))
+    return groups
+
+def partition_key_value(path, item):
+    # Only top-level paths can be read from the document
+    return item.get(path.lstrip("/")) if path and path.count("/") == 1 else None
+
+def write_results_response(items, results) -> func.HttpResponse:
+    for item in items:
+        for operation in ('Put', 'Delete'):
+            if operation in item:
+                invalidate_catalog_cache(item[operation]['TableName'])
+
+    indexed = sorted(entry for group_results in results for entry in group_results)
+    responses = [response for _, response in indexed]
     return func.HttpResponse(
         body=json.dumps(responses),
         status_code=200,
         mimetype="application/json"
     )
 
+def execute_write_group(container, partition_key, entries):
+    if partition_key is None:
+        return [execute_write_item(container, entry) for entry in entries]
+    results = []
+    # Cosmos DB caps a transactional batch at 100 operations, larger groups are committed in chunks
+    for start in range(0, len(entries), COSMOS_BATCH_LIMIT):
+        chunk = entries[start:start + COSMOS_BATCH_LIMIT]
+        try:
+            cosmos_call(
+                container,
+                "execute_item_batch",
+                batch_operations=[batch_operation for _, (_, _, batch_operation) in chunk],
+                partition_key=partition_key,
+            )
+            results.extend(
+                (index, {"operation": operation, "status": "Success", "item_id": item_id})
+                for index, (operation, item_id, _) in chunk
+            )
+        except (exceptions.CosmosBatchOperationError, exceptions.CosmosHttpResponseError) as e:
+            results.extend((index, {"error": str(e)}) for index, _ in chunk)
+    return results
+
+def execute_write_item(container, entry):
+    # The SDK takes the partition key from the document itself
+    index, (operation, item_id, (_, (put_item,))) = entry
+    try:
+        cosmos_call(container, "upsert_item", body=put_item)
+        return index, {"operation": operation, "status": "Success", "item_id": item_id}
+    except exceptions.CosmosHttpResponseError as e:
+        return index, {"error": str(e)}
+
+
+@api_event("read_logs", required=("job_id",))
+def read_logs(request: ApiRequest) -> func.HttpResponse:
+    payload = request.data
+    job_id = payload['job_id']
+    if not JOB_ID_PATTERN.match(job_id):
+        return func.HttpResponse("Invalid job_id.", status_code=400)
 
-def read_logs(req: func.HttpRequest) -> func.HttpResponse:
-    from azure.monitor.query import LogsQueryClient
     try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
-    
-    payload = req_body.get('data', {})
-    job_id = payload.get('job_id')
-    if not job_id:
-        return func.HttpResponse("Missing job_id.", status_code=400)
+        cursor = decode_log_cursor(payload.get('cursor'))
+        since = parse_timestamp(payload['since']) if payload.get('since') else None
+        limit = read_logs_limit(payload.get('limit'))
+    except (ValueError, KeyError, TypeError):
+        return func.HttpResponse("Invalid cursor, since or limit.", status_code=400)
+
+    if LOG_ARCHIVE_CONTAINER and not (cursor and "t" in cursor):
+        try:
+            archive = get_log_archive(job_id)
+            if archive and archive.get("partial") != "true":
+                return archived_logs_response(job_id, archive, cursor, since, limit)
+        except Exception as e:
+            logging.warning(f"Could not read log archive for {job_id}, querying Log Analytics: {e}")
+    if cursor and "t" not in cursor:
+        cursor = None
 
     log_analytics_workspace_id = os.getenv("LOG_ANALYTICS_WORKSPACE_ID")
 
     try:
-        credential = DefaultAzureCredential()
-        client = LogsQueryClient(credential)
-        
+        client = get_logs_client()
+
+        # Tail by ingestion time rather than TimeGenerated so rows that arrive late are not skipped
+        filters = ""
+        if cursor:
+            filters += f"\n        | where Ingested >= datetime({kql_datetime(parse_timestamp(cursor['t']))})"
+        if since:
+            filters += f"\n        | where TimeGenerated > datetime({kql_datetime(since)})"
+        take = f"\n        | take {limit + cursor['n']}" if cursor and limit else (f"\n        | take {limit}" if limit else "")
         query = f"""
         ContainerInstanceLog_CL
         | where ContainerGroup_s == "{job_id}"
-        | order by TimeGenerated asc
+        | extend Ingested = ingestion_time(){filters}
+        | project TimeGenerated, Message, Ingested
+        | order by Ingested asc, TimeGenerated asc, Message asc{take}
         """
 
-        timespan = timedelta(days=365)
-        response = client.query_workspace(log_analytics_workspace_id, query, timespan=timespan)
+        job_start = cursor["s"] if cursor and cursor.get("s") else job_start_time(job_id)
+        if job_start:
+            # Rows can not be older than the job itself, allow for some clock skew
+            timespan = (parse_timestamp(job_start) - timedelta(minutes=5), datetime.now(timezone.utc))
+        else:
+            timespan = timedelta(days=365)
+        with dependency_span("logs"):
+            response = client.query_workspace(log_analytics_workspace_id, query, timespan=timespan)
 
         def json_serial(obj):
             if isinstance(obj, (datetime, date)):
                 return obj.isoformat()
             raise TypeError(f"Type {obj.__class__.__name__} not serializable")
 
-    
-        events = []
+        rows = []
         if response.tables:
             for table in response.tables:
-                events.extend([{"message": row["Message"]} for row in table.rows])
+                rows.extend(table.rows)
+        if cursor:
+            # The first rows at the cursor timestamp were already returned by the previous call
+            already_seen = cursor["n"]
+            while rows and already_seen and ingested_at(rows[0]) == cursor["t"]:
+                rows.pop(0)
+                already_seen -= 1
+        events = [{"message": row["Message"]} for row in rows]
 
     except Exception as e:
         return func.HttpResponse(f"Error querying logs: {e}", status_code=500)
     
     return func.HttpResponse(
-        body=json.dumps({"events": events}, default=json_serial),
+        body=json.dumps({"events": events, "cursor": next_log_cursor(cursor, rows, job_start)}, default=json_serial),
         status_code=200,
         mimetype="application/json"
     )
 
-def generate_presigned_url(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
-    
-    from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9-]+$")
+READ_LOGS_MAX_LIMIT = int(os.getenv("READ_LOGS_MAX_LIMIT", "10000"))
 
+job_start_times = OrderedDict()
 
-    req_body = req.get_json()
-    payload = req_body.get('data')
-    bucket_name = payload.get("bucket_name")
-    container_name = buckets[bucket_name]
-    blob_name = payload.get("key")
-    if container_name.startswith("workload-"):
-        account_name = os.getenv("STORAGE_ACCOUNT_NAME")
-        principal = os.getenv("AZURE_SUBSCRIPTION_ID")
-        resp = get_work_token(principal)
-        try:
-            tokens = resp.json()
-        except Exception as e:
-            return func.HttpResponse(resp.text, status_code=resp.status_code)
+def parse_timestamp(value):
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
 
-        container_sas = tokens[container_name]
-        blob_url = (
-            f"https://{account_name}.blob.core.windows.net/"
-            f"{container_name}/{blob_name}?{container_sas}"
-        )
-        return func.HttpResponse(
-            json.dumps({"url": blob_url}),
-            status_code=200,
-            mimetype="application/json"
-        )
+def kql_datetime(value):
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
-    account_name = os.getenv("PUBLIC_STORAGE_ACCOUNT_NAME")
+def ingested_at(row):
+    ingested = row["Ingested"]
+    return ingested.isoformat() if isinstance(ingested, datetime) else ingested
+
+def job_start_time(job_id):
+    if job_id in job_start_times:
+        return job_start_times[job_id]
+    try:
+        cg = get_aci_client(os.getenv("AZURE_SUBSCRIPTION_ID")).container_groups.get(os.getenv("RESOURCE_GROUP_NAME"), job_id)
+    except Exception as e:
+        logging.info(f"Could not read container group {job_id}, querying full log retention: {e}")
+        return None
+    timestamps = []
+    for container in cg.containers or []:
+        instance_view = container.instance_view
+        if not instance_view:
+            continue
+        timestamps.extend(event.first_timestamp for event in instance_view.events or [] if event.first_timestamp)
+        if instance_view.current_state and instance_view.current_state.start_time:
+            timestamps.append(instance_view.current_state.start_time)
+    if not timestamps:
+        return None
+    start = min(timestamps).isoformat()
+    job_start_times[job_id] = start
+    while len(job_start_times) > 1024:
+        job_start_times.popitem(last=False)
+    return start
+
+def next_log_cursor(cursor, rows, job_start):
+    if not rows:
+        return encode_log_cursor(cursor) if cursor else None
+    last = ingested_at(rows[-1])
+    seen = sum(1 for row in rows if ingested_at(row) == last)
+    if cursor and cursor["t"] == last:
+        seen += cursor["n"]
+    return encode_log_cursor({"t": last, "n": seen, "s": job_start})
+
+def read_logs_limit(value):
+    if value is None:
+        return None
+    limit = int(value)
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    return min(limit, READ_LOGS_MAX_LIMIT)
+
+def encode_log_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii")
+
+def decode_log_cursor(token):
+    if not token:
+        return None
+    cursor = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    if not isinstance(cursor, dict):
+        raise ValueError("cursor must be an object")
+    if "o" in cursor:
+        # Row offset into a log archive
+        offset = int(cursor["o"])
+        if offset < 0:
+            raise ValueError("cursor offset must not be negative")
+        return {"o": offset}
+    seen = int(cursor["n"])
+    if seen < 0:
+        raise ValueError("cursor row count must not be negative")
+    if not isinstance(cursor["t"], str) or not isinstance(cursor.get("s") or "", str):
+        raise ValueError("cursor timestamps must be strings")
+    parse_timestamp(cursor["t"])
+    if cursor.get("s"):
+        parse_timestamp(cursor["s"])
+    return {"t": cursor["t"], "n": seen, "s": cursor.get("s")}
+
+@api_event("generate_presigned_url", required=("bucket_name", "key"))
+def generate_presigned_url(request: ApiRequest) -> func.HttpResponse:
+    payload = request.data
+    try:
+        blob_url = presign_blob_url(payload.get("bucket_name"), payload.get("key"), payload.get("expires_in", 3600))
+    except BrokerTokenError as e:
+        return func.HttpResponse(str(e), status_code=e.status_code)
+    except ValueError as e:
+        return func.HttpResponse(str(e), status_code=400)
+
+    return func.HttpResponse(
+        json.dumps({"url": blob_url}),
+        status_code=200,
+        mimetype="application/json"
+    )
 
-    expires_in = payload.get("expires_in", 3600)
+@api_event("generate_presigned_urls", required=("objects",))
+def generate_presigned_urls(request: ApiRequest) -> func.HttpResponse:
+    payload = request.data
+    objects = payload['objects']
+    if not isinstance(objects, list) or not all(isinstance(obj, dict) for obj in objects):
+        return func.HttpResponse("Expected a list of {bucket_name, key} objects in data.objects.", status_code=400)
 
+    urls = []
+    for index, obj in enumerate(objects):
+        try:
+            url = presign_blob_url(obj.get("bucket_name"), obj.get("key"), obj.get("expires_in", payload.get("expires_in", 3600)))
+            urls.append({"index": index, "bucket_name": obj.get("bucket_name"), "key": obj.get("key"), "url": url})
+        except (BrokerTokenError, ValueError) as e:
+            urls.append({"index": index, "error": str(e)})
+    return func.HttpResponse(json.dumps({"urls": urls}), status_code=200, mimetype="application/json")
+
+# One user delegation key can sign SAS URLs for up to 7 days, so it is fetched once per account and
+# signing becomes a local HMAC. A key is replaced shortly before it expires or when a SAS would
+# outlive it.
+DELEGATION_KEY_LIFETIME = int(os.getenv("DELEGATION_KEY_LIFETIME", str(6 * 24 * 3600)))
+DELEGATION_KEY_REFRESH_MARGIN = int(os.getenv("DELEGATION_KEY_REFRESH_MARGIN", "3600"))
+DELEGATION_KEY_MAX_LIFETIME = 7 * 24 * 3600
+
+delegation_key_cache = {}
+delegation_key_lock = threading.Lock()
+
+def get_user_delegation_key(account_name, valid_until):
+    entry, window = cached_user_delegation_key(account_name, valid_until)
+    if entry is None:
+        with dependency_span("blob"):
+            key = get_blob_service_client(account_name).get_user_delegation_key(
+                key_start_time=window[0],
+                key_expiry_time=window[1]
+            )
+        entry = store_user_delegation_key(account_name, key, window[1])
+    return entry
+
+def cached_user_delegation_key(account_name, valid_until):
+    # Returns the cached entry, or the (start, expiry) window of the key to request instead
+    now = datetime.utcnow()
+    valid_until = min(valid_until, now + timedelta(seconds=DELEGATION_KEY_MAX_LIFETIME - DELEGATION_KEY_REFRESH_MARGIN))
+    with delegation_key_lock:
+        entry = delegation_key_cache.get(account_name)
+    if (entry is None
+            or entry["expires_at"] - timedelta(seconds=DELEGATION_KEY_REFRESH_MARGIN) < now
+            or entry["expires_at"] < valid_until):
+        lifetime = max(DELEGATION_KEY_LIFETIME, int((valid_until - now).total_seconds()) + DELEGATION_KEY_REFRESH_MARGIN)
+        return None, (now - timedelta(minutes=1), now + timedelta(seconds=min(DELEGATION_KEY_MAX_LIFETIME, lifetime)))
+    return entry, None
+
+def store_user_delegation_key(account_name, key, expires_at):
+    entry = {"key": key, "expires_at": expires_at}
+    with delegation_key_lock:
+        delegation_key_cache[account_name] = entry
+    return entry
+
+def presign_blob_url(bucket_name, blob_name, expires_in=3600):
+    container_name = presign_container(bucket_name, blob_name)
+    if container_name.startswith("workload-"):
+        principal = os.getenv("AZURE_SUBSCRIPTION_ID")
+        return workload_blob_url(container_name, blob_name, get_work_token(principal))
 
-    sas_expiry = datetime.utcnow() + timedelta(seconds=expires_in)
+    account_name = os.getenv("PUBLIC_STORAGE_ACCOUNT_NAME")
+    sas_expiry = datetime.utcnow() + timedelta(seconds=int(expires_in))
+    return sign_blob_url(account_name, container_name, blob_name, sas_expiry, get_user_delegation_key(account_name, sas_expiry))
 
+def presign_container(bucket_name, blob_name):
+    if bucket_name not in buckets:
+        raise ValueError(f"Unknown bucket_name '{bucket_name}'")
+    if not blob_name:
+        raise ValueError("key is required")
+    return buckets[bucket_name]
 
-    blob_service_client = BlobServiceClient(
-        account_url=f"https://{account_name}.blob.core.windows.net",
-        credential=DefaultAzureCredential()
-    )
+def workload_blob_url(container_name, blob_name, tokens):
+    account_name = os.getenv("STORAGE_ACCOUNT_NAME")
+    return f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{tokens[container_name]}"
 
-    user_delegation_key = blob_service_client.get_user_delegation_key(
-        key_start_time=datetime.utcnow() - timedelta(minutes=1),
-        key_expiry_time=sas_expiry
-    )
+def sign_blob_url(account_name, container_name, blob_name, sas_expiry, entry):
+    from azure.storage.blob import generate_blob_sas, BlobSasPermissions
 
+    # A SAS cannot outlive the key that signed it
+    sas_expiry = min(sas_expiry, entry["expires_at"])
     sas_token = generate_blob_sas(
         account_name=account_name,
         container_name=container_name,
         blob_name=blob_name,
         permission=BlobSasPermissions(read=True),
         expiry=sas_expiry,
-        user_delegation_key=user_delegation_key,
+        user_delegation_key=entry["key"],
     )
+    return f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}"
 
-    blob_url = f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}"
-
-    return func.HttpResponse(
-        json.dumps({"url": blob_url}),
-        status_code=200,
-        mimetype="application/json"
-    )
-
-def start_runner(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
-
+@api_event("start_runner")
+def start_runner(request: ApiRequest) -> func.HttpResponse:
     subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
     resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
-    image = os.getenv("IMAGE")
-    region_short = os.getenv("REGION_SHORT")
+
+    payload = request.data
+    container_group_name = new_container_group_name()
+
+    if RUNNER_DISPATCH_MODE == "queue":
+        try:
+            enqueue_runner_job(container_group_name, payload)
+        except Exception as e:
+            logging.error(f"Error queueing ACI task: {e}")
+            return func.HttpResponse(json.dumps({"status": f"Error queueing ACI task {e}"}), status_code=500)
+        return func.HttpResponse(json.dumps({"status": "queued", "job_id": container_group_name}), status_code=200)
 
     try:
-        # needs to be cleaned up, exmaple: (max 100 containers regardless of state (running, stopped, etc.))
-        delete_finished_container_groups(subscription_id, resource_group_name)
+        # ACI allows max 100 container groups regardless of state (running, stopped, etc.), the bulk
+        # of the cleanup runs on a timer so only reclaim what is needed for this launch here
+        free_slots = ensure_runner_capacity(subscription_id, resource_group_name, needed=1)
+        if free_slots < 1:
+            return func.HttpResponse(json.dumps({"status": "No runner capacity available, try again later"}), status_code=503)
     except Exception as e:
-        print(f"Error deleting finished container groups: {e}. Continuing...")
+        print(f"Error checking runner capacity: {e}. Continuing...")
         pass
 
     try:
-        credential = DefaultAzureCredential()
-        client = ContainerInstanceManagementClient(credential, subscription_id)
+        client = get_aci_client(subscription_id)
     except Exception as e:
         return func.HttpResponse(f"Error initializing ACI client: {e}", status_code=500)
 
     logging.info('Python HTTP trigger function processed a request.')
 
-    container_group_name = f"infraweave-runner-job-{subscription_id[:8]}-{region_short}-{str(uuid.uuid4())[:8]}"
+    try:
+        launch_runner(client, container_group_name, payload)
+        logging.info("ACI task started successfully.")
+        return func.HttpResponse(json.dumps({"status": f"ACI task started successfully.", "job_id": container_group_name}), status_code=200)
 
-    payload = req_body.get('data')
-    cpu = payload.get('cpu')
-    memory = payload.get('memory')
+    except Exception as e:
+        logging.error(f"Error starting ACI task: {e}")
+        return func.HttpResponse(json.dumps({"status": f"Error starting ACI task {e}"}), status_code=500)
 
+def new_container_group_name():
+    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+    region_short = os.getenv("REGION_SHORT")
+    return f"infraweave-runner-job-{subscription_id[:8]}-{region_short}-{str(uuid.uuid4())[:8]}"
+
+# The parts of the container group that are the same for every job are built once per process.
+# With RUNNER_PAYLOAD_OFFLOAD, payloads above RUNNER_PAYLOAD_INLINE_MAX_BYTES are written to the
+# change records container instead (at enqueue in queue mode) and the runner gets a read-only URL
+# in PAYLOAD_URL, signed at launch and valid for RUNNER_PAYLOAD_URL_TTL seconds so it covers a slow
+# container start. Only runner images that read PAYLOAD_URL can use it, so it is off by default.
+# The default threshold stays below the 128 KiB a single environment variable may hold on Linux.
+# The group is tagged so the cleanup removes the blob.
+RUNNER_PAYLOAD_OFFLOAD = os.getenv("RUNNER_PAYLOAD_OFFLOAD", "false").lower() == "true"
+RUNNER_PAYLOAD_INLINE_MAX_BYTES = int(os.getenv("RUNNER_PAYLOAD_INLINE_MAX_BYTES", str(120 * 1024)))
+RUNNER_PAYLOAD_URL_TTL = int(os.getenv("RUNNER_PAYLOAD_URL_TTL", str(6 * 3600)))
+RUNNER_PAYLOAD_BUCKET = "change_records"
+RUNNER_PAYLOAD_PREFIX = "runner-payloads"
+RUNNER_PAYLOAD_TAG = "payload"
+
+_runner_template = None
+runner_template_lock = threading.Lock()
+
+def runner_template():
+    global _runner_template
+    with runner_template_lock:
+        if _runner_template is None:
+            _runner_template = build_runner_template()
+        return _runner_template
+
+def build_runner_template():
+    from azure.mgmt.containerinstance.models import (
+        ContainerGroupIdentity,
+        ResourceIdentityType,
+        ContainerGroupSubnetId,
+        ContainerGroupDiagnostics,
+        LogAnalytics,
+    )
     log_analytics_workspace_id = os.getenv("LOG_ANALYTICS_WORKSPACE_ID")
     log_analytics_workspace_key = os.getenv("LOG_ANALYTICS_WORKSPACE_KEY")
 
@@ -305,225 +627,670 @@ def start_runner(req: func.HttpRequest) -> func.HttpResponse:
         )
     )
 
-    try:
-        container_resource_requirements = ResourceRequirements(
-            requests=ResourceRequests(
-                memory_in_gb=memory,
-                cpu=cpu,
+    environment_variables = [
+        {
+            "name": "REGION", 
+            "value": os.getenv("REGION")
+        },
+        {
+            "name": "AZURE_SUBSCRIPTION_ID",
+            "value": os.getenv("AZURE_SUBSCRIPTION_ID")
+        },
+        {
+            "name": "INFRAWEAVE_ENV",
+            "value": os.getenv("INFRAWEAVE_ENV")
+        },
+        {
+            "name": "PROVIDER",
+            "value": "azure"
+        },
+        {
+            "name": "AZURE_CONTAINER_INSTANCE",
+            "value": "true"
+        },
+        {
+            "name": "ACCOUNT_ID", # to be renamed to PROJECT_ID
+            "value": os.getenv("AZURE_SUBSCRIPTION_ID")
+        },
+        {
+            "name": "TF_BUCKET",
+            "value": os.getenv("TF_STATE_CONTAINER")
+        },
+        {
+            "name": "STORAGE_ACCOUNT",
+            "value": os.getenv("STORAGE_ACCOUNT_NAME")
+        },
+        {
+            "name": "RESOURCE_GROUP_NAME",
+            "value": os.getenv("RESOURCE_GROUP_NAME")
+        },
+        { "name": "ARM_USE_MSI",       "value": "true" },
+        { "name": "ARM_USE_AZUREAD",   "value": "true" },
+        { "name": "ARM_CLIENT_ID",     "value": os.getenv("TF_AZURE_CLIENT_ID") },
+        { "name": "ARM_TENANT_ID",     "value": os.getenv("TF_AZURE_TENANT_ID") },
+        { "name": "ARM_SUBSCRIPTION_ID", "value": os.getenv("AZURE_SUBSCRIPTION_ID") },
+    ]
+
+    return {
+        "image": os.getenv("IMAGE"),
+        "location": os.getenv("LOCATION"),
+        "diagnostics": diagnostics,
+        "environment_variables": environment_variables,
+        "identity": ContainerGroupIdentity(
+            type=ResourceIdentityType.user_assigned,
+            user_assigned_identities={
+                os.getenv("USER_ASSIGNED_IDENTITY_RESOURCE_ID"): {}
+            }
+        ),
+        "subnet_ids": [
+            ContainerGroupSubnetId(
+                id=os.getenv("ACI_SUBNET_ID")
             )
-        )
-        container = Container(
-            name="runner",
-            image=image,
-            resources=container_resource_requirements,
-            ports=[],
-            environment_variables=[
-                {
-                    "name": "PAYLOAD",
-                    "value": json.dumps(payload)
-                },
-                {
-                    "name": "REGION", 
-                    "value": os.getenv("REGION")
-                },
-                {
-                    "name": "AZURE_SUBSCRIPTION_ID",
-                    "value": os.getenv("AZURE_SUBSCRIPTION_ID")
-                },
-                {
-                    "name": "INFRAWEAVE_ENV",
-                    "value": os.getenv("INFRAWEAVE_ENV")
-                },
-                {
-                    "name": "PROVIDER",
-                    "value": "azure"
-                },
-                {
-                    "name": "AZURE_CONTAINER_INSTANCE",
-                    "value": "true"
-                },
-                {
-                    "name": "ACCOUNT_ID", # to be renamed to PROJECT_ID
-                    "value": os.getenv("AZURE_SUBSCRIPTION_ID")
-                },
-                {
-                    "name": "TF_BUCKET",
-                    "value": os.getenv("TF_STATE_CONTAINER")
-                },
-                {
-                    "name": "STORAGE_ACCOUNT",
-                    "value": os.getenv("STORAGE_ACCOUNT_NAME")
-                },
-                {
-                    "name": "RESOURCE_GROUP_NAME",
-                    "value": os.getenv("RESOURCE_GROUP_NAME")
-                },
-                {
-                    "name": "CONTAINER_GROUP_NAME",
-                    "value": container_group_name
-                },
-                { "name": "ARM_USE_MSI",       "value": "true" },
-                { "name": "ARM_USE_AZUREAD",   "value": "true" },
-                { "name": "ARM_CLIENT_ID",     "value": os.getenv("TF_AZURE_CLIENT_ID") },
-                { "name": "ARM_TENANT_ID",     "value": os.getenv("TF_AZURE_TENANT_ID") },
-                { "name": "ARM_SUBSCRIPTION_ID", "value": os.getenv("AZURE_SUBSCRIPTION_ID") },
-            ]
-        )
+        ],
+    }
 
-        container_group = ContainerGroup(
-            location=os.getenv("LOCATION"),
-            containers=[container],
-            os_type=OperatingSystemTypes.Linux,
-            restart_policy="Never",
-            identity=ContainerGroupIdentity(
-                type=ResourceIdentityType.user_assigned,
-                user_assigned_identities={
-                    os.getenv("USER_ASSIGNED_IDENTITY_RESOURCE_ID"): {}
-                }
-            ),
-            subnet_ids=[
-                ContainerGroupSubnetId(
-                    id=os.getenv("ACI_SUBNET_ID")
-                )
-            ],
-            diagnostics=diagnostics,
+def build_container_group(template, container_group_name, payload, payload_variable):
+    from azure.mgmt.containerinstance.models import (
+        ContainerGroup,
+        Container,
+        ResourceRequests,
+        ResourceRequirements,
+        OperatingSystemTypes,
+    )
+    container_resource_requirements = ResourceRequirements(
+        requests=ResourceRequests(
+            memory_in_gb=payload.get('memory'),
+            cpu=payload.get('cpu'),
         )
+    )
+    container = Container(
+        name="runner",
+        image=template["image"],
+        resources=container_resource_requirements,
+        ports=[],
+        environment_variables=[
+            payload_variable,
+            {
+                "name": "CONTAINER_GROUP_NAME",
+                "value": container_group_name
+            },
+            *template["environment_variables"],
+        ]
+    )
+
+    return ContainerGroup(
+        location=template["location"],
+        containers=[container],
+        os_type=OperatingSystemTypes.Linux,
+        restart_policy="Never",
+        identity=template["identity"],
+        subnet_ids=template["subnet_ids"],
+        diagnostics=template["diagnostics"],
+        tags={RUNNER_PAYLOAD_TAG: "blob"} if payload_variable["name"] == "PAYLOAD_URL" else None,
+    )
+
+def runner_payload_blob(container_group_name):
+    account_name = os.getenv("STORAGE_ACCOUNT_NAME")
+    return get_blob_service_client(account_name).get_blob_client(
+        container=buckets[RUNNER_PAYLOAD_BUCKET],
+        blob=f"{RUNNER_PAYLOAD_PREFIX}/{container_group_name}.json",
+    )
 
-        client.container_groups.begin_create_or_update(
-            resource_group_name=resource_group_name,
-            container_group_name=container_group_name,
-            container_group=container_group
+def offload_runner_payload(body) -> bool:
+    return RUNNER_PAYLOAD_OFFLOAD and len(body) > RUNNER_PAYLOAD_INLINE_MAX_BYTES
+
+def runner_payload_variable(container_group_name, payload):
+    body = json.dumps(payload)
+    if not offload_runner_payload(body):
+        return {"name": "PAYLOAD", "value": body}
+    upload_runner_payload(container_group_name, body)
+    try:
+        return runner_payload_url_variable(container_group_name)
+    except Exception:
+        discard_runner_payload(container_group_name)
+        raise
+
+def upload_runner_payload(container_group_name, body):
+    from azure.storage.blob import ContentSettings
+    # Named after the job, so a retried enqueue overwrites its own payload
+    with dependency_span("blob"):
+        runner_payload_blob(container_group_name).upload_blob(
+            body.encode("utf-8"), overwrite=True, content_settings=ContentSettings(content_type="application/json")
         )
-        
-        logging.info("ACI task started successfully.")
-        return func.HttpResponse(json.dumps({"status": f"ACI task started successfully.", "job_id": container_group_name}), status_code=200)
+    record_usage(bytes_transferred=len(body))
+
+def runner_payload_url_variable(container_group_name):
+    # Signed at launch rather than with the broker SAS, which may expire minutes after the group is created
+    blob_client = runner_payload_blob(container_group_name)
+    account_name = os.getenv("STORAGE_ACCOUNT_NAME")
+    sas_expiry = datetime.utcnow() + timedelta(seconds=RUNNER_PAYLOAD_URL_TTL)
+    url = sign_blob_url(account_name, blob_client.container_name, blob_client.blob_name, sas_expiry, get_user_delegation_key(account_name, sas_expiry))
+    return {"name": "PAYLOAD_URL", "value": url}
 
+def delete_runner_payload(container_group_name):
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        with dependency_span("blob"):
+            runner_payload_blob(container_group_name).delete_blob()
+    except ResourceNotFoundError:
+        pass
+
+def discard_runner_payload(container_group_name):
+    # No container group will read the payload, a failed delete only leaves the blob behind
+    try:
+        delete_runner_payload(container_group_name)
     except Exception as e:
-        logging.error(f"Error starting ACI task: {e}")
-        return func.HttpResponse(json.dumps({"status": f"Error starting ACI task {e}"}), status_code=500)
+        logging.warning(f"Could not delete the payload of runner {container_group_name}: {e}")
+
+def launch_runner(client, container_group_name, payload, template=None, payload_variable=None):
+    # A payload_variable is passed for queued jobs whose payload was uploaded at enqueue, the blob
+    # is kept for the next attempt when the launch fails
+    resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
+    uploaded = payload_variable is None
+    if payload_variable is None:
+        payload_variable = runner_payload_variable(container_group_name, payload)
+    try:
+        container_group = build_container_group(template or runner_template(), container_group_name, payload, payload_variable)
+        with dependency_span("aci"):
+            client.container_groups.begin_create_or_update(
+                resource_group_name=resource_group_name,
+                container_group_name=container_group_name,
+                container_group=container_group
+            )
+    except Exception:
+        if uploaded and payload_variable["name"] == "PAYLOAD_URL":
+            discard_runner_payload(container_group_name)
+        raise
+    note_container_group(container_group_name, "Creating")
+
+def launch_runners(client, jobs, launch_job=launch_runner):
+    # jobs is a list of (container_group_name, payload), the returned errors line up with it (None on success)
+    template = runner_template()
+
+    def launch(job):
+        try:
+            launch_job(client, job[0], job[1], template)
+            return None
+        except Exception as e:
+            logging.error(f"Error starting ACI task {job[0]}: {e}")
+            return str(e)
+
+    if len(jobs) <= 1:
+        return [launch(job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=min(RUNNER_LAUNCH_CONCURRENCY, len(jobs))) as pool:
+        return list(pool.map(in_request_context(launch), jobs))
+
+@api_event("start_runners", data=list)
+def start_runners(request: ApiRequest) -> func.HttpResponse:
+    payloads = request.data
+    if not all(isinstance(payload, dict) for payload in payloads):
+        return func.HttpResponse("Expected a list of runner payloads in data.", status_code=400)
+
+    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+    resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
+    job_ids = [new_container_group_name() for _ in payloads]
+    jobs = []
+
+    if RUNNER_DISPATCH_MODE == "queue":
+        def enqueue(job):
+            try:
+                enqueue_runner_job(job[0], job[1], signal=False)
+                return None
+            except Exception as e:
+                logging.error(f"Error queueing ACI task {job[0]}: {e}")
+                return str(e)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(RUNNER_LAUNCH_CONCURRENCY, len(payloads)))) as pool:
+            errors = list(pool.map(in_request_context(enqueue), zip(job_ids, payloads)))
+        if any(error is None for error in errors):
+            signal_runner_dispatcher()
+        for index, (job_id, error) in enumerate(zip(job_ids, errors)):
+            jobs.append({"index": index, "job_id": job_id, "status": "queued"} if error is None else {"index": index, "error": error})
+        return func.HttpResponse(json.dumps({"jobs": jobs}), status_code=200, mimetype="application/json")
+
+    try:
+        free_slots = ensure_runner_capacity(subscription_id, resource_group_name, needed=len(payloads))
+    except Exception as e:
+        logging.warning(f"Error checking runner capacity: {e}. Continuing...")
+        free_slots = len(payloads)
+
+    client = get_aci_client(subscription_id)
+    launchable = max(0, min(free_slots, len(payloads)))
+    errors = launch_runners(client, list(zip(job_ids, payloads))[:launchable])
+    errors += ["No runner capacity available, try again later"] * (len(payloads) - launchable)
+    for index, (job_id, error) in enumerate(zip(job_ids, errors)):
+        jobs.append({"index": index, "job_id": job_id, "status": "started"} if error is None else {"index": index, "error": error})
+    return func.HttpResponse(json.dumps({"jobs": jobs}), status_code=200, mimetype="application/json")
 
 def get_id(body):
     raw = f"{body['PK']}~{body['SK']}".lower()
     safe = re.sub(r'[^0-9a-z]', '_', raw)
     return safe
 
-def insert_db(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
-
-    table_key = req_body.get('table')
+@api_event("insert_db", body={"table": str}, data=(dict, list))
+def insert_db(request: ApiRequest) -> func.HttpResponse:
+    table_key = request.body['table']
     container_name = tables[table_key]
-    item = req_body.get('data', {})
+    if isinstance(request.data, list):
+        return insert_db_bulk(request, table_key, container_name)
+    item = request.data
     item.update({'id': get_id(item)})
 
     principal = os.getenv("AZURE_SUBSCRIPTION_ID")
     if not principal:
         return func.HttpResponse("Missing AZURE_SUBSCRIPTION_ID", status_code=500)
 
-    resp = get_work_token(principal)
     try:
-        tokens = resp.json()
-    except Exception as e:
-        return func.HttpResponse(resp.text, status_code=resp.status_code)
+        tokens = get_work_token(principal)
+    except BrokerTokenError as e:
+        return func.HttpResponse(str(e), status_code=e.status_code)
 
-    db_link   = f"dbs/{COSMOS_DB_DATABASE}"
-    coll_link = f"{db_link}/colls/{container_name}"
-    credential = { coll_link: tokens[container_name] }
     pk_arg = {}
 
-    client = CosmosClient(COSMOS_DB_ENDPOINT, credential=credential)
-    database = client.get_database_client(COSMOS_DB_DATABASE)
-    container = database.get_container_client(container_name)
+    container = get_cosmos_container(container_name, tokens[container_name])
 
     try:
-        response = container.upsert_item(body=item, **pk_arg)
+        response = cosmos_call(container, "upsert_item", body=item, **pk_arg)
         logging.info("Insert/upsert succeeded:")
         logging.info(response)
         return func.HttpResponse(json.dumps(response), status_code=200)
     except exceptions.CosmosHttpResponseError as e:
         logging.error("Error inserting item:", exc_info=e)
         return func.HttpResponse(f'Error inserting item: {e}', status_code=500)
+    finally:
+        invalidate_catalog_cache(table_key)
+
 
+# Bulk inserts group items by partition key value. Groups are written as transactional batches and
+# single items as plain upserts, with at most INSERT_DB_MAX_WORKERS requests in flight. A batch
+# that fails as a whole is retried item by item so every item gets its own status.
+INSERT_DB_MAX_ITEMS = int(os.getenv("INSERT_DB_MAX_ITEMS", "1000"))
+INSERT_DB_MAX_WORKERS = int(os.getenv("INSERT_DB_MAX_WORKERS", "8"))
+
+def insert_db_bulk(request: ApiRequest, table_key, container_name) -> func.HttpResponse:
+    items = request.data
+    if not all(isinstance(item, dict) and 'PK' in item and 'SK' in item for item in items):
+        return func.HttpResponse("Every item needs PK and SK.", status_code=400)
+    if len(items) > INSERT_DB_MAX_ITEMS:
+        return func.HttpResponse(f"At most {INSERT_DB_MAX_ITEMS} items per call.", status_code=400)
+
+    principal = os.getenv("AZURE_SUBSCRIPTION_ID")
+    if not principal:
+        return func.HttpResponse("Missing AZURE_SUBSCRIPTION_ID", status_code=500)
+    try:
+        tokens = get_work_token(principal)
+    except BrokerTokenError as e:
+        return func.HttpResponse(str(e), status_code=e.status_code)
+    container = get_cosmos_container(container_name, tokens[container_name])
+
+    for item in items:
+        item.update({'id': get_id(item)})
+    path = container_partition_key_path(container_name, container)
+    groups = {}
+    for index, item in enumerate(items):
+        value = partition_key_value(path, item)
+        # Items whose partition key cannot be derived are written one by one
+        groups.setdefault(value if value is not None else ("single", index), []).append((index, item))
+
+    jobs = []
+    for key, entries in groups.items():
+        if isinstance(key, tuple) or len(entries) == 1:
+            jobs.extend([entry] for entry in entries)
+        else:
+            jobs.extend(entries[start:start + COSMOS_BATCH_LIMIT] for start in range(0, len(entries), COSMOS_BATCH_LIMIT))
+
+    def write(chunk):
+        if len(chunk) > 1:
+            try:
+                batch = cosmos_call(
+                    container,
+                    "execute_item_batch",
+                    batch_operations=[("upsert", (item,)) for _, item in chunk],
+                    partition_key=chunk[0][1][path.lstrip("/")],
+                )
+                return [
+                    (index, {"status": "Success", "item_id": item["id"], "request_charge": float(result.get("requestCharge", 0))})
+                    for (index, item), result in zip(chunk, batch)
+                ]
+            except (exceptions.CosmosBatchOperationError, exceptions.CosmosHttpResponseError) as e:
+                logging.warning(f"Batch of {len(chunk)} items failed, retrying individually: {e}")
+        return [upsert_one(container, index, item) for index, item in chunk]
 
-def read_db(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
+        with ThreadPoolExecutor(max_workers=max(1, min(INSERT_DB_MAX_WORKERS, len(jobs)))) as pool:
+            results = sorted(entry for chunk_results in pool.map(in_request_context(write), jobs) for entry in chunk_results)
+    finally:
+        invalidate_catalog_cache(table_key)
 
-    container_name = req_body.get('table')
-    container_name = tables[container_name]
-    query = req_body.get('data').get('query')
-    table_key    = req_body["table"]
+    responses = [{"index": index, **response} for index, response in results]
+    return func.HttpResponse(
+        json.dumps({
+            "items": responses,
+            "request_charge": round(sum(response.get("request_charge", 0) for response in responses), 2),
+            "failed": sum(1 for response in responses if "error" in response),
+        }),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+def upsert_one(container, index, item):
+    charge = {}
+    try:
+        cosmos_call(container, "upsert_item", body=item, response_hook=lambda headers, _: charge.update(headers))
+        return index, {"status": "Success", "item_id": item["id"], "request_charge": float(charge.get("x-ms-request-charge", 0))}
+    except exceptions.CosmosHttpResponseError as e:
+        return index, {"item_id": item["id"], "error": str(e)}
+
+def container_partition_key_path(container_name, container):
+    path = partition_key_paths.get(container_name)
+    if path is None:
+        try:
+            path = container.read()["partitionKey"]["paths"][0]
+        except exceptions.CosmosHttpResponseError as e:
+            logging.warning(f"Could not read partition key of {container_name}: {e}")
+            return None
+        partition_key_paths[container_name] = path
+    return path
+
+@api_event("read_db", body={"table": str}, required=("query",))
+def read_db(request: ApiRequest) -> func.HttpResponse:
+    query = request.data['query']
+    return query_db(request, query, match_point_read(query))
+
+@api_event("get_item", body={"table": str}, required=("PK", "SK"))
+def get_item(request: ApiRequest) -> func.HttpResponse:
+    data = request.data
+    # Used if the partition key of the table cannot be derived from PK/SK
+    query = {
+        "query": "SELECT * FROM c WHERE c.PK = @pk AND c.SK = @sk",
+        "parameters": [{"name": "@pk", "value": data['PK']}, {"name": "@sk", "value": data['SK']}],
+    }
+    return query_db(request, query, (data['PK'], data['SK']))
+
+def query_db(request: ApiRequest, query, point_key=None) -> func.HttpResponse:
+    table_key = request.body['table']
+    container_name = tables[table_key]
+    data = request.data
     principal = os.getenv("AZURE_SUBSCRIPTION_ID")
     if not principal:
         return func.HttpResponse("Missing AZURE_SUBSCRIPTION_ID", status_code=500)
 
-    if table_key in ["modules", "policies", "config"]:
-        credential = DefaultAzureCredential()
+    try:
+        paginated, page_size, continuation_token = read_db_paging(data)
+    except ValueError:
+        return func.HttpResponse("Invalid page_size or continuation_token.", status_code=400)
+
+    cache_key = None
+    if table_key in CATALOG_TABLES and not paginated and CATALOG_CACHE_TTL > 0:
+        cache_key = (table_key, normalise_query(query))
+        cached = catalog_cache_get(cache_key)
+        if cached:
+            return catalog_cache_response(request, cached, "HIT")
+
+    if table_key in CATALOG_TABLES:
+        container = get_cosmos_container(container_name)
         cross_partition = True
         pk_arg = {}
     else:
-        resp = get_work_token(principal)
         try:
-            tokens = resp.json()
-        except Exception as e:
-            return func.HttpResponse(resp.text, status_code=resp.status_code)
-        db_link   = f"dbs/{COSMOS_DB_DATABASE}"
-        coll_link = f"{db_link}/colls/{container_name}"
-        credential = {
-            coll_link: tokens[container_name]
-        }
+            tokens = get_work_token(principal)
+        except BrokerTokenError as e:
+            return func.HttpResponse(str(e), status_code=e.status_code)
+        container = get_cosmos_container(container_name, tokens[container_name])
         cross_partition = False
         pk_arg = {"partition_key": principal}
-    client = CosmosClient(COSMOS_DB_ENDPOINT, credential=credential)
 
-    q_kwargs = {
-        "query": query,
-        **({"enable_cross_partition_query": True} if cross_partition else {}),
-        **pk_arg
-    }
-
-    database = client.get_database_client(COSMOS_DB_DATABASE)
-    container = database.get_container_client(container_name)
+    q_kwargs = query_kwargs(query, page_size, pk_arg.get("partition_key"), cross_partition)
 
     try:
-        items = list(container.query_items(**q_kwargs))
-        logging.info(f"Read operation succeeded, found {len(items)} items.")
-        logging.info("response:")
-        logging.info(items)
-        return func.HttpResponse(json.dumps(items), status_code=200)
+        partition_key = pk_arg.get("partition_key")
+        if point_key and not continuation_token and partition_key is None:
+            partition_key = point_read_partition_key(container_name, container, point_key)
+        if point_key and not continuation_token and partition_key is not None:
+            items = point_read(container, point_key, partition_key)
+            return point_read_response(request, items, paginated, cache_key)
+
+        pages = CosmosPages(container, q_kwargs, continuation_token)
+        if paginated:
+            return query_page_response(next(pages, []), pages.continuation_token)
+        body, count = encode_json_pages(pages)
+        return query_items_response(request, body, count, cache_key)
     except exceptions.CosmosHttpResponseError as e:
-        print(f'Error querying items: {e}')
-        logging.error("response error:")
-        logging.error(e)
-        return func.HttpResponse(json.dumps({"message": f"error querying: {e}"}), status_code=500)
+        return query_error_response(e)
+
+def query_kwargs(query, page_size, partition_key=None, cross_partition=False) -> dict:
+    kwargs = {"query": query["query"], "parameters": query["parameters"]} if isinstance(query, dict) else {"query": query}
+    kwargs["max_item_count"] = page_size
+    if cross_partition:
+        kwargs["enable_cross_partition_query"] = True
+    if partition_key is not None:
+        kwargs["partition_key"] = partition_key
+    return kwargs
+
+# Responses of query_db and query_db_async
+def point_read_response(request: ApiRequest, items, paginated, cache_key) -> func.HttpResponse:
+    logging.info(f"Point read succeeded, found {len(items)} items.")
+    if paginated:
+        body = json.dumps({"items": items, "continuation_token": None})
+        return func.HttpResponse(body, status_code=200, mimetype="application/json")
+    if cache_key:
+        return catalog_cache_response(request, catalog_cache_put(cache_key, json.dumps(items).encode("utf-8")), "MISS")
+    return func.HttpResponse(json.dumps(items), status_code=200)
+
+def query_page_response(items, continuation_token) -> func.HttpResponse:
+    logging.info(f"Read operation succeeded, returning page of {len(items)} items.")
+    body = {"items": items, "continuation_token": encode_continuation_token(continuation_token)}
+    return func.HttpResponse(json.dumps(body), status_code=200, mimetype="application/json")
+
+def query_items_response(request: ApiRequest, body, count, cache_key) -> func.HttpResponse:
+    logging.info(f"Read operation succeeded, found {count} items.")
+    if cache_key:
+        return catalog_cache_response(request, catalog_cache_put(cache_key, body), "MISS")
+    return func.HttpResponse(body, status_code=200)
+
+def query_error_response(e) -> func.HttpResponse:
+    logging.error(f"Error querying items: {e}")
+    return func.HttpResponse(json.dumps({"message": f"error querying: {e}"}), status_code=500)
+
+def read_db_paging(data):
+    paginated = 'page_size' in data or 'continuation_token' in data
+    page_size = data.get('page_size')
+    if page_size is None:
+        page_size = READ_DB_PAGE_SIZE
+    elif isinstance(page_size, bool) or not isinstance(page_size, (int, str)) or int(page_size) < 1:
+        raise ValueError("page_size must be a positive integer")
+    page_size = min(int(page_size), READ_DB_MAX_PAGE_SIZE)
+    return paginated, page_size, decode_continuation_token(data.get('continuation_token'))
+
+# Read-mostly catalog tables are cached in-process, keyed by table and normalised query text.
+# Writes through this instance invalidate the table, other instances converge within the TTL.
+CATALOG_TABLES = ("modules", "policies", "config")
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "60"))
+CATALOG_CACHE_MAX_ENTRIES = int(os.getenv("CATALOG_CACHE_MAX_ENTRIES", "256"))
+CATALOG_CACHE_MAX_ENTRY_BYTES = int(os.getenv("CATALOG_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+
+catalog_cache = OrderedDict()
+catalog_cache_lock = threading.Lock()
+
+QUOTED_STRING = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+
+def normalise_query(query):
+    if isinstance(query, dict):
+        return json.dumps(query, sort_keys=True)
+    # Collapse whitespace outside of string literals only
+    parts = QUOTED_STRING.split((query or "").strip())
+    return "".join(part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts))
+
+def catalog_cache_get(key):
+    with catalog_cache_lock:
+        entry = catalog_cache.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= time.time():
+            del catalog_cache[key]
+            return None
+        catalog_cache.move_to_end(key)
+        return entry
+
+def catalog_cache_put(key, body: bytes):
+    entry = {
+        "body": body,
+        "etag": '"' + hashlib.sha1(body).hexdigest() + '"',
+        "expires_at": time.time() + CATALOG_CACHE_TTL,
+    }
+    if len(body) > CATALOG_CACHE_MAX_ENTRY_BYTES:
+        return entry
+    with catalog_cache_lock:
+        catalog_cache[key] = entry
+        catalog_cache.move_to_end(key)
+        while len(catalog_cache) > CATALOG_CACHE_MAX_ENTRIES:
+            catalog_cache.popitem(last=False)
+    return entry
+
+def invalidate_catalog_cache(table_key):
+    if table_key not in CATALOG_TABLES:
+        return
+    with catalog_cache_lock:
+        for key in [key for key in catalog_cache if key[0] == table_key]:
+            del catalog_cache[key]
+
+def catalog_cache_response(request: ApiRequest, entry, status) -> func.HttpResponse:
+    headers = {
+        "ETag": entry["etag"],
+        "X-Cache": status,
+        "Cache-Control": f"private, max-age={max(0, int(entry['expires_at'] - time.time()))}",
+    }
+    if entry["etag"] in (request.headers.get("If-None-Match") or ""):
+        return func.HttpResponse(status_code=304, headers=headers)
+    return func.HttpResponse(entry["body"], status_code=200, headers=headers)
+
+# Matches "SELECT * FROM c WHERE c.PK = '...' AND c.SK = '...'" (in either order) so it can be served as a point read
+POINT_READ_QUERY = re.compile(
+    r"""^\s*(?i:SELECT)\s+\*\s+(?i:FROM)\s+(?P<alias>\w+)\s+(?i:WHERE)\s+"""
+    r"""(?P=alias)\.(?P<f1>PK|SK)\s*=\s*(?:'(?P<v1>[^'\\]*)'|"(?P<d1>[^"\\]*)")\s+(?i:AND)\s+"""
+    r"""(?P=alias)\.(?P<f2>PK|SK)\s*=\s*(?:'(?P<v2>[^'\\]*)'|"(?P<d2>[^"\\]*)")\s*$"""
+)
+
+def match_point_read(query):
+    match = POINT_READ_QUERY.match(query or "")
+    if not match or match.group("f1") == match.group("f2"):
+        return None
+    values = {
+        match.group("f1"): match.group("v1") if match.group("v1") is not None else match.group("d1"),
+        match.group("f2"): match.group("v2") if match.group("v2") is not None else match.group("d2"),
+    }
+    return values["PK"], values["SK"]
 
-def upload_file_base64(req: func.HttpRequest) -> func.HttpResponse:
+partition_key_paths = {}
+
+def point_read_partition_key(container_name, container, point_key):
+    path = container_partition_key_path(container_name, container)
+    if path is None:
+        return None
+    return partition_key_for_path(path, point_key)
+
+def partition_key_for_path(path, point_key):
+    pk, sk = point_key
+    return {"/PK": pk, "/SK": sk, "/id": get_id({"PK": pk, "SK": sk})}.get(path)
+
+def point_read(container, point_key, partition_key):
+    pk, sk = point_key
     try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
-    
+        item = cosmos_call(container, "read_item", item=get_id({"PK": pk, "SK": sk}), partition_key=partition_key)
+    except exceptions.CosmosResourceNotFoundError:
+        return []
+    return point_read_items(item, point_key)
+
+def point_read_items(item, point_key):
+    # get_id() is lossy, make sure the document really is the one that was asked for
+    pk, sk = point_key
+    if item.get("PK") != pk or item.get("SK") != sk:
+        return []
+    return [item]
+
+class JsonArrayEncoder:
+    # Serialises one page at a time so only a single page of decoded items is alive at once. BytesIO
+    # hands its buffer over in getvalue(), so the encoded body exists only once.
+    def __init__(self):
+        self.body = io.BytesIO()
+        self.body.write(b"[")
+        self.count = 0
+
+    def add_page(self, page):
+        for item in page:
+            if self.count:
+                self.body.write(b", ")
+            self.body.write(json.dumps(item).encode("utf-8"))
+            self.count += 1
+
+    def getvalue(self) -> bytes:
+        self.body.write(b"]")
+        return self.body.getvalue()
+
+def encode_json_pages(pages):
+    encoder = JsonArrayEncoder()
+    for page in pages:
+        encoder.add_page(page)
+    return encoder.getvalue(), encoder.count
+
+async def encode_json_pages_async(pages):
+    encoder = JsonArrayEncoder()
+    async for page in pages:
+        encoder.add_page(page)
+    return encoder.getvalue(), encoder.count
+
+def encode_continuation_token(token):
+    if not token:
+        return None
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+def decode_continuation_token(token):
+    if not token:
+        return None
+    return base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8")
+
+@api_event("upload_file_base64", required=("bucket_name", "key", "base64_content"))
+def upload_file_base64(request: ApiRequest) -> func.HttpResponse:
     account_name = os.getenv("STORAGE_ACCOUNT_NAME")
-    blob_service_client = BlobServiceClient(
-        account_url=f"https://{account_name}.blob.core.windows.net",
-        credential=DefaultAzureCredential()
-    )
+    blob_service_client = get_blob_service_client(account_name)
 
-    payload = req_body.get('data')
-    bucket_name = payload.get('bucket_name')
+    payload = request.data
+    bucket_name = payload['bucket_name']
     container_name = buckets[bucket_name]
     blob_name = payload.get('key')
     base64_body = payload.get('base64_content')
-    binary_body = base64.b64decode(base64_body)
     blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-    blob_client.upload_blob(binary_body, overwrite=True)
+    key = (container_name, blob_name)
+    sha256 = (payload.get('sha256') or "").lower() or None
+    try:
+        md5 = normalise_md5(payload.get('md5'))
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid md5: {e}", status_code=400)
+
+    # A declared hash that matches the stored blob skips even decoding the body
+    if (sha256 or md5) and not content_hash_differs(key, sha256, md5):
+        if content_matches(blob_content_hashes(blob_client, key), sha256, md5):
+            return deduplicated_response(blob_name, container_name, sha256)
+
+    binary_body = base64.b64decode(base64_body)
+    actual = {
+        "sha256": hashlib.sha256(binary_body).hexdigest(),
+        "md5": hashlib.md5(binary_body, usedforsecurity=False).hexdigest(),
+    }
+    if (sha256 and sha256 != actual["sha256"]) or (md5 and md5 != actual["md5"]):
+        return func.HttpResponse("Content does not match the declared hash.", status_code=400)
+    if not (sha256 or md5) and not content_hash_differs(key, actual["sha256"]) and content_matches(blob_content_hashes(blob_client, key), actual["sha256"]):
+        return deduplicated_response(blob_name, container_name, actual["sha256"])
+
+    with dependency_span("blob"):
+        blob_client.upload_blob(binary_body, overwrite=True, metadata={CONTENT_SHA256_METADATA: actual["sha256"]})
+    record_usage(bytes_transferred=len(binary_body))
+    content_hash_put(key, actual)
     print(f"Blob {blob_name} uploaded to container {container_name} successfully.")
     response_body = {
-        "status": f"Blob {blob_name} uploaded to container {container_name} successfully."
+        "status": f"Blob {blob_name} uploaded to container {container_name} successfully.",
+        "deduplicated": False,
+        "sha256": actual["sha256"],
     }
     return func.HttpResponse(
         json.dumps(response_body),
@@ -531,13 +1298,20 @@ def upload_file_base64(req: func.HttpRequest) -> func.HttpResponse:
         mimetype="application/json"
     )
 
-def upload_file_url(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        req_body = req.get_json()
-    except ValueError:
-        return func.HttpResponse("Invalid JSON body.", status_code=400)
+def deduplicated_response(blob_name, container_name, sha256) -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps({
+            "status": f"Blob {blob_name} in container {container_name} already has this content.",
+            "deduplicated": True,
+            "sha256": sha256,
+        }),
+        status_code=200,
+        mimetype="application/json"
+    )
 
-    payload = req_body.get('data', {})
+@api_event("upload_file_url", required=("bucket_name", "key", "url"))
+def upload_file_url(request: ApiRequest) -> func.HttpResponse:
+    payload = request.data
     bucket_name = payload.get('bucket_name')
     container_name = buckets.get(bucket_name)
     if not container_name:
@@ -547,64 +1321,2256 @@ def upload_file_url(req: func.HttpRequest) -> func.HttpResponse:
 
     download_url = payload.get('url')
     account_name = os.getenv("STORAGE_ACCOUNT_NAME")
-    blob_service = BlobServiceClient(
-        account_url=f"https://{account_name}.blob.core.windows.net",
-        credential=DefaultAzureCredential()
-    )
+    blob_service = get_blob_service_client(account_name)
     blob_client = blob_service.get_blob_client(container=container_name, blob=blob_name)
 
-    # check if blob already exists
-    if blob_client.exists():
+    # check if blob already exists, this never overwrites so a matching hash only tells the
+    # caller whether the existing blob is the content they meant to publish
+    key = (container_name, blob_name)
+    sha256 = (payload.get('sha256') or "").lower() or None
+    try:
+        md5 = normalise_md5(payload.get('md5'))
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid md5: {e}", status_code=400)
+    try:
+        block_size = int(payload.get('block_size') or UPLOAD_BLOCK_SIZE)
+        concurrency = int(payload.get('concurrency') or UPLOAD_CONCURRENCY)
+    except (ValueError, TypeError):
+        return func.HttpResponse("block_size and concurrency must be integers.", status_code=400)
+    hashes = blob_content_hashes(blob_client, key)
+    if hashes is not None:
         return func.HttpResponse(
-            json.dumps({"object_already_exists": True}),
+            json.dumps({"object_already_exists": True, "deduplicated": content_matches(hashes, sha256, md5)}),
             status_code=200,
             mimetype="application/json"
         )
 
     # download from URL and upload
     try:
-        with urllib.request.urlopen(download_url) as resp:
-            blob_client.upload_blob(resp, overwrite=False)
+        transfer = transfer_url_to_blob(download_url, blob_client, block_size=block_size, concurrency=concurrency)
     except Exception as e:
         return func.HttpResponse(f"Error uploading blob: {e}", status_code=500)
+    if transfer["sha256"]:
+        content_hash_put(key, {"sha256": transfer["sha256"], "md5": None})
 
     return func.HttpResponse(
-        json.dumps({"object_already_exists": False}),
+        json.dumps({"object_already_exists": False, "deduplicated": False, "transfer": transfer}),
         status_code=200,
         mimetype="application/json"
     )
 
+### BLOB TRANSFER ###
+
+# Large files are copied as staged blocks: Range requests fetch blocks in parallel when the source
+# supports it, otherwise the response is streamed and cut into blocks. Block ids are derived from
+# the source, so blocks staged by an attempt that timed out are reused on the next attempt.
+UPLOAD_BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE", str(8 * 1024 * 1024)))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+UPLOAD_MAX_BLOCK_SIZE = 100 * 1024 * 1024
+UPLOAD_MAX_CONCURRENCY = 16
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+DOWNLOAD_RETRIES = 3
+
+_download_session = None
+
+def get_download_session():
+    global _download_session
+    with client_registry_lock:
+        if _download_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_MAX_CONCURRENCY)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _download_session = session
+    return _download_session
+
+def block_id(prefix, index):
+    return base64.b64encode(f"{prefix}-{index:06d}".encode("ascii")).decode("ascii")
+
+def staged_blocks(blob_client) -> dict:
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        with dependency_span("blob"):
+            _, uncommitted = blob_client.get_block_list("uncommitted")
+    except ResourceNotFoundError:
+        return {}
+    return {block.id: block.size for block in uncommitted}
+
+def probe_source(session, url):
+    # A one byte Range request tells both the size and whether ranges are honoured, unlike HEAD
+    # it also works for presigned GET-only URLs
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+        resp.raise_for_status()
+        content_range = resp.headers.get("Content-Range", "")
+        if resp.status_code == 206 and "/" in content_range and not content_range.endswith("/*"):
+            return int(content_range.rsplit("/", 1)[1]), True
+        length = resp.headers.get("Content-Length")
+        return (int(length) if length else None), False
+
+def fetch_range(session, url, start, end):
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            with dependency_span("download"):
+                resp = session.get(url, headers={"Range": f"bytes={start}-{end}"}, timeout=DOWNLOAD_TIMEOUT)
+            resp.raise_for_status()
+            if resp.status_code != 206 or len(resp.content) != end - start + 1:
+                raise IOError(f"Unexpected range response for bytes {start}-{end} ({resp.status_code}, {len(resp.content)} bytes)")
+            return resp.content
+        except (requests.RequestException, IOError):
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+def transfer_url_to_blob(url, blob_client, block_size=UPLOAD_BLOCK_SIZE, concurrency=UPLOAD_CONCURRENCY) -> dict:
+    from azure.core import MatchConditions
+    block_size = max(1024 * 1024, min(block_size, UPLOAD_MAX_BLOCK_SIZE))
+    concurrency = max(1, min(concurrency, UPLOAD_MAX_CONCURRENCY))
+    started = time.monotonic()
+    session = get_download_session()
+
+    size, ranged = probe_source(session, url)
+    prefix = hashlib.sha256(f"{url}|{size}|{block_size}".encode("utf-8")).hexdigest()[:16]
+    existing = staged_blocks(blob_client)
+    block_ids = []
+    stats = {"bytes": 0, "blocks": 0, "resumed_blocks": 0}
+    digest = hashlib.sha256()
+    in_flight = deque()
+
+    def stage(index, data):
+        with dependency_span("blob"):
+            blob_client.stage_block(block_id=block_id(prefix, index), data=data, length=len(data))
+        return data
+
+    def wait_for_slot(limit):
+        # Waiting on the oldest block keeps the content hash in order and bounds memory to about
+        # `concurrency` blocks in flight
+        while len(in_flight) >= limit:
+            data = in_flight.popleft().result()
+            stats["bytes"] += len(data)
+            if ranged and digest is not None:
+                digest.update(data)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if ranged:
+            for index, start in enumerate(range(0, size, block_size)):
+                end = min(start + block_size, size) - 1
+                block_ids.append(block_id(prefix, index))
+                if existing.get(block_ids[-1]) == end - start + 1:
+                    # Resumed blocks are not downloaded again, so the content hash is unknown
+                    wait_for_slot(1)
+                    digest = None
+                    stats["resumed_blocks"] += 1
+                    stats["bytes"] += end - start + 1
+                    continue
+                wait_for_slot(concurrency)
+                in_flight.append(pool.submit(in_request_context(lambda i, a, b: stage(i, fetch_range(session, url, a, b))), index, start, end))
+        else:
+            with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+                resp.raise_for_status()
+                buffer = bytearray()
+                index = 0
+                chunks = resp.iter_content(chunk_size=min(block_size, 1024 * 1024))
+                while True:
+                    chunk = next(chunks, None)
+                    if chunk:
+                        buffer += chunk
+                    if len(buffer) < block_size and chunk is not None:
+                        continue
+                    if not buffer and chunk is None:
+                        break
+                    data, buffer = bytes(buffer[:block_size]), buffer[block_size:]
+                    digest.update(data)
+                    block_ids.append(block_id(prefix, index))
+                    if existing.get(block_ids[-1]) == len(data):
+                        stats["resumed_blocks"] += 1
+                        stats["bytes"] += len(data)
+                    else:
+                        wait_for_slot(concurrency)
+                        in_flight.append(pool.submit(in_request_context(stage), index, data))
+                    index += 1
+                    if chunk is None and not buffer:
+                        break
+        wait_for_slot(1)
+
+    stats["blocks"] = len(block_ids)
+    sha256 = digest.hexdigest() if digest is not None else None
+    record_usage(bytes_transferred=stats["bytes"])
+    with dependency_span("blob"):
+        blob_client.commit_block_list(
+            block_ids,
+            metadata={CONTENT_SHA256_METADATA: sha256} if sha256 else None,
+            etag="*",
+            match_condition=MatchConditions.IfMissing,
+        )
+
+    seconds = time.monotonic() - started
+    return {
+        **stats,
+        "sha256": sha256,
+        "mode": "ranged" if ranged else "stream",
+        "block_size": block_size,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "throughput_mib_s": round(stats["bytes"] / (1024 * 1024) / seconds, 2) if seconds else None,
+    }
+
 ### EXTRA FUNCTIONS ###
 
-def delete_finished_container_groups(subscription_id, resource_group_name):
-    credential = DefaultAzureCredential()
-    client = ContainerInstanceManagementClient(credential, subscription_id)
+ACI_MAX_CONTAINER_GROUPS = int(os.getenv("ACI_MAX_CONTAINER_GROUPS", "100"))
+ACI_DELETE_CONCURRENCY = int(os.getenv("ACI_DELETE_CONCURRENCY", "10"))
+CONTAINER_GROUP_COUNT_TTL = int(os.getenv("CONTAINER_GROUP_COUNT_TTL", "30"))
+CONTAINER_GROUP_CLEANUP_SCHEDULE = os.getenv("CONTAINER_GROUP_CLEANUP_SCHEDULE", "0 */5 * * * *")
+FINISHED_STATES = {"Succeeded", "Failed", "Stopped"}
 
-    finished_states = {"Succeeded", "Failed"}
+container_group_cache = {"groups": None, "fetched_at": 0.0}
+container_group_lock = threading.Lock()
 
-    container_groups = client.container_groups.list_by_resource_group(resource_group_name)
-    
-    for cg in container_groups:
-        state = cg.provisioning_state
-        if state in finished_states:
-            print(f"Deleting container group: {cg.name} (state: {state})")
-            delete_op = client.container_groups.begin_delete(resource_group_name, cg.name)
-            delete_op.wait()
+@app.function_name(name="cleanup_container_groups")
+@app.timer_trigger(schedule=CONTAINER_GROUP_CLEANUP_SCHEDULE, arg_name="timer", run_on_startup=False, use_monitor=False)
+def cleanup_container_groups(timer: func.TimerRequest) -> None:
+    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+    resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
+    deleted = delete_finished_container_groups(subscription_id, resource_group_name)
+    logging.info(f"Container group cleanup deleted {deleted} finished container groups.")
+    if RUNNER_DISPATCH_MODE == "queue":
+        dispatch_runners()
+
+def list_container_groups(client, resource_group_name, max_age=CONTAINER_GROUP_COUNT_TTL) -> dict:
+    with container_group_lock:
+        if container_group_cache["groups"] is not None and time.time() - container_group_cache["fetched_at"] < max_age:
+            return dict(container_group_cache["groups"])
+    with dependency_span("aci"):
+        groups = {cg.name: cg.provisioning_state for cg in client.container_groups.list_by_resource_group(resource_group_name)}
+    with container_group_lock:
+        container_group_cache["groups"] = groups
+        container_group_cache["fetched_at"] = time.time()
+    return dict(groups)
+
+def note_container_group(name, state=None):
+    with container_group_lock:
+        groups = container_group_cache["groups"]
+        if groups is None:
+            return
+        if state is None:
+            groups.pop(name, None)
+        else:
+            groups[name] = state
+
+def ensure_runner_capacity(subscription_id, resource_group_name, needed=1, max_age=CONTAINER_GROUP_COUNT_TTL) -> int:
+    client = get_aci_client(subscription_id)
+    max_groups = min(RUNNER_MAX_CONCURRENCY, ACI_MAX_CONTAINER_GROUPS)
+    free_slots = max_groups - len(list_container_groups(client, resource_group_name, max_age=max_age))
+    if free_slots >= needed:
+        return free_slots
+    if max_age > 0:
+        # The cached count may be stale, so only pay for a cleanup when a fresh listing agrees
+        free_slots = max_groups - len(list_container_groups(client, resource_group_name, max_age=0))
+        if free_slots >= needed:
+            return free_slots
+    return free_slots + delete_finished_container_groups(subscription_id, resource_group_name, limit=needed - free_slots)
+
+def delete_finished_container_groups(subscription_id, resource_group_name, limit=None) -> int:
+    client = get_aci_client(subscription_id)
+
+    # A provisioning state of Succeeded only means the group was created, the instance view tells whether it has exited
+    candidates = [
+        name for name, state in list_container_groups(client, resource_group_name, max_age=0).items()
+        if state in {"Succeeded", "Failed"}
+    ]
+
+    def finished_summary(name):
+        try:
+            cg = client.container_groups.get(resource_group_name, name)
+        except Exception as e:
+            logging.error(f"Error reading container group {name}: {e}")
+            return None
+        summary = container_group_summary(cg)
+        if summary["state"] not in FINISHED_STATES:
+            logging.info(f"Skipping container group: {name} (state: {summary['state']})")
+            return None
+        settled = log_archive_settled(summary)
+        if limit is None and LOG_ARCHIVE_CONTAINER and not settled:
+            # Give Log Analytics time to ingest the last rows before archiving, a later run picks it up
+            logging.info(f"Skipping container group: {name} (logs not settled yet)")
+            return None
+        summary["partial"] = not settled
+        summary["payload_blob"] = (cg.tags or {}).get(RUNNER_PAYLOAD_TAG) == "blob"
+        return summary
+
+    def delete_group(name, summary):
+        if LOG_ARCHIVE_CONTAINER:
+            try:
+                archive_job_logs(name, summary)
+            except Exception as e:
+                logging.error(f"Error archiving logs for {name}, they remain available in Log Analytics: {e}")
+        try:
+            print(f"Deleting container group: {name}")
+            client.container_groups.begin_delete(resource_group_name, name).wait()
+            note_container_group(name)
+        except Exception as e:
+            logging.error(f"Error deleting container group {name}: {e}")
+            return False
+        if summary.get("payload_blob"):
+            try:
+                delete_runner_payload(name)
+            except Exception as e:
+                logging.error(f"Error deleting the offloaded payload of {name}: {e}")
+        return True
+
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=ACI_DELETE_CONCURRENCY) as pool:
+        for start in range(0, len(candidates), ACI_DELETE_CONCURRENCY):
+            wave = candidates[start:start + ACI_DELETE_CONCURRENCY]
+            finished = [(name, summary) for name, summary in zip(wave, pool.map(finished_summary, wave)) if summary]
+            if limit is not None:
+                # A capacity check only reclaims as many slots as it needs
+                finished = finished[:limit - deleted]
+            deleted += sum(pool.map(lambda entry: delete_group(*entry), finished))
+            if limit is not None and deleted >= limit:
+                break
+    return deleted
+
+def container_group_summary(cg) -> dict:
+    state = cg.instance_view.state if cg.instance_view and cg.instance_view.state else cg.provisioning_state
+    summary = {"state": state, "exit_code": None, "started_at": None, "finished_at": None}
+    for container in cg.containers or []:
+        current = container.instance_view.current_state if container.instance_view else None
+        if current:
+            summary["exit_code"] = current.exit_code
+            summary["started_at"] = current.start_time.isoformat() if current.start_time else None
+            summary["finished_at"] = current.finish_time.isoformat() if current.finish_time else None
+    return summary
+
+### JOB STATUS ###
+
+# job_status reads container group states through the ACI client instead of Log Analytics or
+# Cosmos. States of running jobs are memoised for JOB_STATUS_TTL seconds, terminal states never
+# change and are kept until evicted. With `wait` the call long-polls until every job has finished,
+# any job changed state or the wait is over. Jobs that are still queued have no container group
+# yet and report Queued (or Failed once their message was poisoned) from the runner state, groups
+# removed by the cleanup timer report the state kept in their log archive. Only unknown job ids
+# report NotFound.
+JOB_STATUS_TTL = float(os.getenv("JOB_STATUS_TTL", "5"))
+JOB_STATUS_MAX_WAIT = float(os.getenv("JOB_STATUS_MAX_WAIT", "25"))
+JOB_STATUS_POLL_INTERVAL = 1.0
+JOB_STATUS_MAX_JOBS = 100
+JOB_STATUS_MAX_WORKERS = int(os.getenv("JOB_STATUS_MAX_WORKERS", "8"))
+JOB_STATUS_CACHE_MAX_ENTRIES = 4096
+
+job_status_cache = OrderedDict()
+job_status_lock = threading.Lock()
+
+@api_event("job_status")
+def job_status(request: ApiRequest) -> func.HttpResponse:
+    try:
+        job_ids, wait = job_status_request(request.data)
+    except (ValueError, TypeError) as e:
+        return func.HttpResponse(str(e), status_code=400)
+
+    valid = [job_id for job_id in job_ids if JOB_ID_PATTERN.match(job_id)]
+    deadline = time.monotonic() + wait
+    statuses = job_statuses(valid)
+    initial = {job_id: status.get("state") for job_id, status in statuses.items()}
+    while not job_status_settled(statuses, initial, deadline):
+        time.sleep(max(0.0, min(JOB_STATUS_POLL_INTERVAL, deadline - time.monotonic())))
+        statuses = job_statuses(valid)
+    return job_status_response(job_ids, statuses)
+
+def job_status_request(data):
+    job_ids = data.get('job_ids')
+    if job_ids is None and data.get('job_id'):
+        job_ids = [data['job_id']]
+    if not isinstance(job_ids, list) or not job_ids or not all(isinstance(job_id, str) for job_id in job_ids):
+        raise ValueError("Expected job_id or a non-empty list of job_ids in data.")
+    if len(job_ids) > JOB_STATUS_MAX_JOBS:
+        raise ValueError(f"At most {JOB_STATUS_MAX_JOBS} job_ids per call.")
+    wait = float(data.get('wait') or 0)
+    if not math.isfinite(wait) or wait < 0:
+        raise ValueError("wait must be a finite number that is not negative.")
+    return list(dict.fromkeys(job_ids)), min(wait, JOB_STATUS_MAX_WAIT)
+
+def job_status_settled(statuses, initial, deadline) -> bool:
+    if time.monotonic() >= deadline:
+        return True
+    if all(status.get("finished") or "error" in status for status in statuses.values()):
+        return True
+    return any(status.get("state") != initial.get(job_id) for job_id, status in statuses.items())
+
+def job_status_response(job_ids, statuses) -> func.HttpResponse:
+    jobs = [
+        {"job_id": job_id, **statuses[job_id]} if job_id in statuses else {"job_id": job_id, "error": "Invalid job_id."}
+        for job_id in job_ids
+    ]
+    return func.HttpResponse(json.dumps({"jobs": jobs}), status_code=200, mimetype="application/json")
+
+def job_statuses(job_ids) -> dict:
+    statuses = {}
+    missing = []
+    now = time.time()
+    with job_status_lock:
+        for job_id in job_ids:
+            entry = job_status_cache.get(job_id)
+            if entry and (entry["expires_at"] is None or now < entry["expires_at"]):
+                job_status_cache.move_to_end(job_id)
+                statuses[job_id] = entry["status"]
+            else:
+                missing.append(job_id)
+
+    if len(missing) <= 1:
+        fetched = [fetch_job_status(job_id) for job_id in missing]
+    else:
+        with ThreadPoolExecutor(max_workers=min(JOB_STATUS_MAX_WORKERS, len(missing))) as pool:
+            fetched = list(pool.map(in_request_context(fetch_job_status), missing))
+
+    with job_status_lock:
+        for job_id, status in zip(missing, fetched):
+            statuses[job_id] = status
+            if "error" in status:
+                continue
+            job_status_cache[job_id] = {
+                "status": status,
+                "expires_at": None if status["finished"] else time.time() + JOB_STATUS_TTL,
+            }
+            job_status_cache.move_to_end(job_id)
+        while len(job_status_cache) > JOB_STATUS_CACHE_MAX_ENTRIES:
+            job_status_cache.popitem(last=False)
+    return statuses
+
+def fetch_job_status(job_id) -> dict:
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        client = get_aci_client(os.getenv("AZURE_SUBSCRIPTION_ID"))
+        with dependency_span("aci"):
+            cg = client.container_groups.get(os.getenv("RESOURCE_GROUP_NAME"), job_id)
+    except ResourceNotFoundError:
+        return deleted_job_status(job_id)
+    except Exception as e:
+        logging.warning(f"Could not read container group {job_id}: {e}")
+        return {"error": f"Could not read job status: {e}"}
+    summary = container_group_summary(cg)
+    return {**summary, "finished": summary["state"] in FINISHED_STATES}
+
+def deleted_job_status(job_id) -> dict:
+    archive = None
+    if LOG_ARCHIVE_CONTAINER:
+        try:
+            archive = get_log_archive(job_id)
+        except Exception as e:
+            logging.warning(f"Could not read log archive for {job_id}: {e}")
+    if not archive:
+        return queued_job_status(job_id)
+    def value(name):
+        # The archive metadata holds str() of each value, so None was stored as "None"
+        return None if archive.get(name) in (None, "None") else archive[name]
+
+    return {
+        "state": value("state"),
+        "exit_code": int(value("exit_code")) if value("exit_code") is not None else None,
+        "started_at": None,
+        "finished_at": value("finished_at"),
+        "finished": True,
+    }
+
+def queued_job_status(job_id) -> dict:
+    status = {"state": "NotFound", "exit_code": None, "started_at": None, "finished_at": None, "finished": False}
+    try:
+        record = get_runner_state().get_job(job_id)
+    except Exception as e:
+        logging.warning(f"Could not read the queued state of runner job {job_id}: {e}")
+        record = None
+    if not record:
+        return status
+    status["state"] = record["state"]
+    for name in ("priority", "attempts", "last_error", "error"):
+        if record.get(name) is not None:
+            status[name] = record[name]
+    if record["state"] == "Failed":
+        status.update({"finished_at": record.get("updated_at"), "finished": True})
+    return status
+
+### CONTENT HASH INDEX ###
+
+# Uploads record the SHA-256 of their content in blob metadata. A recent-hash index per process
+# lets a publish of changed content skip the properties request. It is only a hint, another
+# instance may have overwritten the blob since, so a match is always confirmed against the blob
+# before an upload is skipped.
+CONTENT_SHA256_METADATA = "content_sha256"
+CONTENT_HASH_INDEX_TTL = float(os.getenv("CONTENT_HASH_INDEX_TTL", "300"))
+CONTENT_HASH_INDEX_MAX_ENTRIES = int(os.getenv("CONTENT_HASH_INDEX_MAX_ENTRIES", "4096"))
+
+content_hash_index = OrderedDict()
+content_hash_lock = threading.Lock()
+
+def normalise_md5(md5):
+    # Accepts hex or base64 (as in Content-MD5), raises ValueError otherwise
+    if not md5:
+        return None
+    if not isinstance(md5, str):
+        raise ValueError("md5 must be a string")
+    if re.fullmatch(r"[0-9a-fA-F]{32}", md5):
+        return md5.lower()
+    try:
+        digest = base64.b64decode(md5, validate=True)
+    except binascii.Error:
+        raise ValueError("md5 is neither hex nor base64")
+    if len(digest) != 16:
+        raise ValueError("md5 must be 16 bytes")
+    return digest.hex()
+
+def content_hash_get(key):
+    with content_hash_lock:
+        entry = content_hash_index.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= time.time():
+            del content_hash_index[key]
+            return None
+        content_hash_index.move_to_end(key)
+        return entry["hashes"]
+
+def content_hash_put(key, hashes):
+    with content_hash_lock:
+        content_hash_index[key] = {"hashes": hashes, "expires_at": time.time() + CONTENT_HASH_INDEX_TTL}
+        content_hash_index.move_to_end(key)
+        while len(content_hash_index) > CONTENT_HASH_INDEX_MAX_ENTRIES:
+            content_hash_index.popitem(last=False)
+
+def forget_content_hash(key):
+    with content_hash_lock:
+        content_hash_index.pop(key, None)
+
+def content_hash_differs(key, sha256=None, md5=None) -> bool:
+    # True when the index holds a hash of the blob that differs from the given one
+    hashes = content_hash_get(key)
+    if not hashes:
+        return False
+    return any(value and hashes.get(name) and hashes[name] != value for name, value in (("sha256", sha256), ("md5", md5)))
+
+def blob_content_hashes(blob_client, key):
+    # Reads the hashes from the blob itself, returns None when it does not exist
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        with dependency_span("blob"):
+            props = blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        forget_content_hash(key)
+        return None
+    content_md5 = props.content_settings.content_md5 if props.content_settings else None
+    hashes = {
+        "sha256": (props.metadata or {}).get(CONTENT_SHA256_METADATA),
+        "md5": bytes(content_md5).hex() if content_md5 else None,
+    }
+    content_hash_put(key, hashes)
+    return hashes
+
+def content_matches(hashes, sha256=None, md5=None) -> bool:
+    if not hashes:
+        return False
+    return bool((sha256 and hashes.get("sha256") == sha256) or (md5 and hashes.get("md5") == md5))
+
+### UPLOAD SESSIONS ###
+
+# A session uploads one blob as independently staged blocks. The session id carries the target
+# and a random nonce, so any instance can serve any chunk. Each block id embeds the session nonce,
+# the chunk index and the chunk's SHA-256, so commit_upload can rebuild the block list and the
+# overall checksum from the blob's uncommitted blocks alone. Abandoned sessions are garbage
+# collected by the storage service after 7 days.
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+UPLOAD_MAX_CHUNK_SIZE = int(os.getenv("UPLOAD_MAX_CHUNK_SIZE", str(64 * 1024 * 1024)))
+UPLOAD_MAX_CHUNKS = 50000
+
+@api_event("begin_upload", required=("bucket_name", "key"))
+def begin_upload(request: ApiRequest) -> func.HttpResponse:
+    payload = request.data
+    bucket_name = payload.get('bucket_name')
+    if bucket_name not in buckets:
+        return func.HttpResponse(f"Unknown bucket_name '{bucket_name}'", status_code=400)
+
+    session = {"b": bucket_name, "k": payload['key'], "n": uuid.uuid4().hex[:16]}
+    return func.HttpResponse(
+        json.dumps({
+            "session_id": base64.urlsafe_b64encode(json.dumps(session).encode("utf-8")).decode("ascii"),
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "max_chunk_size": UPLOAD_MAX_CHUNK_SIZE,
+            "max_chunks": UPLOAD_MAX_CHUNKS,
+        }),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+def decode_upload_session(session_id):
+    session = json.loads(base64.urlsafe_b64decode(session_id.encode("ascii")))
+    if session["b"] not in buckets or not re.fullmatch(r"[0-9a-f]{16}", session["n"]):
+        raise ValueError("Unknown upload session")
+    return session
+
+def upload_session_blob_client(session):
+    account_name = os.getenv("STORAGE_ACCOUNT_NAME")
+    return get_blob_service_client(account_name).get_blob_client(container=buckets[session["b"]], blob=session["k"])
+
+def chunk_block_id(session, index, digest):
+    return base64.b64encode(bytes.fromhex(session["n"]) + index.to_bytes(4, "big") + digest).decode("ascii")
+
+def parse_chunk_block_id(session, block_id):
+    raw = base64.b64decode(block_id)
+    if len(raw) != 44 or raw[:8] != bytes.fromhex(session["n"]):
+        return None
+    return int.from_bytes(raw[8:12], "big"), raw[12:]
+
+@api_event("upload_chunk", required=("session_id", "index"))
+def upload_chunk(request: ApiRequest) -> func.HttpResponse:
+    params = request.data
+    try:
+        if request.body is None:
+            data = request.http.get_body()
+        else:
+            data = base64.b64decode(params.get('base64_content') or "", validate=True)
+        session = decode_upload_session(params.get('session_id') or "")
+        index = int(params.get('index'))
+    except (ValueError, KeyError, TypeError):
+        return func.HttpResponse("Invalid upload_chunk request.", status_code=400)
+
+    if not 0 <= index < UPLOAD_MAX_CHUNKS:
+        return func.HttpResponse(f"Chunk index must be between 0 and {UPLOAD_MAX_CHUNKS - 1}.", status_code=400)
+    if not data or len(data) > UPLOAD_MAX_CHUNK_SIZE:
+        return func.HttpResponse(f"Chunk size must be between 1 and {UPLOAD_MAX_CHUNK_SIZE} bytes.", status_code=400)
+
+    digest = hashlib.sha256(data).digest()
+    expected = params.get('sha256')
+    if expected and expected.lower() != digest.hex():
+        return func.HttpResponse(f"Checksum mismatch for chunk {index}.", status_code=400)
+
+    blob_client = upload_session_blob_client(session)
+    with dependency_span("blob"):
+        blob_client.stage_block(block_id=chunk_block_id(session, index, digest), data=data, length=len(data))
+    record_usage(bytes_transferred=len(data))
+    return func.HttpResponse(
+        json.dumps({"index": index, "size": len(data), "sha256": digest.hex()}),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+@api_event("commit_upload", required=("session_id", "chunks"))
+def commit_upload(request: ApiRequest) -> func.HttpResponse:
+    payload = request.data
+    try:
+        session = decode_upload_session(payload.get('session_id') or "")
+        chunks = int(payload.get('chunks'))
+    except (ValueError, KeyError, TypeError):
+        return func.HttpResponse("Invalid commit_upload request.", status_code=400)
+    if not 1 <= chunks <= UPLOAD_MAX_CHUNKS:
+        return func.HttpResponse(f"chunks must be between 1 and {UPLOAD_MAX_CHUNKS}.", status_code=400)
+
+    blob_client = upload_session_blob_client(session)
+    staged = {}
+    for block_id, size in staged_blocks(blob_client).items():
+        parsed = parse_chunk_block_id(session, block_id)
+        if parsed is None or parsed[0] >= chunks:
+            continue
+        index, digest = parsed
+        if index in staged:
+            return func.HttpResponse(f"Chunk {index} was staged more than once with different content.", status_code=409)
+        staged[index] = (block_id, digest, size)
+
+    missing = [index for index in range(chunks) if index not in staged]
+    if missing:
+        return func.HttpResponse(
+            json.dumps({"error": "Missing chunks", "missing": missing[:100]}),
+            status_code=409,
+            mimetype="application/json"
+        )
+
+    # The overall checksum is the SHA-256 of the chunk digests concatenated in index order
+    checksum = hashlib.sha256(b"".join(staged[index][1] for index in range(chunks))).hexdigest()
+    expected = payload.get('sha256')
+    if expected and expected.lower() != checksum:
+        return func.HttpResponse(
+            json.dumps({"error": "Checksum mismatch", "sha256": checksum}),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    content_settings = None
+    if payload.get('content_type'):
+        from azure.storage.blob import ContentSettings
+        content_settings = ContentSettings(content_type=payload['content_type'])
+    with dependency_span("blob"):
+        blob_client.commit_block_list([staged[index][0] for index in range(chunks)], content_settings=content_settings)
+    forget_content_hash((buckets[session["b"]], session["k"]))
+    return func.HttpResponse(
+        json.dumps({
+            "status": f"Blob {session['k']} uploaded to container {buckets[session['b']]} successfully.",
+            "chunks": chunks,
+            "bytes": sum(staged[index][2] for index in range(chunks)),
+            "sha256": checksum,
+        }),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+### LOG ARCHIVE ###
+
+# Logs of finished jobs never change, so they are exported from Log Analytics to a gzip NDJSON blob
+# before the container group is deleted. The blob is written as independent gzip members of a fixed
+# number of rows whose byte offsets are kept in the blob metadata, which lets read_logs page through
+# it with range reads.
+LOG_ARCHIVE_CONTAINER = os.getenv("LOG_ARCHIVE_CONTAINER")
+LOG_ARCHIVE_SETTLE_SECONDS = int(os.getenv("LOG_ARCHIVE_SETTLE_SECONDS", "600"))
+LOG_ARCHIVE_ROWS_PER_MEMBER = 500
+LOG_ARCHIVE_MAX_MEMBERS = 600 # keeps the offsets within the 8 KiB metadata limit
+LOG_ARCHIVE_MISS_TTL = 30
+
+log_archive_index = OrderedDict()
+log_archive_lock = threading.Lock()
+
+def get_archive_blob_service_client():
+    from azure.storage.blob import BlobServiceClient
+    entry = get_registered_client(
+        ("blob", "AzureWebJobsStorage"),
+        None,
+        lambda: BlobServiceClient.from_connection_string(os.environ["AzureWebJobsStorage"], transport=get_azure_transport()),
+    )
+    return entry["client"]
+
+def log_archive_blob(job_id):
+    return get_archive_blob_service_client().get_blob_client(container=LOG_ARCHIVE_CONTAINER, blob=f"{job_id}.ndjson.gz")
+
+def log_archive_settled(summary) -> bool:
+    if not summary.get("finished_at"):
+        # Failed provisioning never started a container, there is nothing left to ingest
+        return True
+    return time.time() - parse_timestamp(summary["finished_at"]).timestamp() >= LOG_ARCHIVE_SETTLE_SECONDS
+
+def archive_job_logs(job_id, summary):
+    client = get_logs_client()
+    query = f"""
+    ContainerInstanceLog_CL
+    | where ContainerGroup_s == "{job_id}"
+    | project TimeGenerated, Message
+    | order by TimeGenerated asc, Message asc
+    """
+    started_at = summary.get("started_at")
+    if started_at:
+        timespan = (parse_timestamp(started_at) - timedelta(minutes=5), datetime.now(timezone.utc))
+    else:
+        timespan = timedelta(days=365)
+    with dependency_span("logs"):
+        response = client.query_workspace(os.getenv("LOG_ANALYTICS_WORKSPACE_ID"), query, timespan=timespan)
+    rows = [row for table in response.tables or [] for row in table.rows]
+
+    rows_per_member = max(LOG_ARCHIVE_ROWS_PER_MEMBER, -(-len(rows) // LOG_ARCHIVE_MAX_MEMBERS))
+    body = bytearray()
+    offsets = []
+    for start in range(0, len(rows), rows_per_member):
+        offsets.append(len(body))
+        lines = "".join(
+            json.dumps({"time": row["TimeGenerated"].isoformat(), "message": row["Message"]}) + "\n"
+            for row in rows[start:start + rows_per_member]
+        )
+        body += gzip.compress(lines.encode("utf-8"))
+
+    metadata = {
+        "rows": str(len(rows)),
+        "rows_per_member": str(rows_per_member),
+        "offsets": ",".join(str(offset) for offset in offsets),
+        "state": str(summary.get("state")),
+        "exit_code": str(summary.get("exit_code")),
+        "finished_at": str(summary.get("finished_at")),
+        "partial": "true" if summary.get("partial") else "false",
+    }
+    from azure.storage.blob import ContentSettings
+    log_archive_blob(job_id).upload_blob(
+        bytes(body),
+        overwrite=True,
+        metadata=metadata,
+        content_settings=ContentSettings(content_type="application/gzip"),
+    )
+    logging.info(f"Archived {len(rows)} log rows for {job_id}.")
+
+def get_log_archive(job_id):
+    # Archives are immutable so hits are kept, misses only briefly since the job may get archived any time
+    with log_archive_lock:
+        entry = log_archive_index.get(job_id)
+        if entry and (entry["metadata"] is not None or time.time() < entry["expires_at"]):
+            log_archive_index.move_to_end(job_id)
+            return entry["metadata"]
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        with dependency_span("blob"):
+            metadata = dict(log_archive_blob(job_id).get_blob_properties().metadata)
+    except ResourceNotFoundError:
+        metadata = None
+    with log_archive_lock:
+        log_archive_index[job_id] = {"metadata": metadata, "expires_at": time.time() + LOG_ARCHIVE_MISS_TTL}
+        while len(log_archive_index) > 4096:
+            log_archive_index.popitem(last=False)
+    return metadata
+
+def archived_logs_response(job_id, metadata, cursor, since, limit) -> func.HttpResponse:
+    offset = cursor["o"] if cursor else 0
+    if since and not cursor:
+        rows, _ = read_archived_logs(job_id, metadata)
+        offset = next((i for i, row in enumerate(rows) if parse_timestamp(row["time"]) > since), len(rows))
+    rows, next_offset = read_archived_logs(job_id, metadata, offset, limit)
+    return func.HttpResponse(
+        body=json.dumps({"events": [{"message": row["message"]} for row in rows], "cursor": encode_log_cursor({"o": next_offset})}),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+def read_archived_logs(job_id, metadata, offset=0, limit=None):
+    total = int(metadata["rows"])
+    offsets = [int(value) for value in metadata["offsets"].split(",")] if metadata["offsets"] else []
+    rows_per_member = int(metadata["rows_per_member"])
+    if offset >= total:
+        return [], total
+    end = total if limit is None else min(total, offset + limit)
+
+    first_member = offset // rows_per_member
+    last_member = (end - 1) // rows_per_member
+    range_start = offsets[first_member]
+    range_end = offsets[last_member + 1] if last_member + 1 < len(offsets) else None
+    length = None if range_end is None else range_end - range_start
+    with dependency_span("blob"):
+        data = log_archive_blob(job_id).download_blob(offset=range_start, length=length).readall()
+    record_usage(bytes_transferred=len(data))
+
+    lines = gzip.decompress(data).decode("utf-8").splitlines()
+    skip = offset - first_member * rows_per_member
+    return [json.loads(line) for line in lines[skip:skip + (end - offset)]], end
+
+### RUNNER SCHEDULER ###
+
+# In queue mode start_runner only enqueues the job. Jobs wait in one queue per priority and a
+# queue-triggered dispatcher launches them whenever there is a free slot below RUNNER_MAX_CONCURRENCY.
+# Dispatchers on other instances and the cleanup timer would each count free slots for themselves,
+# so dispatch holds a blob lease and counts with a fresh listing. Until a job has a container group
+# its state (Queued, or Failed once it is poisoned) is kept in RUNNER_STATE_CONTAINER for job_status.
+# A queue message holds at most 64 KiB after the Base64 encoding, payloads that would not fit are
+# kept in RUNNER_STATE_CONTAINER as well and the message only refers to them.
+RUNNER_DISPATCH_MODE = os.getenv("RUNNER_DISPATCH_MODE", "queue")
+RUNNER_QUEUE_BACKEND = os.getenv("RUNNER_QUEUE_BACKEND", "storage")
+RUNNER_QUEUE_PREFIX = os.getenv("RUNNER_QUEUE_PREFIX", "runner-jobs")
+RUNNER_DISPATCH_QUEUE = os.getenv("RUNNER_DISPATCH_QUEUE", "runner-dispatch")
+RUNNER_MAX_CONCURRENCY = int(os.getenv("RUNNER_MAX_CONCURRENCY", "100"))
+RUNNER_LAUNCH_CONCURRENCY = int(os.getenv("RUNNER_LAUNCH_CONCURRENCY", "10"))
+RUNNER_MAX_DEQUEUE_COUNT = int(os.getenv("RUNNER_MAX_DEQUEUE_COUNT", "5"))
+RUNNER_DISPATCH_VISIBILITY_TIMEOUT = int(os.getenv("RUNNER_DISPATCH_VISIBILITY_TIMEOUT", "120"))
+RUNNER_DISPATCH_RETRY_DELAY = int(os.getenv("RUNNER_DISPATCH_RETRY_DELAY", "30"))
+RUNNER_DISPATCH_BUSY_DELAY = int(os.getenv("RUNNER_DISPATCH_BUSY_DELAY", "5"))
+RUNNER_DISPATCH_LEASE_SECONDS = 60
+RUNNER_DISPATCH_LEASE_BLOB = "dispatch.lock"
+RUNNER_STATE_CONTAINER = os.getenv("RUNNER_STATE_CONTAINER", "runner-state")
+RUNNER_QUEUE_MESSAGE_MAX_BYTES = 64 * 1024
+RUNNER_PRIORITIES = ("high", "normal", "low")
+RUNNER_JOB_PRIORITIES = json.loads(os.getenv("RUNNER_JOB_PRIORITIES") or '{"apply": "high", "destroy": "high", "plan": "normal"}')
+
+class StorageRunnerQueue:
+    def __init__(self, name):
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
+        # Base64 to match what the Functions queue trigger expects
+        self.client = QueueClient.from_connection_string(
+            os.environ["AzureWebJobsStorage"],
+            name,
+            message_encode_policy=TextBase64EncodePolicy(),
+            message_decode_policy=TextBase64DecodePolicy(),
+            transport=get_azure_transport(),
+        )
+
+    def send(self, content, visibility_timeout=None):
+        self.client.send_message(content, visibility_timeout=visibility_timeout)
+
+    def receive(self, max_messages, visibility_timeout):
+        return list(self.client.receive_messages(max_messages=max_messages, visibility_timeout=visibility_timeout))
+
+    def delete(self, message):
+        self.client.delete_message(message)
+
+    def pending_count(self):
+        return self.client.get_queue_properties().approximate_message_count
+
+# Process-local stand-in for StorageRunnerQueue, used for tests and local runs
+class InMemoryRunnerQueue:
+    def __init__(self, name):
+        self.name = name
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def send(self, content, visibility_timeout=None):
+        # Same limit as a Storage Queue
+        if runner_queue_message_size(content) > RUNNER_QUEUE_MESSAGE_MAX_BYTES:
+            raise ValueError(f"The message exceeds the queue limit of {RUNNER_QUEUE_MESSAGE_MAX_BYTES} bytes.")
+        with self.lock:
+            self.messages.append({
+                "id": uuid.uuid4().hex,
+                "content": content,
+                "dequeue_count": 0,
+                "visible_at": time.time() + (visibility_timeout or 0),
+            })
+
+    def receive(self, max_messages, visibility_timeout):
+        now = time.time()
+        received = []
+        with self.lock:
+            for message in self.messages:
+                if len(received) >= max_messages:
+                    break
+                if message["visible_at"] <= now:
+                    message["visible_at"] = now + visibility_timeout
+                    message["dequeue_count"] += 1
+                    received.append(InMemoryQueueMessage(message["id"], message["content"], message["dequeue_count"]))
+        return received
+
+    def delete(self, message):
+        with self.lock:
+            self.messages = [m for m in self.messages if m["id"] != message.id]
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.messages)
+
+class InMemoryQueueMessage:
+    def __init__(self, id, content, dequeue_count):
+        self.id = id
+        self.content = content
+        self.dequeue_count = dequeue_count
+
+def runner_queue_message_size(content):
+    # Size after the Base64 encode policy
+    return 4 * ((len(content.encode("utf-8")) + 2) // 3)
+
+def get_runner_queue(name):
+    backend = InMemoryRunnerQueue if RUNNER_QUEUE_BACKEND == "memory" else StorageRunnerQueue
+    return get_registered_client(("queue", RUNNER_QUEUE_BACKEND, name), None, lambda: backend(name))["client"]
+
+class StorageRunnerState:
+    def __init__(self, container_name):
+        self.container_name = container_name
+
+    def blob(self, name):
+        return get_archive_blob_service_client().get_blob_client(container=self.container_name, blob=name)
+
+    def put_job(self, job_id, record):
+        with dependency_span("blob"):
+            self.blob(f"jobs/{job_id}.json").upload_blob(json.dumps(record), overwrite=True)
+
+    def get_job(self, job_id):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            with dependency_span("blob"):
+                return json.loads(self.blob(f"jobs/{job_id}.json").download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+
+    def delete_job(self, job_id):
+        self.delete(f"jobs/{job_id}.json")
+
+    def put_payload(self, job_id, body):
+        with dependency_span("blob"):
+            self.blob(f"payloads/{job_id}.json").upload_blob(body, overwrite=True)
+        record_usage(bytes_transferred=len(body))
+
+    def get_payload(self, job_id):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            with dependency_span("blob"):
+                body = self.blob(f"payloads/{job_id}.json").download_blob().readall()
+        except ResourceNotFoundError:
+            return None
+        record_usage(bytes_transferred=len(body))
+        return json.loads(body)
+
+    def delete_payload(self, job_id):
+        self.delete(f"payloads/{job_id}.json")
+
+    def delete(self, name):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            with dependency_span("blob"):
+                self.blob(name).delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+    def acquire_dispatch_lease(self):
+        # Returns None while another dispatcher holds the lease
+        from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+        blob_client = self.blob(RUNNER_DISPATCH_LEASE_BLOB)
+        for _ in range(2):
+            try:
+                return StorageDispatchLease(blob_client.acquire_lease(lease_duration=RUNNER_DISPATCH_LEASE_SECONDS))
+            except ResourceNotFoundError:
+                try:
+                    blob_client.upload_blob(b"", overwrite=False)
+                except ResourceExistsError:
+                    pass
+            except HttpResponseError as e:
+                if e.status_code == 409:
+                    return None
+                raise
+        return None
+
+class StorageDispatchLease:
+    # Renewed in the background, capacity checks that delete groups can take longer than a lease
+    def __init__(self, lease):
+        self.lease = lease
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.keep_alive, daemon=True)
+        self.thread.start()
+
+    def keep_alive(self):
+        while not self.stopped.wait(RUNNER_DISPATCH_LEASE_SECONDS / 3):
+            try:
+                self.lease.renew()
+            except Exception as e:
+                logging.warning(f"Could not renew the runner dispatch lease: {e}")
+                return
+
+    def release(self):
+        self.stopped.set()
+        try:
+            self.lease.release()
+        except Exception as e:
+            logging.warning(f"Could not release the runner dispatch lease, it expires in {RUNNER_DISPATCH_LEASE_SECONDS}s: {e}")
+
+# Process-local stand-in for StorageRunnerState, dispatch is inline there so the lease waits
+class InMemoryRunnerState:
+    def __init__(self):
+        self.jobs = {}
+        self.payloads = {}
+        self.lock = threading.Lock()
+        self.dispatch_lock = threading.Lock()
+
+    def put_job(self, job_id, record):
+        with self.lock:
+            self.jobs[job_id] = json.loads(json.dumps(record))
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def delete_job(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def put_payload(self, job_id, body):
+        with self.lock:
+            self.payloads[job_id] = body
+
+    def get_payload(self, job_id):
+        with self.lock:
+            body = self.payloads.get(job_id)
+        return None if body is None else json.loads(body)
+
+    def delete_payload(self, job_id):
+        with self.lock:
+            self.payloads.pop(job_id, None)
+
+    def acquire_dispatch_lease(self):
+        self.dispatch_lock.acquire()
+        return SimpleLease(self.dispatch_lock.release)
+
+class SimpleLease:
+    def __init__(self, release):
+        self.release = release
+
+def get_runner_state():
+    if RUNNER_QUEUE_BACKEND == "memory":
+        return get_registered_client(("runner_state", "memory"), None, InMemoryRunnerState)["client"]
+    return get_registered_client(("runner_state", RUNNER_STATE_CONTAINER), None, lambda: StorageRunnerState(RUNNER_STATE_CONTAINER))["client"]
+
+@contextmanager
+def runner_dispatch_lease():
+    lease = get_runner_state().acquire_dispatch_lease()
+    try:
+        yield lease is not None
+    finally:
+        if lease is not None:
+            lease.release()
+
+def note_runner_job(job_id, state, **fields):
+    # The record only informs job_status, a failed write must not fail the dispatch
+    try:
+        get_runner_state().put_job(job_id, {"state": state, "updated_at": datetime.now(timezone.utc).isoformat(), **fields})
+    except Exception as e:
+        logging.warning(f"Could not record state {state} of runner job {job_id}: {e}")
+
+def forget_runner_job(job_id):
+    try:
+        get_runner_state().delete_job(job_id)
+    except Exception as e:
+        logging.warning(f"Could not remove the queued state of runner job {job_id}: {e}")
+
+def forget_runner_payload(job_id):
+    try:
+        get_runner_state().delete_payload(job_id)
+    except Exception as e:
+        logging.warning(f"Could not remove the stored payload of runner job {job_id}: {e}")
+
+def runner_job_priority(payload):
+    if payload.get("priority") in RUNNER_PRIORITIES:
+        return payload["priority"]
+    command = payload.get("command")
+    for value in payload.values():
+        if command is None and isinstance(value, dict):
+            command = value.get("command")
+    return RUNNER_JOB_PRIORITIES.get(command, "normal")
+
+def enqueue_runner_job(job_id, payload, signal=True):
+    priority = runner_job_priority(payload)
+    job = {"job_id": job_id, "priority": priority, "enqueued_at": time.time()}
+    body = json.dumps(payload)
+    message = json.dumps({**job, "data": payload})
+    if offload_runner_payload(body):
+        # The runner reads it from PAYLOAD_URL, the dispatcher only needs the resources
+        upload_runner_payload(job_id, body)
+        job.update(payload_blob=True, resources={"cpu": payload.get("cpu"), "memory": payload.get("memory")})
+        message = json.dumps(job)
+    elif runner_queue_message_size(message) > RUNNER_QUEUE_MESSAGE_MAX_BYTES:
+        get_runner_state().put_payload(job_id, body)
+        job["payload_stored"] = True
+        message = json.dumps(job)
+    # Recorded first, a dispatcher may launch the job and remove the record right after the send
+    note_runner_job(job_id, "Queued", priority=priority)
+    try:
+        with dependency_span("queue"):
+            get_runner_queue(f"{RUNNER_QUEUE_PREFIX}-{priority}").send(message)
+    except Exception:
+        forget_runner_job(job_id)
+        if job.get("payload_stored"):
+            forget_runner_payload(job_id)
+        if job.get("payload_blob"):
+            discard_runner_payload(job_id)
+        raise
+    if signal:
+        signal_runner_dispatcher()
+
+def signal_runner_dispatcher(delay=None):
+    if RUNNER_QUEUE_BACKEND == "memory":
+        # Nothing triggers on an in-memory queue, dispatch inline instead
+        if delay is None:
+            dispatch_runners()
+        return
+    get_runner_queue(RUNNER_DISPATCH_QUEUE).send("dispatch", visibility_timeout=delay)
+
+@app.function_name(name="runner_dispatcher")
+@app.queue_trigger(arg_name="msg", queue_name=RUNNER_DISPATCH_QUEUE, connection="AzureWebJobsStorage")
+def runner_dispatcher(msg: func.QueueMessage) -> None:
+    launched = dispatch_runners(triggered=True)
+    logging.info(f"Runner dispatcher launched {launched} queued jobs.")
+
+def dispatch_runners(triggered=False) -> int:
+    # triggered means this run consumes a message of the dispatch queue
+    queues = [get_runner_queue(f"{RUNNER_QUEUE_PREFIX}-{priority}") for priority in RUNNER_PRIORITIES]
+    if not sum(queue.pending_count() for queue in queues):
+        return 0
+
+    with runner_dispatch_lease() as leased:
+        if not leased:
+            # The dispatcher holding the lease may have looked at the queues before these jobs arrived
+            schedule_runner_dispatch(RUNNER_DISPATCH_BUSY_DELAY, triggered)
+            return 0
+        return dispatch_queued_runners(queues, triggered)
+
+def dispatch_queued_runners(queues, triggered) -> int:
+    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+    resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
+
+    pending = sum(queue.pending_count() for queue in queues)
+    if not pending:
+        return 0
+    # Other instances launch too, the cached listing of this one would overcount free slots
+    free_slots = ensure_runner_capacity(subscription_id, resource_group_name, needed=pending, max_age=0)
+    client = get_aci_client(subscription_id)
+    launched = 0
+    for queue in queues:
+        while free_slots > 0:
+            messages = queue.receive(max_messages=min(free_slots, 32), visibility_timeout=RUNNER_DISPATCH_VISIBILITY_TIMEOUT)
+            if not messages:
+                break
+            launched_now = launch_queued_runners(client, queue, messages)
+            launched += launched_now
+            free_slots -= launched_now
+
+    if launched < pending and free_slots <= 0:
+        # Jobs are still waiting for capacity, check again later
+        schedule_runner_dispatch(RUNNER_DISPATCH_RETRY_DELAY, triggered)
+    return launched
+
+def schedule_runner_dispatch(delay, triggered):
+    # Skipped when another signal is already pending. The approximate count still includes the
+    # message that triggered this run, it is only deleted once the function returns.
+    if RUNNER_QUEUE_BACKEND == "memory" or get_runner_queue(RUNNER_DISPATCH_QUEUE).pending_count() <= (1 if triggered else 0):
+        signal_runner_dispatcher(delay=delay)
+
+def launch_queued_runner(client, job_id, job, template):
+    if job.get("payload_blob"):
+        return launch_runner(client, job_id, job["resources"], template, runner_payload_url_variable(job_id))
+    payload = get_runner_state().get_payload(job_id) if job.get("payload_stored") else job["data"]
+    if payload is None:
+        raise ValueError("The stored payload of the job is missing.")
+    launch_runner(client, job_id, payload, template)
+
+def launch_queued_runners(client, queue, messages) -> int:
+    jobs = [json.loads(message.content) for message in messages]
+    # The job_id is fixed at enqueue time, so a message redelivered after a successful launch
+    # updates the same container group instead of starting a second runner
+    errors = launch_runners(client, [(job["job_id"], job) for job in jobs], launch_queued_runner)
+    launched = 0
+    for job, message, error in zip(jobs, messages, errors):
+        if error is None:
+            queue.delete(message)
+            # The container group reports the state from here on
+            forget_runner_job(job["job_id"])
+            if job.get("payload_stored"):
+                forget_runner_payload(job["job_id"])
+            logging.info(f"Started queued runner {job['job_id']} ({job['priority']}).")
+            launched += 1
+        elif message.dequeue_count >= RUNNER_MAX_DEQUEUE_COUNT:
+            get_runner_queue(f"{RUNNER_QUEUE_PREFIX}-poison").send(message.content)
+            queue.delete(message)
+            note_runner_job(job["job_id"], "Failed", priority=job["priority"], attempts=message.dequeue_count, error=error)
+            if job.get("payload_stored"):
+                forget_runner_payload(job["job_id"])
+            if job.get("payload_blob"):
+                discard_runner_payload(job["job_id"])
+            logging.error(f"Gave up on queued runner {job['job_id']} after {message.dequeue_count} attempts: {error}")
         else:
-            print(f"Skipping container group: {cg.name} (state: {state})")
+            note_runner_job(job["job_id"], "Queued", priority=job["priority"], attempts=message.dequeue_count, last_error=error)
+    return launched
+
+# Broker work tokens are cached per partition key until shortly before they expire.
+# Cosmos resource tokens carry no readable expiry, so the broker default (1h) is assumed
+# unless the response says otherwise or a SAS token in it expires sooner.
+WORK_TOKEN_DEFAULT_TTL = int(os.getenv("WORK_TOKEN_DEFAULT_TTL", "3600"))
+WORK_TOKEN_REFRESH_MARGIN = int(os.getenv("WORK_TOKEN_REFRESH_MARGIN", "300"))
+BROKER_TIMEOUT = int(os.getenv("BROKER_TIMEOUT", "30"))
 
 work_token_cache = {}
+work_token_inflight = {}
+work_token_lock = threading.Lock()
+work_token_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+_broker_credential = None
+_broker_session = None
+
+class BrokerTokenError(Exception):
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+def get_work_token(pk: str) -> dict:
+    now = time.time()
+    with work_token_lock:
+        entry = work_token_cache.get(pk)
+        if entry and now < entry["refresh_at"]:
+            work_token_stats["hits"] += 1
+            return entry["tokens"]
+        flight = work_token_inflight.get(pk)
+        leader = flight is None
+        if leader:
+            flight = {"done": threading.Event(), "error": None}
+            work_token_inflight[pk] = flight
+        elif entry and now < entry["expires_at"]:
+            # Someone else is already refreshing, keep serving the still valid token meanwhile
+            work_token_stats["stale_hits"] += 1
+            return entry["tokens"]
+        work_token_stats["misses"] += 1
+
+    if not leader:
+        flight["done"].wait(timeout=BROKER_TIMEOUT + 5)
+        with work_token_lock:
+            entry = work_token_cache.get(pk)
+        if entry and time.time() < entry["expires_at"]:
+            return entry["tokens"]
+        raise flight["error"] or BrokerTokenError("Timed out waiting for broker token", status_code=504)
+
+    try:
+        tokens, expires_at = fetch_work_token(pk)
+        with work_token_lock:
+            work_token_cache[pk] = {
+                "tokens": tokens,
+                "expires_at": expires_at,
+                "refresh_at": max(time.time(), expires_at - WORK_TOKEN_REFRESH_MARGIN),
+            }
+            work_token_stats["refreshes"] += 1
+        return tokens
+    except Exception as e:
+        error = e if isinstance(e, BrokerTokenError) else BrokerTokenError(f"Error fetching broker token: {e}")
+        flight["error"] = error
+        with work_token_lock:
+            work_token_stats["errors"] += 1
+        if entry and time.time() < entry["expires_at"]:
+            logging.warning(f"Broker token refresh failed, serving cached token: {error}")
+            return entry["tokens"]
+        raise error
+    finally:
+        with work_token_lock:
+            work_token_inflight.pop(pk, None)
+        flight["done"].set()
+
+def fetch_work_token(pk: str):
+    global _broker_credential, _broker_session
+    if _broker_credential is None:
+        from azure.identity import ManagedIdentityCredential
+        _broker_credential = ManagedIdentityCredential()
+    if _broker_session is None:
+        _broker_session = requests.Session()
+
+    with dependency_span("credential"):
+        jwt = _broker_credential.get_token(os.environ["BROKER_SCOPE"]).token
+    with dependency_span("broker"):
+        resp = _broker_session.post(
+            f"{os.environ['BROKER_URL']}/token",
+            headers={"Authorization": f"Bearer {jwt}"},
+            json={"data": {"partitionKey": pk}},
+            timeout=BROKER_TIMEOUT,
+        )
+    if not resp.ok:
+        raise BrokerTokenError(resp.text, status_code=resp.status_code)
+    try:
+        tokens = resp.json()
+    except ValueError:
+        raise BrokerTokenError(resp.text, status_code=resp.status_code)
+    return tokens, work_token_expiry(tokens, time.time())
+
+def work_token_expiry(tokens: dict, now: float) -> float:
+    expires_at = now + WORK_TOKEN_DEFAULT_TTL
+    for key in ("expires_on", "expiresOn"):
+        if isinstance(tokens.get(key), (int, float)):
+            expires_at = min(expires_at, float(tokens[key]))
+    for value in tokens.values():
+        if not isinstance(value, str) or "se=" not in value:
+            continue
+        # SAS tokens carry their signed expiry in the "se" parameter
+        se = parse_qs(value.lstrip("?")).get("se")
+        if not se:
+            continue
+        try:
+            expiry = datetime.fromisoformat(se[0].replace("Z", "+00:00"))
+        except ValueError:
+            continue
+        if expiry.tzinfo is None:
+            expiry = expiry.replace(tzinfo=timezone.utc)
+        expires_at = min(expires_at, expiry.timestamp())
+    return expires_at
+
+def get_work_token_stats() -> dict:
+    with work_token_lock:
+        return dict(work_token_stats, cached_keys=len(work_token_cache))
+
+### INSTRUMENTATION ###
+
+# Each API request collects timed dependency spans, Cosmos request charge, item counts and bytes
+# moved in a context variable. The totals are returned in a Server-Timing header and written as one
+# structured log line. Pool workers run in a copy of the request context so their spans are counted
+# too. Spans are also exported over OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set and the
+# OpenTelemetry SDK is installed.
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+
+request_metrics = contextvars.ContextVar("request_metrics", default=None)
+_tracer = None
+
+def get_tracer():
+    global _tracer
+    if _tracer is None:
+        _tracer = False
+        if OTEL_EXPORTER_OTLP_ENDPOINT:
+            try:
+                from opentelemetry import trace
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            except ImportError as e:
+                logging.warning(f"OpenTelemetry export disabled: {e}")
+                return None
+            provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "generic-api")}))
+            provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+            trace.set_tracer_provider(provider)
+            _tracer = trace.get_tracer("function_app")
+    return _tracer or None
+
+def begin_request_metrics(event):
+    tracer = get_tracer()
+    root = tracer.start_as_current_span(event) if tracer else nullcontext()
+    root.__enter__()
+    metrics = {
+        "event": event,
+        "started": time.perf_counter(),
+        "spans": [],
+        "request_charge": 0.0,
+        "items": 0,
+        "bytes": 0,
+        "lock": threading.Lock(),
+        "root": root,
+    }
+    return request_metrics.set(metrics)
+
+def finish_request_metrics(token, response: func.HttpResponse) -> func.HttpResponse:
+    metrics = request_metrics.get()
+    request_metrics.reset(token)
+    total = (time.perf_counter() - metrics["started"]) * 1000
+    metrics["root"].__exit__(None, None, None)
+
+    with metrics["lock"]:
+        dependencies = {}
+        for name, duration in metrics["spans"]:
+            entry = dependencies.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+    timings = [f'{name};dur={duration:.1f};desc="{count}"' for name, (count, duration) in dependencies.items()]
+    timings.append(f"total;dur={total:.1f}")
+    if metrics["request_charge"]:
+        timings.append(f'ru;desc="{metrics["request_charge"]:.2f}"')
+    response.headers["Server-Timing"] = ", ".join(timings)
+
+    line = {
+        "event": metrics["event"],
+        "status": response.status_code,
+        "duration_ms": round(total, 1),
+        "dependencies": {name: {"calls": count, "duration_ms": round(duration, 1)} for name, (count, duration) in dependencies.items()},
+        "request_charge": round(metrics["request_charge"], 2),
+        "items": metrics["items"],
+        "bytes": metrics["bytes"],
+        # Process totals, so the broker hit rate and the RU/s per container can be charted
+        "work_tokens": get_work_token_stats(),
+    }
+    if metrics["request_charge"]:
+        line["cosmos"] = get_cosmos_stats()
+    logging.info("request_metrics %s", json.dumps(line))
+    return response
+
+@contextmanager
+def dependency_span(name, **attributes):
+    metrics = request_metrics.get()
+    tracer = get_tracer()
+    started = time.perf_counter()
+    with (tracer.start_as_current_span(name, attributes=attributes) if tracer else nullcontext()):
+        try:
+            yield
+        finally:
+            if metrics is not None:
+                duration = (time.perf_counter() - started) * 1000
+                with metrics["lock"]:
+                    metrics["spans"].append((name, duration))
+
+def record_usage(request_charge=None, items=0, bytes_transferred=0):
+    metrics = request_metrics.get()
+    if metrics is None:
+        return
+    with metrics["lock"]:
+        metrics["request_charge"] += request_charge or 0
+        metrics["items"] += items
+        metrics["bytes"] += bytes_transferred
+
+def in_request_context(fn):
+    # Worker threads do not inherit context variables, run fn in a copy of the caller's context
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(fn, *args)
+
+### COSMOS EXECUTION ###
+
+def parse_ru_limits(value) -> dict:
+    # A malformed app setting must not break module load, bad values are skipped with a warning
+    if not value:
+        return {}
+    try:
+        limits = json.loads(value)
+    except ValueError as e:
+        logging.warning(f"Ignoring COSMOS_RU_LIMITS, it is not valid JSON: {e}")
+        return {}
+    if not isinstance(limits, dict):
+        logging.warning("Ignoring COSMOS_RU_LIMITS, expected an object of container name to RU/s.")
+        return {}
+    parsed = {}
+    for name, limit in limits.items():
+        if isinstance(limit, (int, float)) and not isinstance(limit, bool) and limit >= 0:
+            parsed[name] = float(limit)
+        else:
+            logging.warning(f"Ignoring COSMOS_RU_LIMITS entry {name!r}, expected a non-negative number.")
+    return parsed
+
+# Cosmos calls go through a per-container limiter and a retry loop. Throttled (429) and transient
+# responses are retried after x-ms-retry-after-ms, or after a jittered exponential backoff, until
+# COSMOS_RETRY_DEADLINE has passed. The limiter is a token bucket in RU. Each call reserves the
+# recent average charge of the container, and the reservation is corrected to the real charge
+# afterwards. A container with no configured RU/s is not limited until it is throttled. After a
+# 429 its rate drops below the RU/s observed in the last window and climbs back while calls
+# succeed. The limiter is released after COSMOS_LIMITER_RELEASE_SECONDS without throttling.
+COSMOS_RETRY_DEADLINE = float(os.getenv("COSMOS_RETRY_DEADLINE", "30"))
+COSMOS_RETRY_BASE_DELAY = 0.1
+COSMOS_RETRY_MAX_DELAY = 5.0
+COSMOS_RETRY_STATUS_CODES = (408, 429, 449, 503)
+COSMOS_RU_PER_SECOND = float(os.getenv("COSMOS_RU_PER_SECOND", "0"))
+COSMOS_RU_LIMITS = parse_ru_limits(os.getenv("COSMOS_RU_LIMITS"))
+COSMOS_MIN_RU_PER_SECOND = 10.0
+COSMOS_RU_WINDOW = 10.0
+COSMOS_RU_BURST_SECONDS = 1.0
+COSMOS_LIMITER_RELEASE_SECONDS = 30.0
+
+cosmos_limiters = {}
+cosmos_limiter_lock = threading.Lock()
+
+class CosmosPages:
+    # Iterates query pages through the limiter, a throttled page is requested again from the last
+    # continuation token
+    def __init__(self, container, query_kwargs, continuation_token=None):
+        self.container = container
+        self.query_kwargs = dict(query_kwargs, response_hook=self.record)
+        self.continuation_token = continuation_token
+        self.charge = None
+        self.pages = None
+        self.deadline = time.monotonic() + COSMOS_RETRY_DEADLINE
+
+    def record(self, headers, _):
+        self.charge = request_charge(headers)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for attempt in itertools.count():
+            if self.pages is None:
+                self.pages = self.container.query_items(**self.query_kwargs).by_page(self.continuation_token)
+            estimate = cosmos_acquire(self.container.id, self.deadline)
+            self.charge = None
+            try:
+                with dependency_span("cosmos", operation="query"):
+                    page = list(next(self.pages))
+            except StopIteration:
+                cosmos_settle(self.container.id, estimate, self.charge)
+                raise
+            except exceptions.CosmosHttpResponseError as e:
+                cosmos_settle(self.container.id, estimate, None, throttled=e.status_code == 429)
+                delay = cosmos_retry_delay(e, attempt, self.deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                self.pages = None
+                continue
+            cosmos_settle(self.container.id, estimate, self.charge)
+            record_usage(request_charge=self.charge, items=len(page))
+            self.continuation_token = self.pages.continuation_token
+            return page
+
+def cosmos_call(container, method, *args, **kwargs):
+    deadline = time.monotonic() + COSMOS_RETRY_DEADLINE
+    hook = kwargs.pop("response_hook", None)
+    charge = {}
+
+    def record(headers, result):
+        charge["ru"] = request_charge(headers)
+        if hook:
+            hook(headers, result)
+
+    for attempt in itertools.count():
+        estimate = cosmos_acquire(container.id, deadline)
+        charge.clear()
+        try:
+            with dependency_span("cosmos", operation=method):
+                result = getattr(container, method)(*args, response_hook=record, **kwargs)
+        except exceptions.CosmosHttpResponseError as e:
+            cosmos_settle(container.id, estimate, None, throttled=e.status_code == 429)
+            delay = cosmos_retry_delay(e, attempt, deadline)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        cosmos_settle(container.id, estimate, charge.get("ru"))
+        record_usage(request_charge=charge.get("ru"))
+        return result
+
+def request_charge(headers):
+    try:
+        return float(headers.get("x-ms-request-charge"))
+    except (TypeError, ValueError):
+        return None
+
+def cosmos_retry_delay(error, attempt, deadline):
+    if error.status_code not in COSMOS_RETRY_STATUS_CODES:
+        return None
+    headers = getattr(error, "headers", None) or {}
+    try:
+        retry_after = float(headers.get("x-ms-retry-after-ms")) / 1000
+        delay = retry_after + random.uniform(0, 0.1 * retry_after + 0.01)
+    except (TypeError, ValueError):
+        delay = random.uniform(0, min(COSMOS_RETRY_MAX_DELAY, COSMOS_RETRY_BASE_DELAY * 2 ** attempt))
+    if time.monotonic() + delay > deadline:
+        return None
+    return delay
+
+def cosmos_limiter(name):
+    limiter = cosmos_limiters.get(name)
+    if limiter is None:
+        ceiling = float(COSMOS_RU_LIMITS.get(name, COSMOS_RU_PER_SECOND)) or None
+        limiter = {
+            "rate": ceiling,
+            "ceiling": ceiling,
+            "tokens": (ceiling or 0) * COSMOS_RU_BURST_SECONDS,
+            "updated": time.monotonic(),
+            "estimate": 5.0,
+            "charges": deque(),
+            "requests": 0,
+            "throttled": 0,
+            "request_charge": 0.0,
+            "decreased_at": 0.0,
+            "increased_at": 0.0,
+        }
+        cosmos_limiters[name] = limiter
+    return limiter
+
+def cosmos_reserve(name, deadline):
+    # Returns the reserved estimate and how long to wait before sending the request
+    with cosmos_limiter_lock:
+        limiter = cosmos_limiter(name)
+        estimate = limiter["estimate"]
+        if limiter["rate"] is None:
+            return estimate, 0
+        now = time.monotonic()
+        rate = limiter["rate"]
+        limiter["tokens"] = min(rate * COSMOS_RU_BURST_SECONDS, limiter["tokens"] + (now - limiter["updated"]) * rate)
+        limiter["updated"] = now
+        limiter["tokens"] -= estimate
+        wait = -limiter["tokens"] / rate if limiter["tokens"] < 0 else 0
+    # Past the deadline the request is sent anyway and the service decides
+    return estimate, max(0, min(wait, deadline - time.monotonic()))
+
+def cosmos_acquire(name, deadline):
+    estimate, wait = cosmos_reserve(name, deadline)
+    if wait:
+        time.sleep(wait)
+    return estimate
+
+def cosmos_settle(name, estimate, charge, throttled=False):
+    with cosmos_limiter_lock:
+        limiter = cosmos_limiter(name)
+        now = time.monotonic()
+        charges = limiter["charges"]
+        limiter["requests"] += 1
+        if charge is not None:
+            if limiter["rate"] is not None:
+                limiter["tokens"] -= charge - estimate
+            limiter["estimate"] = 0.8 * limiter["estimate"] + 0.2 * charge
+            limiter["request_charge"] += charge
+            charges.append((now, charge))
+        while charges and charges[0][0] < now - COSMOS_RU_WINDOW:
+            charges.popleft()
+        observed = observed_ru_per_second(charges, now)
+
+        if throttled:
+            limiter["throttled"] += 1
+            # Requests already in flight are throttled together, back off once per burst
+            if now - limiter["decreased_at"] < 1.0:
+                return
+            limiter["decreased_at"] = now
+            candidates = [rate for rate in (limiter["rate"], observed, limiter["ceiling"]) if rate]
+            limiter["rate"] = max(COSMOS_MIN_RU_PER_SECOND, 0.7 * min(candidates, default=COSMOS_MIN_RU_PER_SECOND))
+            limiter["tokens"] = min(limiter["tokens"], 0)
+            limiter["updated"] = now
+        elif charge is not None and limiter["rate"] is not None:
+            if not limiter["ceiling"] and now - limiter["decreased_at"] > COSMOS_LIMITER_RELEASE_SECONDS:
+                limiter["rate"] = None
+            else:
+                # Grows by about 10% per second while requests succeed
+                limiter["rate"] *= 1 + 0.1 * min(1.0, now - limiter["increased_at"])
+                if limiter["ceiling"]:
+                    limiter["rate"] = min(limiter["rate"], limiter["ceiling"])
+            limiter["increased_at"] = now
+
+def observed_ru_per_second(charges, now):
+    if not charges:
+        return 0.0
+    # A window that has not filled up yet is averaged over the time it covers
+    return sum(charge for _, charge in charges) / min(COSMOS_RU_WINDOW, max(1.0, now - charges[0][0]))
+
+def get_cosmos_stats() -> dict:
+    with cosmos_limiter_lock:
+        return {
+            name: {
+                "rate": limiter["rate"],
+                "ru_per_second": round(observed_ru_per_second(limiter["charges"], time.monotonic()), 2),
+                "requests": limiter["requests"],
+                "throttled": limiter["throttled"],
+                "request_charge": round(limiter["request_charge"], 2),
+            }
+            for name, limiter in cosmos_limiters.items()
+        }
+
+### CLIENT REGISTRY ###
+
+# SDK clients are expensive to build (credential discovery, Cosmos account lookup, TLS handshakes),
+# so they are created once per process and shared across invocations. Clients authenticated with a
+# broker resource token are rebuilt when the token rotates.
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "32"))
+# Throttling is retried by cosmos_call, keep the SDK's own throttle retries short
+COSMOS_CLIENT_RETRY = {"retry_throttle_total": 1, "retry_throttle_backoff_max": 1}
+
+client_registry = {}
+client_registry_lock = threading.RLock()
+closing_clients = set()
+EVICTED_CLIENT_CLOSE_DELAY = 60
+
+_default_credential = None
+_azure_session = None
+
+def get_default_credential():
+    global _default_credential
+    with client_registry_lock:
+        if _default_credential is None:
+            from azure.identity import DefaultAzureCredential
+            _default_credential = DefaultAzureCredential()
+        return _default_credential
+
+def get_azure_transport():
+    from azure.core.pipeline.transport import RequestsTransport
+    global _azure_session
+    with client_registry_lock:
+        if _azure_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=CLIENT_POOL_SIZE, pool_maxsize=CLIENT_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _azure_session = session
+    return RequestsTransport(session=_azure_session, session_owner=False)
+
+def get_registered_client(key, version, factory) -> dict:
+    with client_registry_lock:
+        entry = client_registry.get(key)
+        if entry and entry["version"] == version:
+            return entry
+    client = factory()
+    with client_registry_lock:
+        entry = client_registry.get(key)
+        if entry and entry["version"] == version:
+            return entry
+        if entry:
+            logging.info(f"Credential rotated, evicting client {key[:2]}")
+            close_evicted_client(entry["client"])
+        entry = {"version": version, "client": client, "children": {}}
+        client_registry[key] = entry
+        return entry
+
+def close_evicted_client(client):
+    # Sync clients share the pooled transport and are left to the garbage collector. Async clients
+    # own an aiohttp session that leaks unless closed, requests still running on the old client
+    # get EVICTED_CLIENT_CLOSE_DELAY seconds to finish first.
+    close = getattr(client, "close", None)
+    if not asyncio.iscoroutinefunction(close):
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        logging.warning(f"Evicted {type(client).__name__} outside an event loop, it is not closed")
+        return
+
+    async def close_later():
+        await asyncio.sleep(EVICTED_CLIENT_CLOSE_DELAY)
+        try:
+            await close()
+        except Exception as e:
+            logging.warning(f"Error closing evicted {type(client).__name__}: {e}")
+
+    task = loop.create_task(close_later())
+    closing_clients.add(task)
+    task.add_done_callback(closing_clients.discard)
+
+def get_cosmos_container(container_name, resource_token=None):
+    from azure.cosmos import CosmosClient
+    if resource_token is None:
+        key = ("cosmos", COSMOS_DB_ENDPOINT, "aad")
+        credential = get_default_credential()
+    else:
+        key = ("cosmos", COSMOS_DB_ENDPOINT, "resource_token", container_name)
+        credential = {f"dbs/{COSMOS_DB_DATABASE}/colls/{container_name}": resource_token}
+
+    entry = get_registered_client(
+        key,
+        resource_token,
+        lambda: CosmosClient(COSMOS_DB_ENDPOINT, credential=credential, transport=get_azure_transport(), **COSMOS_CLIENT_RETRY),
+    )
+    containers = entry["children"]
+    container = containers.get(container_name)
+    if container is None:
+        container = entry["client"].get_database_client(COSMOS_DB_DATABASE).get_container_client(container_name)
+        containers[container_name] = container
+    return container
+
+def get_blob_service_client(account_name):
+    from azure.storage.blob import BlobServiceClient
+    account_url = f"https://{account_name}.blob.core.windows.net"
+    entry = get_registered_client(
+        ("blob", account_url, "aad"),
+        None,
+        lambda: BlobServiceClient(account_url=account_url, credential=get_default_credential(), transport=get_azure_transport()),
+    )
+    return entry["client"]
+
+def get_aci_client(subscription_id):
+    from azure.mgmt.containerinstance import ContainerInstanceManagementClient
+    entry = get_registered_client(
+        ("aci", subscription_id, "aad"),
+        None,
+        lambda: ContainerInstanceManagementClient(get_default_credential(), subscription_id, transport=get_azure_transport()),
+    )
+    return entry["client"]
+
+def get_logs_client():
+    from azure.monitor.query import LogsQueryClient
+    entry = get_registered_client(
+        ("logs", "aad"),
+        None,
+        lambda: LogsQueryClient(get_default_credential(), transport=get_azure_transport()),
+    )
+    return entry["client"]
+
+### ASYNC API ###
+
+# generic_api_async serves the same events from the event loop. Events with an async implementation
+# await the .aio SDK clients and an aiohttp broker client, the rest run their sync handler on a
+# worker thread. One worker then holds many requests that are waiting on Cosmos, Blob or the broker.
+async_event_handlers = {}
+work_token_tasks = {}
+
+_broker_credential_async = None
+_broker_http_async = None
+_default_credential_async = None
+
+def api_event_async(name):
+    def register(fn):
+        async_event_handlers[name] = fn
+        return fn
+    return register
+
+@app.function_name(name="generic_api_async")
+@app.route(route="api/async")
+async def async_handler(req: func.HttpRequest) -> func.HttpResponse:
+    request = parse_api_request(req)
+    if isinstance(request, func.HttpResponse):
+        return request
+
+    import traceback
+    metrics_token = begin_request_metrics(request.event)
+    try:
+        handler_async = async_event_handlers.get(request.event)
+        if handler_async is None:
+            response = await asyncio.to_thread(event_handlers[request.event]["handler"], request)
+        else:
+            response = await handler_async(request)
+    except Exception as e:
+        tb = traceback.format_exc()
+        response = func.HttpResponse(json.dumps({"result":f"Api error: {e}", "tb": tb}), status_code=500)
+    return finish_request_metrics(metrics_token, response)
+
+async def get_work_token_async(pk: str) -> dict:
+    # Shares the token cache with get_work_token, concurrent misses await a single refresh task
+    now = time.time()
+    with work_token_lock:
+        entry = work_token_cache.get(pk)
+        if entry and now < entry["refresh_at"]:
+            work_token_stats["hits"] += 1
+            return entry["tokens"]
+        task = work_token_tasks.get(pk)
+        if task is not None and entry and now < entry["expires_at"]:
+            work_token_stats["stale_hits"] += 1
+            return entry["tokens"]
+        work_token_stats["misses"] += 1
+    if task is None:
+        task = asyncio.ensure_future(refresh_work_token_async(pk))
+        work_token_tasks[pk] = task
+        task.add_done_callback(lambda _: work_token_tasks.pop(pk, None))
+
+    try:
+        return await asyncio.shield(task)
+    except BrokerTokenError as error:
+        if entry and time.time() < entry["expires_at"]:
+            logging.warning(f"Broker token refresh failed, serving cached token: {error}")
+            return entry["tokens"]
+        raise
+
+async def refresh_work_token_async(pk: str) -> dict:
+    try:
+        tokens, expires_at = await fetch_work_token_async(pk)
+    except Exception as e:
+        with work_token_lock:
+            work_token_stats["errors"] += 1
+        raise e if isinstance(e, BrokerTokenError) else BrokerTokenError(f"Error fetching broker token: {e}")
+    with work_token_lock:
+        work_token_cache[pk] = {
+            "tokens": tokens,
+            "expires_at": expires_at,
+            "refresh_at": max(time.time(), expires_at - WORK_TOKEN_REFRESH_MARGIN),
+        }
+        work_token_stats["refreshes"] += 1
+    return tokens
+
+async def fetch_work_token_async(pk: str):
+    import aiohttp
+    from azure.identity.aio import ManagedIdentityCredential as AsyncManagedIdentityCredential
+    global _broker_credential_async, _broker_http_async
+    if _broker_credential_async is None:
+        _broker_credential_async = AsyncManagedIdentityCredential()
+    if _broker_http_async is None or _broker_http_async.closed:
+        _broker_http_async = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=BROKER_TIMEOUT))
+
+    with dependency_span("credential"):
+        jwt = (await _broker_credential_async.get_token(os.environ["BROKER_SCOPE"])).token
+    with dependency_span("broker"):
+        async with _broker_http_async.post(
+            f"{os.environ['BROKER_URL']}/token",
+            headers={"Authorization": f"Bearer {jwt}"},
+            json={"data": {"partitionKey": pk}},
+        ) as resp:
+            text = await resp.text()
+        if resp.status >= 400:
+            raise BrokerTokenError(text, status_code=resp.status)
+    try:
+        tokens = json.loads(text)
+    except ValueError:
+        raise BrokerTokenError(text, status_code=resp.status)
+    return tokens, work_token_expiry(tokens, time.time())
+
+def get_default_credential_async():
+    from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+    global _default_credential_async
+    with client_registry_lock:
+        if _default_credential_async is None:
+            _default_credential_async = AsyncDefaultAzureCredential()
+        return _default_credential_async
+
+def get_async_cosmos_container(container_name, resource_token=None):
+    from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+    if resource_token is None:
+        key = ("cosmos-aio", COSMOS_DB_ENDPOINT, "aad")
+        credential = get_default_credential_async()
+    else:
+        key = ("cosmos-aio", COSMOS_DB_ENDPOINT, "resource_token", container_name)
+        credential = {f"dbs/{COSMOS_DB_DATABASE}/colls/{container_name}": resource_token}
+
+    entry = get_registered_client(key, resource_token, lambda: AsyncCosmosClient(COSMOS_DB_ENDPOINT, credential=credential, **COSMOS_CLIENT_RETRY))
+    containers = entry["children"]
+    container = containers.get(container_name)
+    if container is None:
+        container = entry["client"].get_database_client(COSMOS_DB_DATABASE).get_container_client(container_name)
+        containers[container_name] = container
+    return container
+
+def get_async_blob_service_client(account_name):
+    from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+    account_url = f"https://{account_name}.blob.core.windows.net"
+    entry = get_registered_client(
+        ("blob-aio", account_url, "aad"),
+        None,
+        lambda: AsyncBlobServiceClient(account_url=account_url, credential=get_default_credential_async()),
+    )
+    return entry["client"]
+
+async def get_user_delegation_key_async(account_name, valid_until):
+    entry, window = cached_user_delegation_key(account_name, valid_until)
+    if entry is None:
+        with dependency_span("blob"):
+            key = await get_async_blob_service_client(account_name).get_user_delegation_key(
+                key_start_time=window[0],
+                key_expiry_time=window[1]
+            )
+        entry = store_user_delegation_key(account_name, key, window[1])
+    return entry
+
+@api_event_async("insert_db")
+async def insert_db_async(request: ApiRequest) -> func.HttpResponse:
+    if isinstance(request.data, list):
+        return await asyncio.to_thread(insert_db, request)
+    table_key = request.body['table']
+    container_name = tables[table_key]
+    item = request.data
+    item.update({'id': get_id(item)})
+
+    principal = os.getenv("AZURE_SUBSCRIPTION_ID")
+    if not principal:
+        return func.HttpResponse("Missing AZURE_SUBSCRIPTION_ID", status_code=500)
+
+    try:
+        tokens = await get_work_token_async(principal)
+    except BrokerTokenError as e:
+        return func.HttpResponse(str(e), status_code=e.status_code)
+
+    container = get_async_cosmos_container(container_name, tokens[container_name])
+    try:
+        response = await cosmos_call_async(container, "upsert_item", body=item)
+        return func.HttpResponse(json.dumps(response), status_code=200)
+    except exceptions.CosmosHttpResponseError as e:
+        logging.error("Error inserting item:", exc_info=e)
+        return func.HttpResponse(f'Error inserting item: {e}', status_code=500)
+    finally:
+        invalidate_catalog_cache(table_key)
 
-def get_work_token(pk: str) -> str:
-    cred  = ManagedIdentityCredential()
-    jwt   = cred.get_token(os.environ["BROKER_SCOPE"]).token
-    subId = pk
+@api_event_async("transact_write")
+async def transact_write_async(request: ApiRequest) -> func.HttpResponse:
+    principal = os.getenv("AZURE_SUBSCRIPTION_ID")
+    if not principal:
+        return func.HttpResponse("Missing AZURE_SUBSCRIPTION_ID", status_code=500)
 
-    resp = requests.post(
-        f"{os.environ['BROKER_URL']}/token",
-        headers={"Authorization": f"Bearer {jwt}"},
-        json={"data": {"partitionKey": subId}},
-        timeout=30,
+    try:
+        tokens = await get_work_token_async(principal)
+    except BrokerTokenError as e:
+        return func.HttpResponse(str(e), status_code=e.status_code)
+
+    containers = {
+        container_name: get_async_cosmos_container(container_name, tokens[container_name])
+        for container_name in write_item_containers(request.body['items'])
+    }
+    paths = {container_name: await container_partition_key_path_async(container_name, container) for container_name, container in containers.items()}
+    groups = group_write_items(request.body['items'], principal, paths)
+    results = await asyncio.gather(*(
+        execute_write_group_async(containers[container_name], partition_key, entries)
+        for (container_name, partition_key), entries in groups.items()
+    ))
+    return write_results_response(request.body['items'], results)
+
+async def container_partition_key_path_async(container_name, container):
+    path = partition_key_paths.get(container_name)
+    if path is None:
+        try:
+            path = (await container.read())["partitionKey"]["paths"][0]
+        except exceptions.CosmosHttpResponseError as e:
+            logging.warning(f"Could not read partition key of {container_name}: {e}")
+            return None
+        partition_key_paths[container_name] = path
+    return path
+
+async def execute_write_group_async(container, partition_key, entries):
+    if partition_key is None:
+        return list(await asyncio.gather(*(execute_write_item_async(container, entry) for entry in entries)))
+    results = []
+    for start in range(0, len(entries), COSMOS_BATCH_LIMIT):
+        chunk = entries[start:start + COSMOS_BATCH_LIMIT]
+        try:
+            await cosmos_call_async(
+                container,
+                "execute_item_batch",
+                batch_operations=[batch_operation for _, (_, _, batch_operation) in chunk],
+                partition_key=partition_key,
+            )
+            results.extend(
+                (index, {"operation": operation, "status": "Success", "item_id": item_id})
+                for index, (operation, item_id, _) in chunk
+            )
+        except (exceptions.CosmosBatchOperationError, exceptions.CosmosHttpResponseError) as e:
+            results.extend((index, {"error": str(e)}) for index, _ in chunk)
+    return results
+
+async def execute_write_item_async(container, entry):
+    index, (operation, item_id, (_, (put_item,))) = entry
+    try:
+        await cosmos_call_async(container, "upsert_item", body=put_item)
+        return index, {"operation": operation, "status": "Success", "item_id": item_id}
+    except exceptions.CosmosHttpResponseError as e:
+        return index, {"error": str(e)}
+
+@api_event_async("read_db")
+async def read_db_async(request: ApiRequest) -> func.HttpResponse:
+    query = request.data['query']
+    return await query_db_async(request, query, match_point_read(query))
+
+@api_event_async("get_item")
+async def get_item_async(request: ApiRequest) -> func.HttpResponse:
+    data = request.data
+    query = {
+        "query": "SELECT * FROM c WHERE c.PK = @pk AND c.SK = @sk",
+        "parameters": [{"name": "@pk", "value": data['PK']}, {"name": "@sk", "value": data['SK']}],
+    }
+    return await query_db_async(request, query, (data['PK'], data['SK']))
+
+async def query_db_async(request: ApiRequest, query, point_key=None) -> func.HttpResponse:
+    table_key = request.body['table']
+    container_name = tables[table_key]
+    principal = os.getenv("AZURE_SUBSCRIPTION_ID")
+    if not principal:
+        return func.HttpResponse("Missing AZURE_SUBSCRIPTION_ID", status_code=500)
+    try:
+        paginated, page_size, continuation_token = read_db_paging(request.data)
+    except ValueError:
+        return func.HttpResponse("Invalid page_size or continuation_token.", status_code=400)
+
+    cache_key = None
+    if table_key in CATALOG_TABLES and not paginated and CATALOG_CACHE_TTL > 0:
+        cache_key = (table_key, normalise_query(query))
+        cached = catalog_cache_get(cache_key)
+        if cached:
+            return catalog_cache_response(request, cached, "HIT")
+
+    if table_key in CATALOG_TABLES:
+        container = get_async_cosmos_container(container_name)
+        partition_key = None
+    else:
+        try:
+            tokens = await get_work_token_async(principal)
+        except BrokerTokenError as e:
+            return func.HttpResponse(str(e), status_code=e.status_code)
+        container = get_async_cosmos_container(container_name, tokens[container_name])
+        partition_key = principal
+
+    q_kwargs = query_kwargs(query, page_size, partition_key)
+
+    try:
+        if point_key and not continuation_token and partition_key is None:
+            path = await container_partition_key_path_async(container_name, container)
+            partition_key = partition_key_for_path(path, point_key) if path else None
+        if point_key and not continuation_token and partition_key is not None:
+            items = await point_read_async(container, point_key, partition_key)
+            return point_read_response(request, items, paginated, cache_key)
+
+        pages = CosmosPagesAsync(container, q_kwargs, continuation_token)
+        if paginated:
+            items = []
+            async for page in pages:
+                items = page
+                break
+            return query_page_response(items, pages.continuation_token)
+        body, count = await encode_json_pages_async(pages)
+        return query_items_response(request, body, count, cache_key)
+    except exceptions.CosmosHttpResponseError as e:
+        return query_error_response(e)
+
+async def point_read_async(container, point_key, partition_key):
+    pk, sk = point_key
+    try:
+        item = await cosmos_call_async(container, "read_item", item=get_id({"PK": pk, "SK": sk}), partition_key=partition_key)
+    except exceptions.CosmosResourceNotFoundError:
+        return []
+    return point_read_items(item, point_key)
+
+@api_event_async("generate_presigned_url")
+async def generate_presigned_url_async(request: ApiRequest) -> func.HttpResponse:
+    return await presigned_urls_async(request, [request.data], single=True)
+
+@api_event_async("generate_presigned_urls")
+async def generate_presigned_urls_async(request: ApiRequest) -> func.HttpResponse:
+    objects = request.data['objects']
+    if not isinstance(objects, list) or not all(isinstance(obj, dict) for obj in objects):
+        return func.HttpResponse("Expected a list of {bucket_name, key} objects in data.objects.", status_code=400)
+    return await presigned_urls_async(request, objects)
+
+async def presigned_urls_async(request: ApiRequest, objects, single=False) -> func.HttpResponse:
+    default_expires_in = request.data.get("expires_in", 3600)
+    account_name = os.getenv("PUBLIC_STORAGE_ACCOUNT_NAME")
+    principal = os.getenv("AZURE_SUBSCRIPTION_ID")
+    now = datetime.utcnow()
+
+    targets = []
+    for obj in objects:
+        try:
+            container_name = presign_container(obj.get("bucket_name"), obj.get("key"))
+            expiry = now + timedelta(seconds=int(obj.get("expires_in", default_expires_in)))
+            targets.append((container_name, expiry, None))
+        except ValueError as e:
+            targets.append((None, None, str(e)))
+
+    # The broker token and the delegation key are independent, fetch them concurrently
+    workload = any(target[0] and target[0].startswith("workload-") for target in targets)
+    public = [target[1] for target in targets if target[0] and not target[0].startswith("workload-")]
+    fetched = await asyncio.gather(
+        get_work_token_async(principal) if workload else asyncio.sleep(0),
+        get_user_delegation_key_async(account_name, max(public)) if public else asyncio.sleep(0),
+        return_exceptions=True,
     )
+    tokens, delegation_key = fetched
 
-    return resp
+    urls = []
+    for index, (obj, (container_name, expiry, error)) in enumerate(zip(objects, targets)):
+        try:
+            if error:
+                raise ValueError(error)
+            if container_name.startswith("workload-"):
+                if isinstance(tokens, Exception):
+                    raise tokens
+                url = workload_blob_url(container_name, obj["key"], tokens)
+            else:
+                if isinstance(delegation_key, Exception):
+                    raise delegation_key
+                url = sign_blob_url(account_name, container_name, obj["key"], expiry, delegation_key)
+        except (BrokerTokenError, ValueError) as e:
+            if single:
+                return func.HttpResponse(str(e), status_code=getattr(e, "status_code", 400))
+            urls.append({"index": index, "error": str(e)})
+            continue
+        if single:
+            return func.HttpResponse(json.dumps({"url": url}), status_code=200, mimetype="application/json")
+        urls.append({"index": index, "bucket_name": obj.get("bucket_name"), "key": obj.get("key"), "url": url})
+    return func.HttpResponse(json.dumps({"urls": urls}), status_code=200, mimetype="application/json")
+
+@api_event_async("job_status")
+async def job_status_async(request: ApiRequest) -> func.HttpResponse:
+    # ACI reads stay on a worker thread, a long poll waits on the event loop instead of holding one
+    try:
+        job_ids, wait = job_status_request(request.data)
+    except (ValueError, TypeError) as e:
+        return func.HttpResponse(str(e), status_code=400)
+
+    valid = [job_id for job_id in job_ids if JOB_ID_PATTERN.match(job_id)]
+    deadline = time.monotonic() + wait
+    statuses = await asyncio.to_thread(job_statuses, valid)
+    initial = {job_id: status.get("state") for job_id, status in statuses.items()}
+    while not job_status_settled(statuses, initial, deadline):
+        await asyncio.sleep(max(0.0, min(JOB_STATUS_POLL_INTERVAL, deadline - time.monotonic())))
+        statuses = await asyncio.to_thread(job_statuses, valid)
+    return job_status_response(job_ids, statuses)
+
+async def cosmos_call_async(container, method, *args, **kwargs):
+    deadline = time.monotonic() + COSMOS_RETRY_DEADLINE
+    hook = kwargs.pop("response_hook", None)
+    charge = {}
+
+    def record(headers, result):
+        charge["ru"] = request_charge(headers)
+        if hook:
+            hook(headers, result)
+
+    for attempt in itertools.count():
+        estimate, wait = cosmos_reserve(container.id, deadline)
+        if wait:
+            await asyncio.sleep(wait)
+        charge.clear()
+        try:
+            with dependency_span("cosmos", operation=method):
+                result = await getattr(container, method)(*args, response_hook=record, **kwargs)
+        except exceptions.CosmosHttpResponseError as e:
+            cosmos_settle(container.id, estimate, None, throttled=e.status_code == 429)
+            delay = cosmos_retry_delay(e, attempt, deadline)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        cosmos_settle(container.id, estimate, charge.get("ru"))
+        record_usage(request_charge=charge.get("ru"))
+        return result
+
+class CosmosPagesAsync(CosmosPages):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        for attempt in itertools.count():
+            if self.pages is None:
+                self.pages = self.container.query_items(**self.query_kwargs).by_page(self.continuation_token)
+            estimate, wait = cosmos_reserve(self.container.id, self.deadline)
+            if wait:
+                await asyncio.sleep(wait)
+            self.charge = None
+            try:
+                with dependency_span("cosmos", operation="query"):
+                    page = [item async for item in await self.pages.__anext__()]
+            except StopAsyncIteration:
+                cosmos_settle(self.container.id, estimate, self.charge)
+                raise
+            except exceptions.CosmosHttpResponseError as e:
+                cosmos_settle(self.container.id, estimate, None, throttled=e.status_code == 429)
+                delay = cosmos_retry_delay(e, attempt, self.deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                self.pages = None
+                continue
+            cosmos_settle(self.container.id, estimate, self.charge)
+            record_usage(request_charge=self.charge, items=len(page))
+            self.continuation_token = self.pages.continuation_token
+            return page
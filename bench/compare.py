@@ -0,0 +1,65 @@
+# Compares two bench/run.py reports scenario by scenario.
+#
+#   python bench/compare.py before.json after.json [--threshold 10]
+#
+# Exits non-zero when a scenario's p50 latency or peak memory grew by more than --threshold percent,
+# or when it has more errors than before.
+
+import sys
+import json
+import argparse
+
+def change(before, after):
+    if before is None or after is None:
+        return None
+    if before == 0:
+        return 0.0 if after == 0 else float("inf")
+    return (after - before) / before * 100
+
+def format_change(value):
+    return "n/a" if value is None else f"{value:+.1f}%"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports.")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, help="Fail on p50 or peak memory regressions above this percentage")
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"{'scenario':36} {'p50 ms':>20} {'p99 ms':>20} {'peak memory':>12}  calls per op")
+    regressions = []
+    for name in sorted(set(before["scenarios"]) | set(after["scenarios"])):
+        old, new = before["scenarios"].get(name), after["scenarios"].get(name)
+        if old is None or new is None:
+            print(f"{name:36} {'only in ' + ('after' if old is None else 'before'):>20}")
+            continue
+        p50 = change(old["latency_ms"]["p50"], new["latency_ms"]["p50"])
+        p99 = change(old["latency_ms"]["p99"], new["latency_ms"]["p99"])
+        memory = change(old["peak_memory_bytes"], new["peak_memory_bytes"])
+        calls = {
+            dependency: round(new["calls_per_op"].get(dependency, 0) - old["calls_per_op"].get(dependency, 0), 2)
+            for dependency in set(old["calls_per_op"]) | set(new["calls_per_op"])
+        }
+        calls = ", ".join(f"{dependency} {delta:+g}" for dependency, delta in sorted(calls.items()) if delta)
+        print(
+            f"{name:36} {new['latency_ms']['p50']:>11} {format_change(p50):>8} "
+            f"{new['latency_ms']['p99']:>11} {format_change(p99):>8} {format_change(memory):>12}  {calls or '='}"
+        )
+        if new["errors"] > old["errors"]:
+            regressions.append(f"{name}: {new['errors']} errors, was {old['errors']}")
+        if args.threshold is not None:
+            for label, value in (("p50", p50), ("peak memory", memory)):
+                if value is not None and value > args.threshold:
+                    regressions.append(f"{name}: {label} {format_change(value)}")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
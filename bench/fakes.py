@@ -0,0 +1,709 @@
+import re
+import sys
+import asyncio
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+from azure.cosmos import exceptions
+
+# Latency in milliseconds per call, and throughput in MiB/s for calls that move data
+DEFAULT_LATENCY = {
+    "broker": 40.0,
+    "credential": 2.0,
+    "cosmos": 6.0,
+    "blob": 12.0,
+    "download": 20.0,
+    "aci": 250.0,
+    "logs": 300.0,
+}
+DEFAULT_BANDWIDTH = {"blob": 200.0, "download": 100.0, "cosmos": 50.0}
+
+class Latency:
+    def __init__(self, latency=None, bandwidth=None, scale=1.0, jitter=0.2, seed=0):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.bandwidth = dict(DEFAULT_BANDWIDTH, **(bandwidth or {}))
+        self.scale = scale
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def delay(self, name, nbytes=0) -> float:
+        seconds = self.latency.get(name, 0.0) / 1000
+        if nbytes and self.bandwidth.get(name):
+            seconds += nbytes / (self.bandwidth[name] * 1024 * 1024)
+        with self.lock:
+            return seconds * self.scale * (1 + self.random.uniform(-self.jitter, self.jitter))
+
+    def wait(self, name, nbytes=0):
+        seconds = self.delay(name, nbytes)
+        if seconds <= 0:
+            return
+        owed = getattr(self.local, "owed", None)
+        if owed is None:
+            time.sleep(seconds)
+        else:
+            self.local.owed = owed + seconds
+
+    async def deferred(self, fn, *args, **kwargs):
+        # Runs a sync fake on the event loop thread without sleeping, then awaits the latency it
+        # would have slept for. This is how the async stand-ins wrap the sync ones.
+        self.local.owed = 0.0
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            owed, self.local.owed = self.local.owed, None
+            if owed > 0:
+                await asyncio.sleep(owed)
+        return result
+
+class Calls:
+    # Downstream call counter shared by all fakes, keyed "<dependency>.<operation>"
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counts[name] += count
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(sorted(self.counts.items()))
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+class FakeCredential:
+    def __init__(self, env):
+        self.env = env
+
+    def get_token(self, *scopes, **kwargs):
+        self.env.calls.add("credential.get_token")
+        self.env.latency.wait("credential")
+        return SimpleNamespace(token="bench-jwt", expires_on=int(time.time()) + 3600)
+
+class FakeAsync:
+    # Async view of a sync fake, every method becomes a coroutine except the ones named in `sync`
+    def __init__(self, target, env, sync=()):
+        self.target = target
+        self.env = env
+        self.sync = set(sync)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if not callable(attribute) or name in self.sync:
+            return attribute
+
+        async def call(*args, **kwargs):
+            return await self.env.latency.deferred(attribute, *args, **kwargs)
+        return call
+
+    async def close(self):
+        pass
+
+### COSMOS ###
+
+CONDITION = re.compile(r"""(\w+)\.(\w+)\s*=\s*(?:'([^']*)'|"([^"]*)"|(@\w+))""")
+
+def item_size(item) -> int:
+    return len(json.dumps(item, default=str))
+
+class FakeCosmosContainer:
+    # In-memory container keyed by (partition key value, id). Charges follow the rough shape of
+    # Cosmos pricing, and ru_per_second enables 429 responses once the per-second budget is spent.
+    # Like Cosmos, writes whose document does not carry the partition key they were sent with fail.
+    def __init__(self, env, name, partition_key_path="/PK", ru_per_second=None):
+        self.env = env
+        self.id = name
+        self.partition_key_path = partition_key_path
+        self.ru_per_second = ru_per_second
+        self.items = {}
+        self.lock = threading.Lock()
+        self.window = [0.0, 0.0]
+
+    def partition_key(self, item):
+        return item.get(self.partition_key_path.lstrip("/"))
+
+    def check_partition_key(self, item, partition_key):
+        if self.partition_key(item) != partition_key:
+            raise exceptions.CosmosHttpResponseError(
+                status_code=400,
+                message=f"PartitionKey extracted from document doesn't match the one specified in the header ({self.partition_key_path}).",
+            )
+
+    def charge(self, ru, response_hook, result):
+        with self.lock:
+            now = time.monotonic()
+            if self.ru_per_second:
+                if now - self.window[0] >= 1.0:
+                    self.window = [now, 0.0]
+                if self.window[1] + ru > self.ru_per_second:
+                    retry_after = max(1, int((1.0 - (now - self.window[0])) * 1000))
+                    self.env.calls.add("cosmos.throttled")
+                    error = exceptions.CosmosHttpResponseError(status_code=429, message="Request rate is large.")
+                    error.headers = {"x-ms-retry-after-ms": str(retry_after)}
+                    raise error
+                self.window[1] += ru
+        if response_hook:
+            response_hook({"x-ms-request-charge": f"{ru:.2f}"}, result)
+
+    def call(self, operation, nbytes=0):
+        self.env.calls.add(f"cosmos.{operation}")
+        self.env.latency.wait("cosmos", nbytes)
+
+    def read(self, **kwargs):
+        self.call("read")
+        return {"id": self.id, "partitionKey": {"paths": [self.partition_key_path], "kind": "Hash"}}
+
+    def upsert_item(self, body, response_hook=None, **kwargs):
+        size = item_size(body)
+        self.call("upsert_item", size)
+        if "partition_key" in kwargs:
+            self.check_partition_key(body, kwargs["partition_key"])
+        self.charge(5.0 + 5.0 * size / 1024, response_hook, body)
+        with self.lock:
+            self.items[(self.partition_key(body), body["id"])] = json.loads(json.dumps(body, default=str))
+        return body
+
+    def read_item(self, item, partition_key, response_hook=None, **kwargs):
+        self.call("read_item")
+        with self.lock:
+            found = self.items.get((partition_key, item))
+        if found is None:
+            self.charge(1.0, response_hook, None)
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+        self.charge(1.0 + item_size(found) / 1024, response_hook, found)
+        return dict(found)
+
+    def delete_item(self, item, partition_key, response_hook=None, **kwargs):
+        self.call("delete_item")
+        self.charge(5.0, response_hook, None)
+        with self.lock:
+            if self.items.pop((partition_key, item), None) is None:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+
+    def execute_item_batch(self, batch_operations, partition_key, response_hook=None, **kwargs):
+        sizes = [item_size(args[0]) if op in ("upsert", "create", "replace") else 0 for op, args in batch_operations]
+        self.call("execute_item_batch", sum(sizes))
+        for op, args in batch_operations:
+            if op in ("upsert", "create", "replace"):
+                self.check_partition_key(args[0], partition_key)
+        charges = [5.0 + 5.0 * size / 1024 for size in sizes]
+        self.charge(sum(charges), response_hook, None)
+        results = []
+        with self.lock:
+            for (op, args), charge in zip(batch_operations, charges):
+                if op in ("upsert", "create", "replace"):
+                    self.items[(partition_key, args[0]["id"])] = json.loads(json.dumps(args[0], default=str))
+                elif op == "delete":
+                    self.items.pop((partition_key, args[0]), None)
+                results.append({"statusCode": 200, "requestCharge": round(charge, 2)})
+        return results
+
+    def query_items(self, query, parameters=None, partition_key=None, enable_cross_partition_query=None,
+                    max_item_count=None, response_hook=None, **kwargs):
+        values = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        conditions = []
+        for match in CONDITION.finditer(query):
+            _, field, single, double, param = match.groups()
+            conditions.append((field, values.get(param) if param else (single if single is not None else double)))
+        with self.lock:
+            matched = [
+                dict(item) for (pk, _), item in sorted(self.items.items(), key=lambda entry: str(entry[0]))
+                if (partition_key is None or pk == partition_key)
+                and all(item.get(field) == value for field, value in conditions)
+            ]
+        return FakeQueryIterable(self, matched, max_item_count or 100, response_hook)
+
+class FakeQueryIterable:
+    def __init__(self, container, items, page_size, response_hook):
+        self.container = container
+        self.items = items
+        self.page_size = page_size
+        self.response_hook = response_hook
+
+    def by_page(self, continuation_token=None):
+        return FakeQueryPages(self, int(continuation_token or 0))
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+class FakeQueryPages:
+    def __init__(self, query, position):
+        self.query = query
+        self.position = position
+        self.continuation_token = None
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        page = self.query.items[self.position:self.position + self.query.page_size]
+        size = sum(item_size(item) for item in page)
+        self.query.container.call("query_items", size)
+        self.query.container.charge(2.5 + len(page) * 0.1 + size / 1024, self.query.response_hook, page)
+        self.position += len(page)
+        self.done = self.position >= len(self.query.items)
+        self.continuation_token = None if self.done else str(self.position)
+        return iter(page)
+
+class FakeAsyncCosmosContainer(FakeAsync):
+    def __init__(self, container):
+        super().__init__(container, container.env)
+
+    def query_items(self, **kwargs):
+        return FakeAsyncQueryIterable(self.target.query_items(**kwargs))
+
+class FakeAsyncQueryIterable:
+    def __init__(self, query):
+        self.query = query
+
+    def by_page(self, continuation_token=None):
+        return FakeAsyncQueryPages(self.query.by_page(continuation_token))
+
+class FakeAsyncQueryPages:
+    def __init__(self, pages):
+        self.pages = pages
+
+    @property
+    def continuation_token(self):
+        return self.pages.continuation_token
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # StopIteration cannot propagate through a coroutine
+        page = await self.pages.query.container.env.latency.deferred(next, self.pages, None)
+        if page is None:
+            raise StopAsyncIteration
+        return FakeAsyncItems(list(page))
+
+class FakeAsyncItems:
+    def __init__(self, items):
+        self.items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class FakeCosmos:
+    def __init__(self, env, partition_key_paths=None, ru_per_second=None):
+        self.env = env
+        self.partition_key_paths = partition_key_paths or {}
+        self.ru_per_second = ru_per_second
+        self.containers = {}
+        self.lock = threading.Lock()
+
+    def get_container(self, container_name, resource_token=None):
+        with self.lock:
+            container = self.containers.get(container_name)
+            if container is None:
+                container = FakeCosmosContainer(
+                    self.env,
+                    container_name,
+                    self.partition_key_paths.get(container_name, "/PK"),
+                    self.ru_per_second,
+                )
+                self.containers[container_name] = container
+            return container
+
+    def get_async_container(self, container_name, resource_token=None):
+        return FakeAsyncCosmosContainer(self.get_container(container_name, resource_token))
+
+### BLOB ###
+
+class FakeBlobProperties:
+    def __init__(self, blob):
+        self.size = len(blob["data"])
+        self.metadata = dict(blob["metadata"])
+        self.content_settings = blob["content_settings"] or SimpleNamespace(content_md5=None, content_type=None)
+        self.etag = blob["etag"]
+
+class FakeDownload:
+    def __init__(self, data):
+        self.data = data
+
+    def readall(self):
+        return self.data
+
+    def chunks(self):
+        for start in range(0, len(self.data), 4 * 1024 * 1024):
+            yield self.data[start:start + 4 * 1024 * 1024]
+
+class FakeBlobClient:
+    def __init__(self, service, container, blob):
+        self.service = service
+        self.env = service.env
+        self.container_name = container
+        self.blob_name = blob
+        self.key = (container, blob)
+        self.url = f"https://{service.account_name}.blob.core.windows.net/{container}/{blob}"
+
+    def call(self, operation, nbytes=0):
+        self.env.calls.add(f"blob.{operation}")
+        self.env.latency.wait("blob", nbytes)
+
+    def stored(self):
+        blob = self.service.blobs.get(self.key)
+        if blob is None:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return blob
+
+    def exists(self, **kwargs):
+        self.call("exists")
+        return self.key in self.service.blobs
+
+    def get_blob_properties(self, **kwargs):
+        self.call("get_blob_properties")
+        with self.service.lock:
+            return FakeBlobProperties(self.stored())
+
+    def upload_blob(self, data, overwrite=False, metadata=None, content_settings=None, **kwargs):
+        if hasattr(data, "read"):
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.call("upload_blob", len(data))
+        with self.service.lock:
+            if not overwrite and self.key in self.service.blobs:
+                raise ResourceExistsError("The specified blob already exists.")
+            self.service.put(self.key, bytes(data), metadata, content_settings)
+
+    def download_blob(self, offset=None, length=None, **kwargs):
+        with self.service.lock:
+            data = self.stored()["data"]
+        if offset is not None:
+            data = data[offset:None if length is None else offset + length]
+        self.call("download_blob", len(data))
+        return FakeDownload(data)
+
+    def stage_block(self, block_id, data, length=None, **kwargs):
+        if hasattr(data, "read"):
+            data = data.read()
+        self.call("stage_block", len(data))
+        with self.service.lock:
+            self.service.staged.setdefault(self.key, {})[block_id] = bytes(data)
+
+    def get_block_list(self, block_list_type="committed", **kwargs):
+        self.call("get_block_list")
+        with self.service.lock:
+            if self.key not in self.service.blobs and self.key not in self.service.staged:
+                raise ResourceNotFoundError("The specified blob does not exist.")
+            uncommitted = [SimpleNamespace(id=block_id, size=len(data)) for block_id, data in self.service.staged.get(self.key, {}).items()]
+        return [], uncommitted
+
+    def commit_block_list(self, block_list, metadata=None, content_settings=None, etag=None, match_condition=None, **kwargs):
+        self.call("commit_block_list")
+        with self.service.lock:
+            if etag == "*" and match_condition is not None and match_condition.name == "IfMissing" and self.key in self.service.blobs:
+                raise ResourceExistsError("The specified blob already exists.")
+            staged = self.service.staged.get(self.key, {})
+            block_ids = [block if isinstance(block, str) else block.id for block in block_list]
+            data = b"".join(staged[block_id] for block_id in block_ids)
+            self.service.put(self.key, data, metadata, content_settings)
+            self.service.staged.pop(self.key, None)
+
+    def delete_blob(self, **kwargs):
+        self.call("delete_blob")
+        with self.service.lock:
+            self.service.blobs.pop(self.key, None)
+
+class FakeBlobService:
+    def __init__(self, env, account_name="benchaccount"):
+        self.env = env
+        self.account_name = account_name
+        self.url = f"https://{account_name}.blob.core.windows.net"
+        self.blobs = {}
+        self.staged = {}
+        self.lock = threading.Lock()
+
+    def put(self, key, data, metadata, content_settings):
+        self.blobs[key] = {
+            "data": data,
+            "metadata": dict(metadata or {}),
+            "content_settings": content_settings,
+            "etag": hashlib.md5(data, usedforsecurity=False).hexdigest(),
+        }
+
+    def get_blob_client(self, container, blob, **kwargs):
+        return FakeBlobClient(self, container, blob)
+
+    def get_user_delegation_key(self, key_start_time, key_expiry_time, **kwargs):
+        from azure.storage.blob import UserDelegationKey
+        self.env.calls.add("blob.get_user_delegation_key")
+        self.env.latency.wait("blob")
+        key = UserDelegationKey()
+        key.signed_oid = "00000000-0000-0000-0000-000000000000"
+        key.signed_tid = "00000000-0000-0000-0000-000000000000"
+        key.signed_start = key_start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        key.signed_expiry = key_expiry_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        key.signed_service = "b"
+        key.signed_version = "2021-08-06"
+        key.value = "YmVuY2gtZGVsZWdhdGlvbi1rZXk="
+        return key
+
+### ACI ###
+
+class FakePoller:
+    def wait(self, timeout=None):
+        pass
+
+    def result(self, timeout=None):
+        return None
+
+    def done(self):
+        return True
+
+class FakeContainerGroups:
+    # Created groups run for run_seconds and then report Succeeded with exit code 0, groups named in
+    # `running` keep running
+    def __init__(self, env, run_seconds=0.0):
+        self.env = env
+        self.run_seconds = run_seconds
+        self.groups = {}
+        self.tags = {}
+        self.running = set()
+        self.lock = threading.Lock()
+
+    def call(self, operation):
+        self.env.calls.add(f"aci.{operation}")
+        self.env.latency.wait("aci")
+
+    def view(self, name, created):
+        now = datetime.now(timezone.utc)
+        finished = name not in self.running and (now - created).total_seconds() >= self.run_seconds
+        finished_at = created + timedelta(seconds=self.run_seconds)
+        current = SimpleNamespace(
+            state="Terminated" if finished else "Running",
+            exit_code=0 if finished else None,
+            start_time=created,
+            finish_time=finished_at if finished else None,
+        )
+        return SimpleNamespace(
+            name=name,
+            provisioning_state="Succeeded",
+            instance_view=SimpleNamespace(state="Succeeded" if finished else "Running"),
+            containers=[SimpleNamespace(name="runner", instance_view=SimpleNamespace(current_state=current))],
+        )
+
+    def begin_create_or_update(self, resource_group_name, container_group_name, container_group, **kwargs):
+        self.call("begin_create_or_update")
+        with self.lock:
+            self.groups[container_group_name] = datetime.now(timezone.utc)
+            self.tags[container_group_name] = getattr(container_group, "tags", None)
+        return FakePoller()
+
+    def list_by_resource_group(self, resource_group_name, **kwargs):
+        self.call("list_by_resource_group")
+        with self.lock:
+            groups = list(self.groups.items())
+        return [SimpleNamespace(name=name, provisioning_state="Succeeded") for name, _ in groups]
+
+    def get(self, resource_group_name, container_group_name, **kwargs):
+        self.call("get")
+        with self.lock:
+            created = self.groups.get(container_group_name)
+            tags = self.tags.get(container_group_name)
+        if created is None:
+            raise ResourceNotFoundError(f"The Resource '{container_group_name}' was not found.")
+        group = self.view(container_group_name, created)
+        group.tags = tags
+        return group
+
+    def begin_delete(self, resource_group_name, container_group_name, **kwargs):
+        self.call("begin_delete")
+        with self.lock:
+            self.groups.pop(container_group_name, None)
+            self.tags.pop(container_group_name, None)
+        return FakePoller()
+
+class FakeAciClient:
+    def __init__(self, env, run_seconds=0.0):
+        self.container_groups = FakeContainerGroups(env, run_seconds)
+
+### LOG ANALYTICS ###
+
+TAKE = re.compile(r"\|\s*take\s+(\d+)")
+JOB_FILTER = re.compile(r'ContainerGroup_s\s*==\s*"([^"]+)"')
+JOB_ROWS = re.compile(r"-rows-(\d+)$")
+
+class FakeLogsClient:
+    # Every job has log_rows canned rows unless its name ends in -rows-<n>, `take` in the query is honoured
+    def __init__(self, env, log_rows=500, message_size=120):
+        self.env = env
+        self.log_rows = log_rows
+        self.message_size = message_size
+
+    def rows(self, job_id):
+        count = JOB_ROWS.search(job_id)
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        filler = "x" * max(0, self.message_size - 40)
+        return [
+            {
+                "TimeGenerated": start + timedelta(milliseconds=10 * index),
+                "Message": f"{job_id} line {index:06d} {filler}",
+                "Ingested": start + timedelta(seconds=1, milliseconds=10 * index),
+            }
+            for index in range(int(count.group(1)) if count else self.log_rows)
+        ]
+
+    def query_workspace(self, workspace_id, query, timespan=None, **kwargs):
+        match = JOB_FILTER.search(query)
+        rows = self.rows(match.group(1) if match else "job")
+        take = TAKE.search(query)
+        if take:
+            rows = rows[:int(take.group(1))]
+        self.env.calls.add("logs.query_workspace")
+        self.env.latency.wait("logs", sum(len(row["Message"]) for row in rows))
+        return SimpleNamespace(tables=[SimpleNamespace(rows=rows)], status="Success")
+
+### BROKER AND DOWNLOAD SOURCE ###
+
+def source_bytes(size, seed=0) -> bytes:
+    block = hashlib.sha256(f"bench-source-{seed}".encode("utf-8")).digest() * 2048
+    return (block * (size // len(block) + 1))[:size]
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients close probe and keep-alive connections early, that is not worth a traceback
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+class StubServer:
+    # Serves the broker's POST /token and GET /files/<size>[?seed=n] download sources with Range
+    # support, on an ephemeral localhost port
+    def __init__(self, env, container_names):
+        self.env = env
+        self.container_names = container_names
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.server = QuietHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def source(self, size, seed):
+        with self.lock:
+            data = self.sources.get((size, seed))
+            if data is None:
+                data = self.sources[(size, seed)] = source_bytes(size, seed)
+            return data
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send(self, status, body, headers=()):
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/token" or not self.headers.get("Authorization", "").startswith("Bearer "):
+                    return self.send(404, b"not found")
+                stub.env.calls.add("broker.token")
+                stub.env.latency.wait("broker")
+                partition_key = request.get("data", {}).get("partitionKey", "")
+                tokens = {name: f"type=resource&ver=1&sig=bench-{name}-{partition_key}" for name in stub.container_names}
+                tokens["expires_on"] = int(time.time()) + 3600
+                self.send(200, json.dumps(tokens).encode("utf-8"), [("Content-Type", "application/json")])
+
+            def do_GET(self):
+                match = re.fullmatch(r"/files/(\d+)(?:\?seed=(\d+))?", self.path)
+                if not match:
+                    return self.send(404, b"not found")
+                data = stub.source(int(match.group(1)), int(match.group(2) or 0))
+                byte_range = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if byte_range:
+                    start = int(byte_range.group(1))
+                    end = min(int(byte_range.group(2) or len(data) - 1), len(data) - 1)
+                    body = data[start:end + 1]
+                    stub.env.calls.add("download.range")
+                    stub.env.latency.wait("download", len(body))
+                    return self.send(206, body, [("Content-Range", f"bytes {start}-{end}/{len(data)}")])
+                stub.env.calls.add("download.get")
+                stub.env.latency.wait("download", len(data))
+                self.send(200, data)
+
+        return Handler
+
+### ENVIRONMENT ###
+
+class FakeEnvironment:
+    def __init__(self, latency: Latency, container_names, partition_key_paths=None, ru_per_second=None, log_rows=500, run_seconds=0.0):
+        self.latency = latency
+        self.calls = Calls()
+        self.credential = FakeCredential(self)
+        self.cosmos = FakeCosmos(self, partition_key_paths, ru_per_second)
+        self.blob_services = {}
+        self.aci = FakeAciClient(self, run_seconds)
+        self.logs = FakeLogsClient(self, log_rows)
+        self.server = StubServer(self, container_names)
+        self.lock = threading.Lock()
+
+    def blob_service(self, account_name="benchaccount"):
+        with self.lock:
+            service = self.blob_services.get(account_name)
+            if service is None:
+                service = self.blob_services[account_name] = FakeBlobService(self, account_name)
+            return service
+
+    def install(self, app):
+        # Points the app's client factories and broker credential at the fakes
+        self.server.start()
+        app.get_cosmos_container = self.cosmos.get_container
+        app.get_blob_service_client = self.blob_service
+        app.get_archive_blob_service_client = lambda: self.blob_service("AzureWebJobsStorage")
+        app.get_aci_client = lambda subscription_id: self.aci
+        app.get_logs_client = lambda: self.logs
+        app.get_default_credential = lambda: self.credential
+        app._broker_credential = self.credential
+        app.get_async_cosmos_container = self.cosmos.get_async_container
+        app.get_async_blob_service_client = lambda account_name: FakeAsync(self.blob_service(account_name), self, sync=("get_blob_client",))
+        app.get_default_credential_async = lambda: FakeAsync(self.credential, self)
+        app._broker_credential_async = FakeAsync(self.credential, self)
+        return self
+
+    def close(self):
+        self.server.stop()
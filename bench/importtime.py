@@ -0,0 +1,112 @@
+# Import-time budget for api/function_app.py, measured with `python -X importtime`.
+#
+#   python bench/importtime.py [--budget-ms 50] [--runs 5] [--output importtime.json]
+#
+# The Functions worker has azure.functions loaded before it imports the app, so the budget covers
+# what function_app adds on top of it. The check fails when the median exceeds the budget or when
+# one of the SDKs that are meant to load on first use is imported at startup.
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(os.path.dirname(BENCH_DIR), "api")
+
+sys.path.insert(0, BENCH_DIR)
+from run import APP_ENVIRONMENT
+
+DEFAULT_BUDGET_MS = 50.0
+# Loaded on first use by the events that need them, never at startup
+DEFERRED_MODULES = (
+    "requests",
+    "aiohttp",
+    "azure.core.pipeline.transport",
+    "azure.cosmos",
+    "azure.identity",
+    "azure.storage.blob",
+    "azure.storage.queue",
+    "azure.mgmt.containerinstance",
+    "azure.monitor.query",
+    "opentelemetry",
+)
+
+def measure(env):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import azure.functions; import function_app"],
+        cwd=API_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing function_app failed:\n{result.stderr[-2000:]}")
+
+    # Lines look like "import time:  self [us] | cumulative | <indent>name", children come first
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        name = fields[2].strip()
+        modules[name] = (int(fields[0]), int(fields[1]), len(fields[2]) - len(fields[2].lstrip()))
+
+    app_self, app_total, app_depth = modules["function_app"]
+    # Everything imported after azure.functions was imported on behalf of the app
+    names = list(modules)
+    loaded = names[names.index("azure.functions") + 1:names.index("function_app")]
+    direct = sorted(
+        ((name, modules[name][1]) for name in loaded if modules[name][2] == app_depth + 2),
+        key=lambda entry: entry[1],
+        reverse=True,
+    )
+    return {"total_us": app_total, "self_us": app_self, "modules": loaded, "direct": direct}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the import time of api/function_app.py.")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="Also write the measurements to this JSON file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as pycache:
+        env = dict(os.environ, **APP_ENVIRONMENT, PYTHONPYCACHEPREFIX=pycache)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        # The first run compiles bytecode into the temporary cache, it is not measured
+        measure(env)
+        runs = [measure(env) for _ in range(max(1, args.runs))]
+
+    median_ms = statistics.median(run["total_us"] for run in runs) / 1000
+    deferred = sorted({
+        name for run in runs for module in run["modules"] for name in DEFERRED_MODULES
+        if module == name or module.startswith(name + ".")
+    })
+    report = {
+        "median_ms": round(median_ms, 2),
+        "runs_ms": [round(run["total_us"] / 1000, 2) for run in runs],
+        "self_ms": round(statistics.median(run["self_us"] for run in runs) / 1000, 2),
+        "budget_ms": args.budget_ms,
+        "slowest_imports_ms": {name: round(total / 1000, 2) for name, total in runs[-1]["direct"][:10]},
+        "deferred_modules_imported": deferred,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    print(json.dumps(report, indent=2))
+
+    failures = []
+    if median_ms > args.budget_ms:
+        failures.append(f"function_app imports in {median_ms:.1f} ms, the budget is {args.budget_ms:.1f} ms")
+    if deferred:
+        failures.append(f"imported at startup but meant to load on first use: {', '.join(deferred)}")
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
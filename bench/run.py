@@ -0,0 +1,570 @@
+# Offline benchmark for api/function_app.py. The generic_api handler runs in-process against the
+# fakes in fakes.py, so nothing here talks to Azure. Results are written as JSON, compare two runs
+# with compare.py.
+#
+#   python bench/run.py --output bench_output.json
+#   python bench/run.py --only read_db --latency cosmos=20 --iterations 100
+#   python bench/run.py --latency-scale 0     # CPU only, no injected latency
+
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import argparse
+import contextlib
+import platform
+import threading
+import itertools
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "api"))
+
+from fakes import FakeEnvironment, Latency, source_bytes
+
+SUBSCRIPTION_ID = "11111111-2222-3333-4444-555555555555"
+STORAGE_ACCOUNT = "benchstorage"
+
+APP_ENVIRONMENT = {
+    "EVENTS_TABLE_NAME": "events",
+    "MODULES_TABLE_NAME": "modules",
+    "POLICIES_TABLE_NAME": "policies",
+    "DEPLOYMENTS_TABLE_NAME": "deployments",
+    "CHANGE_RECORDS_TABLE_NAME": "change-records",
+    "CONFIG_TABLE_NAME": "config",
+    "MODULE_S3_BUCKET": "modules",
+    "POLICY_S3_BUCKET": "policies",
+    "CHANGE_RECORD_S3_BUCKET": "change-records",
+    "PROVIDERS_S3_BUCKET": "providers",
+    "COSMOS_DB_ENDPOINT": "https://bench.documents.azure.com:443/",
+    "COSMOS_DB_DATABASE": "infraweave",
+    "AZURE_SUBSCRIPTION_ID": SUBSCRIPTION_ID,
+    "RESOURCE_GROUP_NAME": "bench-rg",
+    "REGION": "westeurope",
+    "REGION_SHORT": "weu",
+    "LOCATION": "westeurope",
+    "IMAGE": "infraweave/runner:bench",
+    "STORAGE_ACCOUNT_NAME": STORAGE_ACCOUNT,
+    "PUBLIC_STORAGE_ACCOUNT_NAME": STORAGE_ACCOUNT,
+    "LOG_ANALYTICS_WORKSPACE_ID": "bench-workspace",
+    "LOG_ANALYTICS_WORKSPACE_KEY": "YmVuY2g=",
+    "LOG_ARCHIVE_CONTAINER": "job-logs",
+    "USER_ASSIGNED_IDENTITY_RESOURCE_ID": f"/subscriptions/{SUBSCRIPTION_ID}/resourceGroups/bench-rg/providers/Microsoft.ManagedIdentity/userAssignedIdentities/runner",
+    "ACI_SUBNET_ID": f"/subscriptions/{SUBSCRIPTION_ID}/resourceGroups/bench-rg/providers/Microsoft.Network/virtualNetworks/bench/subnets/aci",
+    "BROKER_SCOPE": "api://bench-broker/.default",
+    "RUNNER_QUEUE_BACKEND": "memory",
+}
+
+# Workload tables hold one partition per project (the subscription id), which is the partition
+# key the app reads and deletes with. Catalog tables are partitioned on PK.
+WORKLOAD_PARTITION_KEY_PATH = "/project_id"
+PARTITION_KEY_PATHS = {
+    APP_ENVIRONMENT[name]: WORKLOAD_PARTITION_KEY_PATH
+    for name in ("EVENTS_TABLE_NAME", "DEPLOYMENTS_TABLE_NAME", "CHANGE_RECORDS_TABLE_NAME")
+}
+
+ITERATIONS = {"single": 50, "bulk": 10, "large": 5, "burst": 128}
+BURST_CONCURRENCY = 32
+
+scenarios = {}
+
+def scenario(event, shape, iterations=None, concurrency=None):
+    def register(fn):
+        name = f"{event}.{shape}"
+        scenarios[name] = {
+            "name": name,
+            "event": event,
+            "shape": shape,
+            "iterations": iterations or ITERATIONS.get(shape, ITERATIONS["single"]),
+            "concurrency": concurrency or (BURST_CONCURRENCY if shape == "burst" else 1),
+            "setup": fn,
+        }
+        return fn
+    return register
+
+class BenchError(Exception):
+    pass
+
+class Bench:
+    def __init__(self, app, env):
+        self.app = app
+        self.env = env
+        self.func = app.func
+        # generic_api_async runs on one long-lived loop, as in the Functions worker
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def request(self, body=None, params=None, raw=None):
+        return self.func.HttpRequest(
+            method="POST",
+            url="/api/api",
+            headers={"Content-Type": "application/octet-stream" if raw is not None else "application/json"},
+            params=params or {},
+            body=raw if raw is not None else json.dumps(body).encode("utf-8"),
+        )
+
+    def send(self, req, expect=(200,)):
+        return self.check(self.app.handler(req), expect)
+
+    def send_async(self, req, expect=(200,)):
+        return self.check(asyncio.run_coroutine_threadsafe(self.app.async_handler(req), self.loop).result(), expect)
+
+    def check(self, response, expect):
+        if response.status_code not in expect:
+            raise BenchError(f"{response.status_code}: {response.get_body()[:200].decode('utf-8', 'replace')}")
+        body = response.get_body()
+        try:
+            return json.loads(body)
+        except ValueError:
+            return body
+
+    def call(self, event, data=None, expect=(200,), **fields):
+        return self.send(self.request({"event": event, "data": data, **fields}), expect)
+
+    def call_async(self, event, data=None, expect=(200,), **fields):
+        return self.send_async(self.request({"event": event, "data": data, **fields}), expect)
+
+    def upload_chunk(self, session_id, index, data):
+        return self.send(self.request(params={"event": "upload_chunk", "session_id": session_id, "index": str(index)}, raw=data))
+
+    def seed_items(self, table, count, partition_key=SUBSCRIPTION_ID, size=200, prefix="item"):
+        container = self.env.cosmos.get_container(self.app.tables[table])
+        filler = "x" * size
+        with container.lock:
+            for index in range(count):
+                item = {"PK": partition_key, "SK": f"{prefix}#{index:06d}", "batch": prefix, "payload": filler}
+                item[container.partition_key_path.lstrip("/")] = partition_key
+                item["id"] = self.app.get_id(item)
+                container.items[(partition_key, item["id"])] = item
+        return container
+
+def deployment(index, size=200):
+    return {
+        "PK": f"DEPLOYMENT#bench-{index % 10}",
+        "SK": f"MODULE#s3bucket#{index:06d}",
+        "project_id": SUBSCRIPTION_ID,
+        "status": "successful",
+        "payload": "x" * size,
+    }
+
+def expect_success(results):
+    failed = [result for result in results if result.get("status") != "Success"]
+    if failed:
+        raise BenchError(f"{len(failed)} of {len(results)} writes failed: {failed[0]}")
+    return results
+
+### SCENARIOS ###
+
+@scenario("insert_db", "burst")
+@scenario("insert_db", "single")
+def insert_db_single(bench):
+    return lambda i: bench.call("insert_db", deployment(i), table="events")
+
+@scenario("insert_db", "bulk")
+def insert_db_bulk(bench):
+    return lambda i: bench.call("insert_db", [deployment(i * 200 + n) for n in range(200)], table="events")
+
+@scenario("insert_db", "large")
+def insert_db_large(bench):
+    return lambda i: bench.call("insert_db", deployment(i, size=512 * 1024), table="events")
+
+def put(table, index, size=200):
+    return {"Put": {"TableName": table, "Item": deployment(index, size)}}
+
+@scenario("transact_write", "burst")
+@scenario("transact_write", "single")
+def transact_write_single(bench):
+    return lambda i: expect_success(bench.call("transact_write", items=[put("events", i)]))
+
+@scenario("transact_write", "bulk")
+def transact_write_bulk(bench):
+    tables = ("events", "deployments", "change_records")
+    return lambda i: expect_success(bench.call("transact_write", items=[put(tables[n % 3], i * 300 + n) for n in range(300)]))
+
+@scenario("transact_write", "large")
+def transact_write_large(bench):
+    return lambda i: expect_success(bench.call("transact_write", items=[put("events", i * 20 + n, size=64 * 1024) for n in range(20)]))
+
+# Read-after-write across both partition key models, every write must come back unchanged
+@scenario("transact_write", "roundtrip")
+def transact_write_roundtrip(bench):
+    def run(i):
+        module = {"PK": f"MODULE#bench-{i % 10}", "SK": f"VERSION#{i:06d}", "status": "published", "payload": "x" * 200}
+        written = {"modules": module, "events": deployment(i)}
+        expect_success(bench.call("transact_write", items=[{"Put": {"TableName": table, "Item": item}} for table, item in written.items()]))
+        for table, item in written.items():
+            found = bench.call("get_item", {"PK": item["PK"], "SK": item["SK"]}, table=table)
+            # Point reads return the item, the query fallback returns the matching items
+            if isinstance(found, list) and len(found) == 1:
+                found = found[0]
+            if not isinstance(found, dict) or any(found.get(key) != value for key, value in item.items()):
+                raise BenchError(f"{table} read after write returned {str(found)[:200]}")
+    return run
+
+@scenario("read_db", "burst")
+@scenario("read_db", "single")
+def read_db_single(bench):
+    bench.seed_items("deployments", 20, prefix="single")
+    query = "SELECT * FROM c WHERE c.batch = 'single'"
+    return lambda i: bench.call("read_db", {"query": query}, table="deployments")
+
+@scenario("read_db", "bulk")
+def read_db_bulk(bench):
+    bench.seed_items("change_records", 2000, prefix="bulk")
+    return lambda i: bench.call("read_db", {"query": "SELECT * FROM c WHERE c.batch = 'bulk'"}, table="change_records")
+
+@scenario("read_db", "paged")
+def read_db_paged(bench):
+    bench.seed_items("change_records", 2000, prefix="bulk")
+
+    def op(i):
+        token = None
+        for _ in range(5):
+            page = bench.call("read_db", {"query": "SELECT * FROM c WHERE c.batch = 'bulk'", "page_size": 100, "continuation_token": token}, table="change_records")
+            token = page["continuation_token"]
+    return op
+
+@scenario("read_db", "large")
+def read_db_large(bench):
+    bench.seed_items("policies", 50, partition_key="POLICY#large", size=64 * 1024)
+    return lambda i: bench.call("read_db", {"query": "SELECT * FROM c WHERE c.PK = 'POLICY#large'"}, table="policies")
+
+@scenario("read_db", "catalog")
+def read_db_catalog(bench):
+    bench.seed_items("modules", 200, partition_key="MODULE#s3bucket")
+    return lambda i: bench.call("read_db", {"query": "SELECT * FROM c WHERE c.PK = 'MODULE#s3bucket'"}, table="modules")
+
+@scenario("get_item", "burst")
+@scenario("get_item", "single")
+def get_item_single(bench):
+    bench.seed_items("deployments", 500, prefix="point")
+    return lambda i: bench.call("get_item", {"PK": SUBSCRIPTION_ID, "SK": f"point#{i % 500:06d}"}, table="deployments")
+
+@scenario("generate_presigned_url", "burst")
+@scenario("generate_presigned_url", "single")
+def generate_presigned_url_single(bench):
+    return lambda i: bench.call("generate_presigned_url", {"bucket_name": "modules", "key": f"modules/s3bucket/{i}.zip", "expires_in": 600})
+
+@scenario("generate_presigned_urls", "bulk")
+def generate_presigned_urls_bulk(bench):
+    objects = [{"bucket_name": "modules", "key": f"modules/s3bucket/{n}.zip"} for n in range(100)]
+    return lambda i: bench.call("generate_presigned_urls", {"objects": objects, "expires_in": 600})
+
+def base64_upload(bench, size, unique=True):
+    run = time.time_ns()
+
+    def op(i):
+        name = f"{run}-{i}" if unique else "same"
+        content = source_bytes(size, seed=name)
+        return bench.call("upload_file_base64", {
+            "bucket_name": "modules",
+            "key": f"bench/base64/{size}/{name}.zip",
+            "base64_content": base64.b64encode(content).decode("ascii"),
+        })
+    return op
+
+@scenario("upload_file_base64", "burst")
+@scenario("upload_file_base64", "single")
+def upload_file_base64_single(bench):
+    return base64_upload(bench, 16 * 1024)
+
+@scenario("upload_file_base64", "large")
+def upload_file_base64_large(bench):
+    return base64_upload(bench, 8 * 1024 * 1024)
+
+@scenario("upload_file_base64", "dedup")
+def upload_file_base64_dedup(bench):
+    return base64_upload(bench, 1024 * 1024, unique=False)
+
+def url_upload(bench, size):
+    run = time.time_ns()
+
+    def op(i):
+        return bench.call("upload_file_url", {
+            "bucket_name": "providers",
+            "key": f"bench/url/{run}/{size}/{i}.zip",
+            "url": f"{bench.env.server.url}/files/{size}?seed={i % 4}",
+        })
+    return op
+
+@scenario("upload_file_url", "burst", iterations=32, concurrency=8)
+@scenario("upload_file_url", "single")
+def upload_file_url_single(bench):
+    return url_upload(bench, 1024 * 1024)
+
+@scenario("upload_file_url", "large")
+def upload_file_url_large(bench):
+    return url_upload(bench, 64 * 1024 * 1024)
+
+@scenario("upload_session", "large")
+def upload_session_large(bench):
+    chunk_size = 4 * 1024 * 1024
+    chunks = [source_bytes(chunk_size, seed=n) for n in range(4)]
+    checksum = hashlib.sha256(b"".join(hashlib.sha256(chunk).digest() for chunk in chunks)).hexdigest()
+
+    def op(i):
+        session = bench.call("begin_upload", {"bucket_name": "providers", "key": f"bench/session/{i}.zip"})
+        for index, chunk in enumerate(chunks):
+            bench.upload_chunk(session["session_id"], index, chunk)
+        return bench.call("commit_upload", {"session_id": session["session_id"], "chunks": len(chunks), "sha256": checksum})
+    return op
+
+@scenario("start_runner", "burst", iterations=64, concurrency=16)
+@scenario("start_runner", "single")
+def start_runner_single(bench):
+    return lambda i: bench.call("start_runner", {"command": "plan", "module": "s3bucket", "cpu": 1, "memory": 2})
+
+@scenario("start_runner", "large")
+def start_runner_large(bench):
+    # A plan with many variables, too large for a queue message but inline in PAYLOAD
+    variables = {f"variable_{n}": "x" * 200 for n in range(450)}
+    return lambda i: bench.call("start_runner", {"command": "plan", "module": "s3bucket", "cpu": 1, "memory": 2, "variables": variables})
+
+@scenario("start_runners", "bulk")
+def start_runners_bulk(bench):
+    return lambda i: bench.call("start_runners", [{"command": "apply", "module": "s3bucket", "index": n} for n in range(20)])
+
+@scenario("read_logs", "burst", iterations=64, concurrency=16)
+@scenario("read_logs", "single")
+def read_logs_single(bench):
+    return lambda i: bench.call("read_logs", {"job_id": f"bench-job-{i}", "limit": 500})
+
+@scenario("read_logs", "large")
+def read_logs_large(bench):
+    return lambda i: bench.call("read_logs", {"job_id": f"bench-job-{i}-rows-10000"})
+
+@scenario("read_logs", "archived")
+def read_logs_archived(bench):
+    summary = {"state": "Succeeded", "exit_code": 0, "started_at": "2024-01-01T00:00:00+00:00", "finished_at": "2024-01-01T00:10:00+00:00"}
+    for index in range(ITERATIONS["single"]):
+        bench.app.archive_job_logs(f"bench-archived-{index}-rows-5000", summary)
+
+    def op(i):
+        job_id = f"bench-archived-{i % ITERATIONS['single']}-rows-5000"
+        page = bench.call("read_logs", {"job_id": job_id, "limit": 1000})
+        return bench.call("read_logs", {"job_id": job_id, "limit": 1000, "cursor": page["cursor"]})
+    return op
+
+def seed_jobs(bench, count, running):
+    groups = bench.env.aci.container_groups
+    job_ids = [f"infraweave-runner-job-bench-{'running' if running else 'done'}-{index}" for index in range(count)]
+    with groups.lock:
+        for job_id in job_ids:
+            groups.groups[job_id] = datetime.now(timezone.utc)
+            if running:
+                groups.running.add(job_id)
+    return job_ids
+
+@scenario("job_status", "burst")
+@scenario("job_status", "single")
+def job_status_single(bench):
+    job_ids = seed_jobs(bench, 10, running=True)
+    return lambda i: bench.call("job_status", {"job_id": job_ids[i % len(job_ids)]})
+
+@scenario("job_status", "bulk")
+def job_status_bulk(bench):
+    job_ids = seed_jobs(bench, 50, running=True) + seed_jobs(bench, 50, running=False)
+    return lambda i: bench.call("job_status", {"job_ids": job_ids})
+
+### ASYNC ###
+
+# The same events through generic_api_async, shape "async" runs one request at a time and
+# "async_burst" runs concurrent requests on the shared loop
+@scenario("insert_db", "async")
+def insert_db_async(bench):
+    return lambda i: bench.call_async("insert_db", deployment(i), table="events")
+
+@scenario("transact_write", "async_burst", iterations=ITERATIONS["burst"], concurrency=BURST_CONCURRENCY)
+@scenario("transact_write", "async")
+def transact_write_async(bench):
+    tables = ("events", "deployments", "change_records")
+    return lambda i: expect_success(bench.call_async("transact_write", items=[put(tables[n % 3], i * 30 + n) for n in range(30)]))
+
+@scenario("read_db", "async")
+def read_db_async(bench):
+    bench.seed_items("change_records", 2000, prefix="bulk")
+    return lambda i: bench.call_async("read_db", {"query": "SELECT * FROM c WHERE c.batch = 'bulk'"}, table="change_records")
+
+@scenario("get_item", "async_burst", iterations=ITERATIONS["burst"], concurrency=BURST_CONCURRENCY)
+@scenario("get_item", "async")
+def get_item_async(bench):
+    bench.seed_items("deployments", 500, prefix="point")
+    return lambda i: bench.call_async("get_item", {"PK": SUBSCRIPTION_ID, "SK": f"point#{i % 500:06d}"}, table="deployments")
+
+@scenario("generate_presigned_urls", "async")
+def generate_presigned_urls_async(bench):
+    objects = [{"bucket_name": "modules", "key": f"modules/s3bucket/{n}.zip"} for n in range(100)]
+    return lambda i: bench.call_async("generate_presigned_urls", {"objects": objects, "expires_in": 600})
+
+### RUNNER ###
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def summarise(latencies):
+    ordered = sorted(latencies)
+    return {
+        "min": round(ordered[0], 3) if ordered else None,
+        "p50": round(percentile(ordered, 0.5), 3) if ordered else None,
+        "p90": round(percentile(ordered, 0.9), 3) if ordered else None,
+        "p99": round(percentile(ordered, 0.99), 3) if ordered else None,
+        "max": round(ordered[-1], 3) if ordered else None,
+        "mean": round(sum(ordered) / len(ordered), 3) if ordered else None,
+    }
+
+def run_round(op, indices, concurrency, latencies, errors):
+    def timed(index):
+        started = time.perf_counter()
+        try:
+            op(index)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    if concurrency <= 1:
+        for index in indices:
+            timed(index)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, indices))
+
+def run_scenario(bench, spec, iterations=None, concurrency=None, warmup=1):
+    iterations = iterations or spec["iterations"]
+    concurrency = concurrency or spec["concurrency"]
+    op = spec["setup"](bench)
+    counter = itertools.count()
+
+    # Warm-up calls fill the token, client and catalog caches, as on a warm instance
+    run_round(op, [next(counter) for _ in range(warmup)], 1, [], [])
+
+    bench.env.calls.reset()
+    latencies, errors = [], []
+    started = time.perf_counter()
+    run_round(op, [next(counter) for _ in range(iterations)], concurrency, latencies, errors)
+    wall = time.perf_counter() - started
+    calls = bench.env.calls.snapshot()
+
+    # Peak memory is measured on a separate round so tracing does not skew the latencies
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    run_round(op, [next(counter) for _ in range(concurrency)], concurrency, [], [])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "event": spec["event"],
+        "shape": spec["shape"],
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:3],
+        "latency_ms": summarise(latencies),
+        "wall_seconds": round(wall, 3),
+        "throughput_per_s": round(iterations / wall, 2) if wall else None,
+        "calls": calls,
+        "calls_per_op": {name: round(count / iterations, 2) for name, count in calls.items()},
+        "peak_memory_bytes": peak,
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def parse_pairs(values):
+    pairs = {}
+    for value in values or []:
+        for pair in value.split(","):
+            name, _, number = pair.partition("=")
+            pairs[name.strip()] = float(number)
+    return pairs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the generic_api handler.")
+    parser.add_argument("--only", action="append", help="Run scenarios whose name starts with this prefix, repeatable")
+    parser.add_argument("--list", action="store_true", help="List the scenarios and exit")
+    parser.add_argument("--iterations", type=int, help="Override the iterations of every scenario")
+    parser.add_argument("--concurrency", type=int, help="Override the concurrency of burst scenarios")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--latency", action="append", metavar="NAME=MS", help="Per call latency, e.g. cosmos=10,blob=20")
+    parser.add_argument("--bandwidth", action="append", metavar="NAME=MIBS", help="Throughput of data transfers, e.g. blob=100")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiply all latencies, 0 disables them")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--ru-per-second", type=float, help="Throttle every fake container above this RU/s")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    selected = [spec for name, spec in scenarios.items() if not args.only or any(name.startswith(prefix) for prefix in args.only)]
+    if args.list:
+        for spec in selected:
+            print(f"{spec['name']:40} iterations={spec['iterations']} concurrency={spec['concurrency']}")
+        return 0
+
+    for name, value in APP_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    import function_app
+
+    latency = Latency(parse_pairs(args.latency), parse_pairs(args.bandwidth), args.latency_scale, args.jitter, args.seed)
+    env = FakeEnvironment(latency, sorted(set(function_app.tables.values())), PARTITION_KEY_PATHS, ru_per_second=args.ru_per_second)
+    env.install(function_app)
+    os.environ["BROKER_URL"] = env.server.url
+    bench = Bench(function_app, env)
+
+    results = {}
+    # The app prints progress messages, stdout is kept for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            for spec in selected:
+                print(f"running {spec['name']}")
+                concurrency = args.concurrency if args.concurrency and spec["concurrency"] > 1 else None
+                results[spec["name"]] = run_scenario(bench, spec, args.iterations, concurrency, args.warmup)
+        finally:
+            bench.close()
+            env.close()
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "latency_ms": latency.latency,
+            "bandwidth_mib_s": latency.bandwidth,
+            "latency_scale": latency.scale,
+            "jitter": latency.jitter,
+            "ru_per_second": args.ru_per_second,
+        },
+        "scenarios": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 1 if any(result["errors"] for result in results.values()) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -49,6 +49,55 @@ resource "azurerm_storage_account" "storage" {
   }
 }
 
+resource "azurerm_storage_container" "job_logs" {
+  name                  = "job-logs"
+  storage_account_id    = azurerm_storage_account.storage.id
+  container_access_type = "private"
+}
+
+resource "azurerm_storage_container" "runner_state" {
+  name                  = "runner-state"
+  storage_account_id    = azurerm_storage_account.storage.id
+  container_access_type = "private"
+}
+
+resource "azurerm_storage_management_policy" "runner_state" {
+  storage_account_id = azurerm_storage_account.storage.id
+
+  rule {
+    name    = "expire-runner-job-states"
+    enabled = true
+    filters {
+      prefix_match = [
+        "${azurerm_storage_container.runner_state.name}/jobs/",
+        "${azurerm_storage_container.runner_state.name}/payloads/",
+      ]
+      blob_types   = ["blockBlob"]
+    }
+    actions {
+      base_blob {
+        delete_after_days_since_modification_greater_than = 30
+      }
+      version {
+        delete_after_days_since_creation = 7
+      }
+    }
+  }
+}
+
+resource "azurerm_storage_queue" "runner" {
+  for_each = toset([
+    "runner-jobs-high",
+    "runner-jobs-normal",
+    "runner-jobs-low",
+    "runner-jobs-poison",
+    "runner-dispatch",
+  ])
+
+  name               = each.key
+  storage_account_id = azurerm_storage_account.storage.id
+}
+
 resource "azurerm_service_plan" "function_plan" {
   name                = "sp-infraweave-${local.proj_short}-${var.region}-${var.environment}"
   location            = azurerm_resource_group.main.location
@@ -143,6 +192,9 @@ resource "azurerm_linux_function_app" "function_app" {
     "REGION_SHORT"        = local.region_short
     "IMAGE"               = local.runner_image
 
+    # The runner image reads its payload from PAYLOAD only, PAYLOAD_URL needs a newer image
+    "RUNNER_PAYLOAD_OFFLOAD" = "false"
+
     "COSMOS_DB_ENDPOINT" = "https://iw-${local.central_proj_short}-${var.region}-${var.environment}.documents.azure.com:443/"
     "COSMOS_DB_DATABASE" = "db-infraweave"
 
@@ -170,6 +222,12 @@ resource "azurerm_linux_function_app" "function_app" {
     STORAGE_ACCOUNT_NAME        = "c${local.central_proj_supershort}${local.region_short}${var.environment}"
     PUBLIC_STORAGE_ACCOUNT_NAME = "p${local.central_proj_supershort}${local.region_short}${var.environment}"
 
+    LOG_ARCHIVE_CONTAINER  = azurerm_storage_container.job_logs.name
+    RUNNER_STATE_CONTAINER = azurerm_storage_container.runner_state.name
+
+    RUNNER_DISPATCH_MODE   = "queue"
+    RUNNER_MAX_CONCURRENCY = var.runner_max_concurrency
+
     "LOG_ANALYTICS_WORKSPACE_ID"  = azurerm_log_analytics_workspace.container_logs.workspace_id
     "LOG_ANALYTICS_WORKSPACE_KEY" = azurerm_log_analytics_workspace.container_logs.primary_shared_key
 
@@ -32,3 +32,9 @@ variable "all_workload_projects" {
     })
   )
 }
+
+variable "runner_max_concurrency" {
+  type        = number
+  default     = 100
+  description = "Maximum number of runner container groups alive at the same time, further jobs are queued (ACI allows at most 100 per resource group)"
+}